@@ -0,0 +1,346 @@
+""" Archive catalogue
+
+A SQLite index of the files in the archive's YYYY/MM/DD folders, so questions
+about the archive are answered without walking the folders over the SD card or
+NFS and hashing the files again.  transfer_data.py adds a row for each file it
+archives with its size, mtime, SleepHQ content hash and SHA-256 (the name of its
+blob in archive_store.py).  The upload status of each content hash is copied
+from prisma-upload-ledger.json by the uploader and prisma_backfill.py after a
+run.  A new file with the same content as an already uploaded one, e.g. an
+unchanged config.pcfg, starts out with that file's status.
+
+rebuild recreates the catalogue from the archive folder, e.g. for an archive
+written before the catalogue existed.  Each distinct blob is hashed once, in a
+pool of worker processes, and compacted days are restored to a temporary file
+to be hashed.
+
+Usage:
+    python3 archive_catalogue.py rebuild [--workers 4]
+    python3 archive_catalogue.py days [--from 2025-01-01] [--to 2025-01-31]
+    python3 archive_catalogue.py changes therapy.pdat    # days with new therapy data
+    python3 archive_catalogue.py changes config.pcfg --last
+    python3 archive_catalogue.py not-uploaded
+    python3 archive_catalogue.py hash <content hash or SHA-256>
+"""
+import argparse
+import datetime
+import logging
+import os
+import shutil
+import sqlite3
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+from archive_store import ArchiveStore, ARCHIVE_PATH, REF_SUFFIX
+from prisma_state import load_json_file, UploadLedger
+from sleephq_hash import HashCache, calculate_content_hash
+
+CATALOGUE_FILE = "./prisma-archive.db"
+LEDGER_FILE = "./prisma-upload-ledger.json"
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS files (
+    day           TEXT NOT NULL,
+    name          TEXT NOT NULL,
+    size          INTEGER NOT NULL,
+    mtime         REAL NOT NULL,
+    content_hash  TEXT NOT NULL,
+    sha256        TEXT,
+    upload_status TEXT,
+    import_id     TEXT,
+    updated       REAL NOT NULL,
+    PRIMARY KEY (day, name)
+);
+CREATE INDEX IF NOT EXISTS files_name_day ON files (name, day);
+CREATE INDEX IF NOT EXISTS files_content_hash ON files (content_hash);
+CREATE INDEX IF NOT EXISTS files_sha256 ON files (sha256);
+"""
+
+
+def folder_day(archive_path, folder):
+    """
+    Return value: the day of an archive day folder as YYYY-MM-DD, or None if
+                  the folder is not a YYYY/MM/DD folder
+    """
+    parts = os.path.relpath(folder, archive_path).split(os.sep)
+    if len(parts) != 3 or not all(part.isdigit() for part in parts):
+        return None
+    try:
+        return datetime.date(int(parts[0]), int(parts[1]), int(parts[2])).isoformat()
+    except ValueError:
+        return None
+
+
+class ArchiveCatalogue:
+    """
+     The catalogue of archived files kept in SQLite, one row per file of each day
+    """
+
+    def __init__(self, catalogue_file=CATALOGUE_FILE):
+        """
+        Construct a new ArchiveCatalogue object.
+
+        :param catalogue_file : The SQLite database file
+        """
+        self.catalogue_file = catalogue_file
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(catalogue_file, timeout=30, check_same_thread=False, isolation_level=None)
+        self.db.row_factory = sqlite3.Row
+        self.db.execute("PRAGMA journal_mode=WAL")
+        # the catalogue can be rebuilt from the archive, so losing the last write is acceptable
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        self.db.executescript(SCHEMA)
+
+    def _query(self, sql, parameters=()):
+        with self.lock:
+            return [dict(row) for row in self.db.execute(sql, parameters).fetchall()]
+
+    def _transaction(self, statements):
+        with self.lock:
+            self.db.execute("BEGIN IMMEDIATE")
+            try:
+                for sql, parameters in statements:
+                    self.db.execute(sql, parameters)
+                self.db.execute("COMMIT")
+            except BaseException:
+                self.db.execute("ROLLBACK")
+                raise
+
+    def record(self, day, name, size, mtime, content_hash, sha256=None, upload_status=None, import_id=None):
+        """
+        Add or replace the row of an archived file.  Without an upload status the
+        file takes the status of an earlier file with the same content, if any
+
+        :param day           : the day folder as YYYY-MM-DD
+        :param name          : the file name, e.g. therapy.pdat
+        :param size          : size in bytes
+        :param mtime         : modification time of the archived file
+        :param content_hash  : SleepHQ content hash of the file
+        :param sha256        : SHA-256 of the file, the name of its blob
+        :param upload_status : status from the upload ledger, None if not known
+        :param import_id     : import the file was uploaded with
+        """
+        self._transaction([(
+            "INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?, ?, ?, " +
+            "COALESCE(?, (SELECT upload_status FROM files WHERE content_hash = ? AND upload_status IS NOT NULL " +
+            "ORDER BY day DESC LIMIT 1)), " +
+            "COALESCE(?, (SELECT import_id FROM files WHERE content_hash = ? AND upload_status IS NOT NULL " +
+            "ORDER BY day DESC LIMIT 1)), ?)",
+            (day, name, size, mtime, content_hash, sha256, upload_status, content_hash,
+             import_id, content_hash, time.time()))])
+
+    def record_uploads(self, entries):
+        """
+        Copy upload statuses from the upload ledger
+
+        :param entries : the entries of an UploadLedger, content hash -> details
+
+        Return value: the number of rows changed
+        """
+        now = time.time()
+        with self.lock:
+            self.db.execute("BEGIN IMMEDIATE")
+            try:
+                changed = 0
+                for content_hash, entry in entries.items():
+                    import_id = str(entry['import_id']) if entry.get('import_id') is not None else None
+                    changed += self.db.execute(
+                        "UPDATE files SET upload_status = ?, import_id = ?, updated = ? " +
+                        "WHERE content_hash = ? AND (upload_status IS NOT ? OR import_id IS NOT ?)",
+                        (entry['status'], import_id, now, content_hash, entry['status'], import_id)).rowcount
+                self.db.execute("COMMIT")
+            except BaseException:
+                self.db.execute("ROLLBACK")
+                raise
+        return changed
+
+    def replace_all(self, rows):
+        """
+        Replace the whole catalogue in one transaction
+
+        :param rows : dictionaries with the arguments of record()
+        """
+        now = time.time()
+        self._transaction([("DELETE FROM files", ())] +
+                          [("INSERT INTO files VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                            (row['day'], row['name'], row['size'], row['mtime'], row['content_hash'],
+                             row.get('sha256'), row.get('upload_status'), row.get('import_id'), now))
+                           for row in rows])
+
+    def days(self, first_day=None, last_day=None):
+        """
+        Return value: the rows of the days in a range, oldest first
+        """
+        return self._query("SELECT * FROM files WHERE day >= ? AND day <= ? ORDER BY day, name",
+                           (first_day or "0000-00-00", last_day or "9999-99-99"))
+
+    def changes(self, name):
+        """
+        Return value: the rows of the days a file differs from the previous archived
+                      day, oldest first.  The first archived day counts as a change
+        """
+        return self._query("SELECT * FROM (SELECT *, LAG(content_hash) OVER (ORDER BY day) AS previous " +
+                           "FROM files WHERE name = ?) WHERE previous IS NULL OR previous != content_hash " +
+                           "ORDER BY day", (name,))
+
+    def not_uploaded(self):
+        """
+        Return value: the rows of the files SleepHQ has not imported, oldest first
+        """
+        return self._query("SELECT * FROM files WHERE upload_status IS NULL OR upload_status != 'complete' " +
+                           "ORDER BY day, name")
+
+    def find_hash(self, file_hash):
+        """
+        Return value: the rows of the files with a content hash or SHA-256, oldest first
+        """
+        return self._query("SELECT * FROM files WHERE content_hash = ? OR sha256 = ? ORDER BY day, name",
+                           (file_hash, file_hash))
+
+    def close(self):
+        with self.lock:
+            self.db.close()
+
+
+def record_uploads(ledger, catalogue_file=CATALOGUE_FILE):
+    """
+    Copy the upload statuses of the ledger into the catalogue, if there is one.
+    A catalogue that can't be updated is only logged, it can be rebuilt later
+
+    :param ledger         : UploadLedger object
+    :param catalogue_file : The SQLite database file
+    """
+    if not os.path.exists(catalogue_file):
+        return
+    try:
+        catalogue = ArchiveCatalogue(catalogue_file)
+        try:
+            catalogue.record_uploads(ledger.entries)
+        finally:
+            catalogue.close()
+    except sqlite3.Error as e:
+        logging.getLogger('prisma.catalogue').warning(f"Could not update {catalogue_file}: {e}")
+
+
+def hash_archived_file(archive_path, folder, name, sha256, is_ref):
+    """
+    Calculate the SleepHQ content hash of an archived file.  Runs in a worker process.
+    A compacted file is restored to a temporary folder first
+
+    Return value: the content hash
+    """
+    if not is_ref:
+        return calculate_content_hash(os.path.join(folder, name))
+    store = ArchiveStore(archive_path)
+    # the file name is part of the content hash, so the restored file keeps it
+    scratch = tempfile.mkdtemp(dir=os.path.join(store.blob_path, "tmp"))
+    try:
+        restored = os.path.join(scratch, name)
+        store.restore_blob(sha256, restored)
+        return calculate_content_hash(restored)
+    finally:
+        shutil.rmtree(scratch, ignore_errors=True)
+
+
+def rebuild(catalogue, archive_path=ARCHIVE_PATH, ledger=None, hash_cache=None, workers=None):
+    """
+    Recreate the catalogue from the files in the archive's day folders
+
+    :param catalogue    : ArchiveCatalogue object to fill
+    :param archive_path : the archive folder holding the YYYY/MM/DD folders
+    :param ledger       : UploadLedger object for the upload statuses, None for none
+    :param hash_cache   : HashCache object whose hashes are used for unchanged files, None to hash every file
+    :param workers      : number of processes hashing files, default the number of CPUs
+
+    Return value: the number of files catalogued and the number of files hashed
+    """
+    store = ArchiveStore(archive_path)
+    rows = []
+    # files with the same blob and name have the same content hash, so each is hashed once
+    pending = {}
+    for folder, name, sha256, is_ref in store.day_files():
+        day = folder_day(archive_path, folder)
+        if day is None:
+            continue
+        full_name = os.path.join(folder, name + (REF_SUFFIX if is_ref else ""))
+        file_stat = os.stat(full_name)
+        size = load_json_file(full_name, {}).get('size', 0) if is_ref else file_stat.st_size
+        row = {'day': day, 'name': name, 'size': size, 'mtime': file_stat.st_mtime, 'sha256': sha256}
+        rows.append(row)
+        key = (sha256, name) if sha256 is not None else (full_name, name)
+        if key not in pending:
+            content_hash = None
+            if hash_cache is not None and not is_ref:
+                content_hash = hash_cache.lookup(os.path.abspath(full_name), file_stat)
+            pending[key] = [content_hash, (archive_path, folder, name, sha256, is_ref), []]
+        pending[key][2].append(row)
+    to_hash = [entry for entry in pending.values() if entry[0] is None]
+    if to_hash:
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            futures = [(entry, executor.submit(hash_archived_file, *entry[1])) for entry in to_hash]
+            for entry, future in futures:
+                entry[0] = future.result()
+    for content_hash, _, hash_rows in pending.values():
+        status = ledger.entries.get(content_hash) if ledger is not None else None
+        for row in hash_rows:
+            row['content_hash'] = content_hash
+            if status is not None:
+                row['upload_status'] = status['status']
+                row['import_id'] = str(status['import_id']) if status.get('import_id') is not None else None
+    catalogue.replace_all(rows)
+    return len(rows), len(to_hash)
+
+
+def print_rows(rows):
+    for row in rows:
+        line = f"{row['day']} {row['name']:<14} {row['size']:12d} {row['content_hash']} " + \
+               f"{row['upload_status'] or 'not uploaded'}"
+        if row['import_id']:
+            line += f" (import {row['import_id']})"
+        print(line)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Query the catalogue of the Prisma archive")
+    parser.add_argument('--catalogue', default=CATALOGUE_FILE, help="catalogue database (default %(default)s)")
+    commands = parser.add_subparsers(dest='command', required=True)
+    rebuild_parser = commands.add_parser('rebuild', help="recreate the catalogue from the archive folder")
+    rebuild_parser.add_argument('--archive', default=ARCHIVE_PATH, help="archive folder (default %(default)s)")
+    rebuild_parser.add_argument('--ledger', default=LEDGER_FILE, help="upload ledger (default %(default)s)")
+    rebuild_parser.add_argument('--workers', type=int, help="hashing processes (default the number of CPUs)")
+    rebuild_parser.add_argument('--rehash', action='store_true', help="hash every file, ignore the hash cache")
+    days_parser = commands.add_parser('days', help="list the archived files of a range of days")
+    days_parser.add_argument('--from', dest='first_day', help="first day, YYYY-MM-DD")
+    days_parser.add_argument('--to', dest='last_day', help="last day, YYYY-MM-DD")
+    changes_parser = commands.add_parser('changes', help="list the days a file changed")
+    changes_parser.add_argument('name', nargs='?', default="therapy.pdat", help="file name (default %(default)s)")
+    changes_parser.add_argument('--last', action='store_true', help="only show the last change")
+    commands.add_parser('not-uploaded', help="list the files SleepHQ has not imported")
+    hash_parser = commands.add_parser('hash', help="list the days holding a file")
+    hash_parser.add_argument('file_hash', help="SleepHQ content hash or SHA-256")
+    args = parser.parse_args()
+
+    my_catalogue = ArchiveCatalogue(args.catalogue)
+    if args.command == 'rebuild':
+        my_start = time.monotonic()
+        my_hash_cache = None if args.rehash else HashCache('./prisma-hash-cache.json')
+        my_files, my_hashed = rebuild(my_catalogue, args.archive, UploadLedger(args.ledger), my_hash_cache,
+                                      args.workers)
+        print(f"Catalogued {my_files} files, hashed {my_hashed}, in {time.monotonic() - my_start:.1f}s")
+        sys.exit(0)
+    if args.command == 'days':
+        my_rows = my_catalogue.days(args.first_day, args.last_day)
+    elif args.command == 'changes':
+        my_rows = my_catalogue.changes(args.name)
+        if args.last:
+            my_rows = my_rows[-1:]
+    elif args.command == 'not-uploaded':
+        my_rows = my_catalogue.not_uploaded()
+    else:
+        my_rows = my_catalogue.find_hash(args.file_hash)
+    print_rows(my_rows)
+    if not my_rows:
+        print("No files found")
@@ -0,0 +1,392 @@
+""" Content addressed archive store
+
+transfer_data.py used to write a full copy of config.pcfg and therapy.pdat into
+archive/YYYY/MM/DD every day.  therapy.pdat is cumulative and config.pcfg rarely
+changes, so most of those bytes were duplicates.
+
+Each distinct file is now stored once as a blob under archive/.blobs, named by
+the SHA-256 of its contents, and the day folders hold hardlinks to the blobs.
+An unchanged config.pcfg costs no space at all, and neither does pressing the
+button twice on the same day.
+
+Optionally, older snapshots can be compacted: each one is stored as a delta
+against the newest snapshot of the same file.  The delta is the length of the
+prefix it shares with the newest snapshot plus the rest of it, compressed with
+lzma.  An older therapy.pdat is normally a prefix of the newest one, so its
+delta is empty.  The compression runs in a background process pool.  A
+compacted day holds a small <name>.ref file instead of the file and is restored
+byte for byte with the restore command.
+
+Usage:
+    python3 archive_store.py dedupe
+    python3 archive_store.py compact [--keep-days 14]
+    python3 archive_store.py restore 2025/01/14 [--to /tmp/restored]
+    python3 archive_store.py verify
+"""
+import argparse
+import hashlib
+import json
+import lzma
+import os
+import shutil
+import stat
+import sys
+from concurrent.futures import ProcessPoolExecutor
+
+from nas_sync import JOURNAL_FILE, record_changes
+from prisma_state import load_json_file, save_json_file
+
+ARCHIVE_PATH = "/home/USER/prisma/archive/"
+BLOB_FOLDER = ".blobs"
+REF_SUFFIX = ".ref"
+CHUNK_SIZE = 1024 * 1024
+
+
+def file_sha256(file_name):
+    """
+    Return the SHA-256 of a file
+    """
+    hasher = hashlib.sha256()
+    with open(file_name, 'rb') as f:
+        for chunk in iter(lambda: f.read(CHUNK_SIZE), b''):
+            hasher.update(chunk)
+    return hasher.hexdigest()
+
+
+def link_replace(source, destination):
+    """
+    Make destination a hardlink to source, replacing whatever was there
+    """
+    tmp_destination = destination + ".tmp"
+    if os.path.lexists(tmp_destination):
+        os.unlink(tmp_destination)
+    if os.path.lexists(destination) and os.path.samefile(source, destination):
+        # renaming a link over a link to the same file does nothing and would leave the .tmp behind
+        return
+    os.link(source, tmp_destination)
+    os.replace(tmp_destination, destination)
+
+
+def common_prefix_length(file_a, file_b):
+    """
+    Return the number of leading bytes two files have in common
+    """
+    length = 0
+    with open(file_a, 'rb') as fa, open(file_b, 'rb') as fb:
+        while True:
+            chunk_a = fa.read(CHUNK_SIZE)
+            chunk_b = fb.read(CHUNK_SIZE)
+            if chunk_a == chunk_b and chunk_a:
+                length += len(chunk_a)
+                continue
+            for byte_a, byte_b in zip(chunk_a, chunk_b):
+                if byte_a != byte_b:
+                    break
+                length += 1
+            return length
+
+
+def encode_delta(snapshot_file, base_file, delta_file):
+    """
+    Store snapshot_file as a delta against base_file.  Runs in a worker process.
+
+    Return value: the number of bytes shared with the base
+    """
+    prefix = common_prefix_length(snapshot_file, base_file)
+    tmp_delta = delta_file + ".tmp"
+    with open(snapshot_file, 'rb') as src, lzma.open(tmp_delta, 'wb', preset=6) as dst:
+        src.seek(prefix)
+        shutil.copyfileobj(src, dst, CHUNK_SIZE)
+    os.replace(tmp_delta, delta_file)
+    return prefix
+
+
+class ArchiveStore:
+    """
+     The blob store under the archive folder
+    """
+
+    def __init__(self, archive_path=ARCHIVE_PATH):
+        """
+        Construct a new ArchiveStore object.
+
+        :param archive_path : the archive folder holding the YYYY/MM/DD folders
+        """
+        self.archive_path = archive_path
+        self.blob_path = os.path.join(archive_path, BLOB_FOLDER)
+        self.index_file = os.path.join(self.blob_path, "index.json")
+        os.makedirs(os.path.join(self.blob_path, "tmp"), exist_ok=True)
+        # blobs stored as deltas: sha256 -> {'base': sha256, 'prefix': bytes, 'size': bytes}
+        self.index = load_json_file(self.index_file, {})
+        # files written, relative to the archive, for the NAS sync journal
+        self.changes = []
+
+    def relative(self, path):
+        return os.path.relpath(path, self.archive_path)
+
+    def blob_file(self, sha256):
+        return os.path.join(self.blob_path, sha256[:2], sha256)
+
+    def delta_file(self, sha256):
+        return os.path.join(self.blob_path, sha256[:2], sha256 + ".delta.xz")
+
+    def new_temp_file(self, name):
+        """
+        Return a temporary file name on the same file system as the blobs, for
+        writing a file that is then passed to add()
+        """
+        return os.path.join(self.blob_path, "tmp", f"{name}.{os.getpid()}")
+
+    def add(self, tmp_file, sha256):
+        """
+        Move a fully written file into the store.  If the same content is already
+        stored the temporary file is simply removed.
+
+        :param tmp_file : the file to add, from new_temp_file()
+        :param sha256   : the SHA-256 of its contents
+
+        Return value: the path of the blob
+        """
+        blob = self.blob_file(sha256)
+        if os.path.exists(blob):
+            os.unlink(tmp_file)
+            return blob
+        if sha256 in self.index:
+            # stored as a delta, it is a full blob again now it is the newest snapshot
+            del self.index[sha256]
+            save_json_file(self.index_file, self.index)
+            self.changes.append(self.relative(self.index_file))
+            if os.path.exists(self.delta_file(sha256)):
+                os.unlink(self.delta_file(sha256))
+        os.makedirs(os.path.dirname(blob), exist_ok=True)
+        # blobs are shared by many day folders, protect them from edits via the samba share
+        os.chmod(tmp_file, stat.S_IRUSR | stat.S_IRGRP | stat.S_IROTH)
+        os.replace(tmp_file, blob)
+        self.changes.append(self.relative(blob))
+        return blob
+
+    def link(self, blob, destination):
+        """
+        Place a stored blob at destination, e.g. a day folder, as a hardlink
+        """
+        ref_file = destination + REF_SUFFIX
+        link_replace(blob, destination)
+        self.changes.append((self.relative(destination), self.relative(blob)))
+        if os.path.exists(ref_file):
+            os.unlink(ref_file)
+
+    def adopt(self, file_name):
+        """
+        Move an existing archived file, e.g. from before the blob store was used,
+        into the store and replace it with a hardlink to its blob
+
+        Return value: True if the file was a duplicate of a stored blob
+        """
+        sha256 = file_sha256(file_name)
+        blob = self.blob_file(sha256)
+        duplicate = os.path.exists(blob)
+        if not duplicate:
+            tmp_file = self.new_temp_file(os.path.basename(file_name))
+            if os.path.lexists(tmp_file):
+                os.unlink(tmp_file)
+            os.link(file_name, tmp_file)
+            self.add(tmp_file, sha256)
+        self.link(blob, file_name)
+        return duplicate
+
+    def day_files(self):
+        """
+        Generate (day folder, file name, sha256 or None, is a .ref stub) for every
+        archived file, oldest day first.  For hardlinked files the SHA-256 is
+        found from the blob inode
+        """
+        blob_inodes = {}
+        for entry in os.scandir(self.blob_path):
+            if entry.is_dir() and len(entry.name) == 2:
+                for blob in os.scandir(entry.path):
+                    if blob.is_file() and len(blob.name) == 64:
+                        blob_inodes[blob.inode()] = blob.name
+        for dirpath, dirnames, filenames in os.walk(self.archive_path):
+            dirnames[:] = sorted(d for d in dirnames if d != BLOB_FOLDER)
+            for f in sorted(filenames):
+                full_name = os.path.join(dirpath, f)
+                if f.endswith(REF_SUFFIX):
+                    ref = load_json_file(full_name, {})
+                    yield dirpath, f[:-len(REF_SUFFIX)], ref.get('sha256'), True
+                elif not f.endswith(".tmp"):
+                    yield dirpath, f, blob_inodes.get(os.stat(full_name).st_ino), False
+
+    def restore_blob(self, sha256, destination):
+        """
+        Write the contents of a stored blob to destination as a normal file
+        """
+        blob = self.blob_file(sha256)
+        tmp_destination = destination + ".tmp"
+        if os.path.exists(blob):
+            shutil.copyfile(blob, tmp_destination)
+        else:
+            delta = self.index[sha256]
+            with open(tmp_destination, 'wb') as dst:
+                with open(self.blob_file(delta['base']), 'rb') as base:
+                    remaining = delta['prefix']
+                    while remaining > 0:
+                        chunk = base.read(min(CHUNK_SIZE, remaining))
+                        if not chunk:
+                            raise OSError(f"base blob of {sha256} is shorter than expected")
+                        dst.write(chunk)
+                        remaining -= len(chunk)
+                with lzma.open(self.delta_file(sha256), 'rb') as suffix:
+                    shutil.copyfileobj(suffix, dst, CHUNK_SIZE)
+        if file_sha256(tmp_destination) != sha256:
+            os.unlink(tmp_destination)
+            raise OSError(f"restored {destination} does not match {sha256}")
+        os.replace(tmp_destination, destination)
+
+    def compact(self, keep_days=14, workers=2):
+        """
+        Store snapshots older than the newest keep_days days as deltas against the
+        newest snapshot of the same file
+
+        :param keep_days : number of most recent day folders left as plain hardlinks
+        :param workers   : number of processes compressing deltas
+
+        Return value: the number of snapshots compacted
+        """
+        files = list(self.day_files())
+        days = sorted({dirpath for dirpath, name, sha256, is_ref in files})
+        recent_days = set(days[-keep_days:]) if keep_days > 0 else set()
+        newest = {}
+        for dirpath, name, sha256, is_ref in files:
+            if sha256 is not None and not is_ref:
+                newest[name] = sha256
+        # current deltas are re-encoded against the newest base so chains never form
+        stale = {}
+        for dirpath, name, sha256, is_ref in files:
+            if sha256 is None or name not in newest or sha256 == newest[name]:
+                continue
+            if dirpath in recent_days and not is_ref:
+                continue
+            if is_ref and self.index.get(sha256, {}).get('base') == newest[name]:
+                continue
+            stale.setdefault(sha256, (name, []))[1].append(dirpath)
+        if not stale:
+            return 0
+        # deltas that need rebasing are restored to a temporary file first
+        sources = {}
+        for sha256 in stale:
+            if os.path.exists(self.blob_file(sha256)):
+                sources[sha256] = self.blob_file(sha256)
+            else:
+                sources[sha256] = self.new_temp_file(sha256)
+                self.restore_blob(sha256, sources[sha256])
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            futures = {sha256: executor.submit(encode_delta, sources[sha256],
+                                               self.blob_file(newest[name]), self.delta_file(sha256) + ".new")
+                       for sha256, (name, day_paths) in stale.items()}
+            for sha256, future in futures.items():
+                prefix = future.result()
+                name, day_paths = stale[sha256]
+                size = os.stat(sources[sha256]).st_size
+                os.replace(self.delta_file(sha256) + ".new", self.delta_file(sha256))
+                self.index[sha256] = {'base': newest[name], 'prefix': prefix, 'size': size}
+                save_json_file(self.index_file, self.index)
+                self.changes.extend([self.relative(self.delta_file(sha256)), self.relative(self.index_file)])
+                # replace the day folder hardlinks with references
+                for dirpath in day_paths:
+                    ref_file = os.path.join(dirpath, name + REF_SUFFIX)
+                    save_json_file(ref_file, {'sha256': sha256, 'size': size})
+                    self.changes.append(self.relative(ref_file))
+                    if os.path.exists(os.path.join(dirpath, name)):
+                        os.unlink(os.path.join(dirpath, name))
+                if sources[sha256] != self.blob_file(sha256):
+                    os.unlink(sources[sha256])
+                elif os.stat(sources[sha256]).st_nlink == 1:
+                    # nothing links to the full blob any more
+                    os.unlink(sources[sha256])
+        return len(stale)
+
+    def restore_day(self, day, target=None):
+        """
+        Write every file of a day folder as normal files
+
+        :param day    : the day folder relative to the archive, e.g. 2025/01/14
+        :param target : folder to write to, defaults to the day folder itself
+
+        Return value: list of restored file names
+        """
+        day_path = os.path.join(self.archive_path, day)
+        target = target or day_path
+        os.makedirs(target, exist_ok=True)
+        restored = []
+        for f in sorted(os.listdir(day_path)):
+            full_name = os.path.join(day_path, f)
+            if f.endswith(REF_SUFFIX):
+                name = f[:-len(REF_SUFFIX)]
+                self.restore_blob(load_json_file(full_name, {})['sha256'], os.path.join(target, name))
+                if target == day_path:
+                    os.unlink(full_name)
+                    self.changes.append(self.relative(os.path.join(target, name)))
+                restored.append(name)
+            elif target != day_path and not f.endswith(".tmp"):
+                shutil.copyfile(full_name, os.path.join(target, f))
+                restored.append(f)
+        return restored
+
+    def verify(self):
+        """
+        Check every archived file can be restored with the right contents
+
+        Return value: list of problems found
+        """
+        problems = []
+        for dirpath, name, sha256, is_ref in self.day_files():
+            if sha256 is None:
+                continue
+            if is_ref:
+                scratch = self.new_temp_file(sha256)
+                try:
+                    self.restore_blob(sha256, scratch)
+                    os.unlink(scratch)
+                except (OSError, KeyError) as e:
+                    problems.append(f"{os.path.join(dirpath, name)}: {e}")
+            elif file_sha256(self.blob_file(sha256)) != sha256:
+                problems.append(f"{os.path.join(dirpath, name)}: blob {sha256} is corrupt")
+        return problems
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Manage the deduplicated Prisma archive")
+    parser.add_argument('--archive', default=ARCHIVE_PATH, help="archive folder (default %(default)s)")
+    parser.add_argument('--journal', default=JOURNAL_FILE, help="NAS sync journal (default %(default)s)")
+    commands = parser.add_subparsers(dest='command', required=True)
+    commands.add_parser('dedupe', help="move day folders written before the blob store into it")
+    compact_parser = commands.add_parser('compact', help="store older snapshots as compressed deltas")
+    compact_parser.add_argument('--keep-days', type=int, default=14,
+                                help="most recent days left as plain files (default %(default)s)")
+    compact_parser.add_argument('--workers', type=int, default=2, help="compression processes")
+    restore_parser = commands.add_parser('restore', help="restore the files of a day")
+    restore_parser.add_argument('day', help="day folder such as 2025/01/14")
+    restore_parser.add_argument('--to', help="folder to restore to, default is the day folder itself")
+    commands.add_parser('verify', help="check every archived file can be restored")
+    args = parser.parse_args()
+
+    store = ArchiveStore(args.archive)
+    if args.command == 'dedupe':
+        duplicates = 0
+        for dirpath, name, sha256, is_ref in list(store.day_files()):
+            if sha256 is None and not is_ref:
+                duplicates += store.adopt(os.path.join(dirpath, name))
+        print(f"Found {duplicates} duplicate files")
+    elif args.command == 'compact':
+        print(f"Compacted {store.compact(args.keep_days, args.workers)} snapshots")
+    elif args.command == 'restore':
+        for restored_file in store.restore_day(args.day, args.to):
+            print(f"Restored {restored_file}")
+    else:
+        problems = store.verify()
+        for problem in problems:
+            print(problem)
+        print("Archive OK" if not problems else f"{len(problems)} problems found")
+        sys.exit(1 if problems else 0)
+    if store.changes:
+        record_changes(store.changes, args.journal)
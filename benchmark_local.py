@@ -0,0 +1,295 @@
+""" Local hot path benchmark
+
+Measures the parts of a run that only use the Pi's CPU and storage, with no
+network involved:
+
+    calculate_md5        : SleepHQ content hash of each card file
+    collect_files        : Step 1 of the uploader without a hash cache, i.e. listing
+                           the folder, hashing every file and creating FileDetails
+    collect_files_cached : Step 1 with a warm hash cache, as in a run with nothing new
+    copy_once            : transfer_data.py copying a card file into the archive
+
+Each stage is run on synthetic config.pcfg and therapy.pdat files of each size
+and content.  The content is "ascii" (nothing to expand), "random" (about half of
+the bytes expand to two in UTF-8) or "high" (every byte expands).  For every
+stage the best time of --repeat runs, the throughput, the peak memory allocated
+by python (tracemalloc, measured in a separate run) and the read and write
+system calls from /proc/self/io are reported.
+
+With --baseline the results are compared with a JSON file of earlier results and
+the script exits with status 1 if any stage got slower, used more memory or made
+more system calls than the baseline allows for with --tolerance.  The baseline is
+written by the first run, or by --update-baseline.  Baselines are only
+comparable on the same hardware, so keep one per device.  The files are written
+to --work-dir, by default a temporary folder, and are usually read back from the
+page cache, so the times are of the CPU work rather than of the SD card.
+
+Usage:
+    python3 benchmark_local.py --sizes 64K 8M 256M --baseline benchmark-baseline.json
+"""
+import argparse
+import json
+import os
+import platform
+import shutil
+import sys
+import tempfile
+import time
+import tracemalloc
+
+from benchmark_upload import CONTENT_TABLES, write_synthetic_file
+from prisma20a_sleephq_uploader import calculate_md5, collect_files
+from prisma_state import list_files
+from sleephq_hash import HashCache
+from transfer_data import copy_once
+
+# Size of the synthetic config.pcfg, the real one is a few kilobytes
+CONFIG_SIZE = 4096
+# A run shorter than this is repeated and averaged, so short stages can be timed
+MIN_RUN_SECONDS = 0.05
+# Counters of /proc/self/io that are compared with the baseline
+IO_COUNTERS = ("syscr", "syscw")
+# Time regressions smaller than this are timer noise
+MIN_TIME_REGRESSION = 0.001
+
+
+def parse_size(text):
+    """
+    Return value: the number of bytes in a size such as 4096, 64K, 8M or 1G
+    """
+    multipliers = {'K': 1024, 'M': 1024 ** 2, 'G': 1024 ** 3}
+    suffix = text[-1:].upper()
+    if suffix in multipliers:
+        return int(float(text[:-1]) * multipliers[suffix])
+    return int(text)
+
+
+def format_size(size):
+    for suffix, multiplier in (('G', 1024 ** 3), ('M', 1024 ** 2), ('K', 1024)):
+        if size >= multiplier and size % multiplier == 0:
+            return f"{size // multiplier}{suffix}"
+    return str(size)
+
+
+def read_io_counters():
+    """
+    Return value: the counters of /proc/self/io, or None where it is not available
+    """
+    try:
+        with open('/proc/self/io') as f:
+            return {name: int(value) for name, value in (line.split(':') for line in f)}
+    except OSError:
+        return None
+
+
+class Stage:
+    """
+     One stage of the benchmark run against a folder of synthetic card files
+    """
+
+    def __init__(self, name, func, prepare=None):
+        """
+        Construct a new Stage object.
+
+        :param name    : name of the stage in the results
+        :param func    : func(data_dir, work_dir, prepared) runs the stage once
+        :param prepare : prepare(data_dir, work_dir) is run before the stage is timed and
+                         its result passed to func, None if there is nothing to prepare
+        """
+        self.name = name
+        self.func = func
+        self.prepare = prepare
+
+    def run(self, data_dir, work_dir, repeat):
+        """
+        Time, trace and count the system calls of the stage
+
+        Return value: a dictionary of measurements for one run of the stage
+        """
+        prepared = self.prepare(data_dir, work_dir) if self.prepare is not None else None
+        # the system calls of one run, before any time is spent on repeats
+        before = read_io_counters()
+        self.func(data_dir, work_dir, prepared)
+        after = read_io_counters()
+        best = None
+        for _ in range(repeat):
+            runs = 0
+            start = time.perf_counter()
+            while True:
+                self.func(data_dir, work_dir, prepared)
+                runs += 1
+                elapsed = time.perf_counter() - start
+                if elapsed >= MIN_RUN_SECONDS:
+                    break
+            best = elapsed / runs if best is None else min(best, elapsed / runs)
+        tracemalloc.start()
+        self.func(data_dir, work_dir, prepared)
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+        result = {'seconds': best, 'peak_bytes': peak}
+        if before is not None and after is not None:
+            for counter in IO_COUNTERS:
+                result[counter] = after[counter] - before[counter]
+        return result
+
+
+def hash_each_file(data_dir, work_dir, prepared):
+    for _, fullname in list_files(data_dir):
+        calculate_md5(fullname)
+
+
+def collect_cold(data_dir, work_dir, prepared):
+    collect_files(data_dir)
+
+
+def warm_hash_cache(data_dir, work_dir):
+    hash_cache = HashCache(os.path.join(work_dir, 'prisma-hash-cache.json'))
+    collect_files(data_dir, hash_cache)
+    return hash_cache
+
+
+def collect_cached(data_dir, work_dir, hash_cache):
+    collect_files(data_dir, hash_cache)
+
+
+def copy_to_archive(data_dir, work_dir, prepared):
+    archive_dir = os.path.join(work_dir, 'archive')
+    os.makedirs(archive_dir, exist_ok=True)
+    for short_name, fullname in list_files(data_dir):
+        copy_once(fullname, os.path.join(archive_dir, short_name), short_name)
+
+
+STAGES = [Stage("calculate_md5", hash_each_file),
+          Stage("collect_files", collect_cold),
+          Stage("collect_files_cached", collect_cached, warm_hash_cache),
+          Stage("copy_once", copy_to_archive)]
+
+
+def run_benchmarks(work_dir, sizes, contents, stage_names, repeat):
+    """
+    Run the stages on synthetic card files of each size and content
+
+    :param work_dir    : folder for the synthetic files, emptied as it goes
+    :param sizes       : sizes of therapy.pdat in bytes
+    :param contents    : content kinds, see CONTENT_TABLES in benchmark_upload.py
+    :param stage_names : names of the stages to run
+    :param repeat      : number of timed runs, the best is kept
+
+    Return value: a dictionary of "stage/content/size" to its measurements
+    """
+    results = {}
+    for content in contents:
+        for size in sizes:
+            case_dir = os.path.join(work_dir, f"{content}-{format_size(size)}")
+            data_dir = os.path.join(case_dir, 'data')
+            os.makedirs(data_dir)
+            write_synthetic_file(os.path.join(data_dir, 'config.pcfg'), CONFIG_SIZE, content=content)
+            write_synthetic_file(os.path.join(data_dir, 'therapy.pdat'), size, content=content)
+            total_bytes = CONFIG_SIZE + size
+            for stage in STAGES:
+                if stage.name not in stage_names:
+                    continue
+                result = stage.run(data_dir, case_dir, repeat)
+                result['bytes'] = total_bytes
+                result['mb_per_s'] = total_bytes / result['seconds'] / 1e6
+                key = f"{stage.name}/{content}/{format_size(size)}"
+                results[key] = result
+                print_result(key, result)
+            shutil.rmtree(case_dir)
+    return results
+
+
+def print_result(key, result):
+    calls = " ".join(f"{counter} {result[counter]:6d}" for counter in IO_COUNTERS if counter in result)
+    print(f"{key:<36} {result['seconds'] * 1000:10.2f}ms {result['mb_per_s']:9.1f}MB/s " +
+          f"peak {result['peak_bytes'] / 1024:9.0f}KiB {calls}")
+
+
+def compare(results, baseline, tolerance):
+    """
+    Compare results with a baseline
+
+    :param results   : measurements from run_benchmarks
+    :param baseline  : measurements from an earlier run_benchmarks
+    :param tolerance : fraction each measurement may grow by, e.g. 0.1 for 10%
+
+    Return value: a list of messages, one per regression
+    """
+    regressions = []
+    for key, result in results.items():
+        previous = baseline.get(key)
+        if previous is None:
+            continue
+        for measurement in ('seconds', 'peak_bytes') + IO_COUNTERS:
+            if measurement not in result or measurement not in previous:
+                continue
+            limit = previous[measurement] * (1 + tolerance)
+            if measurement == 'seconds':
+                limit = max(limit, previous[measurement] + MIN_TIME_REGRESSION)
+            if result[measurement] <= limit:
+                continue
+            if previous[measurement]:
+                growth = f"by {(result[measurement] / previous[measurement] - 1) * 100:.0f}%"
+            else:
+                growth = "from 0"
+            regressions.append(f"{key}: {measurement} {result[measurement]:.6g} is over the baseline " +
+                               f"{previous[measurement]:.6g} {growth}")
+    return regressions
+
+
+def environment():
+    """
+    Return value: a description of where the benchmark runs, stored with a baseline
+    """
+    return {'machine': platform.machine(), 'python': platform.python_version(),
+            'system': platform.platform()}
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Benchmark hashing, Step 1 and the archive copy locally")
+    parser.add_argument('--sizes', nargs='+', default=['64K', '8M', '64M'],
+                        help="sizes of therapy.pdat, e.g. 64K 8M 256M (default %(default)s)")
+    parser.add_argument('--content', nargs='+', default=list(CONTENT_TABLES), choices=list(CONTENT_TABLES),
+                        help="content of the synthetic files (default all)")
+    parser.add_argument('--stages', nargs='+', default=[stage.name for stage in STAGES],
+                        choices=[stage.name for stage in STAGES], help="stages to run (default all)")
+    parser.add_argument('--repeat', type=int, default=3, help="timed runs per stage, the best is kept")
+    parser.add_argument('--work-dir', help="folder for the synthetic files (default a temporary folder)")
+    parser.add_argument('--baseline', help="JSON file to compare with, written if it does not exist")
+    parser.add_argument('--update-baseline', action='store_true', help="replace the baseline with this run")
+    parser.add_argument('--tolerance', type=float, default=0.15,
+                        help="fraction a measurement may exceed the baseline by (default %(default)s)")
+    parser.add_argument('--json', help="also write the results to this file")
+    args = parser.parse_args()
+
+    work_dir = tempfile.mkdtemp(prefix="prisma-bench-", dir=args.work_dir)
+    try:
+        results = run_benchmarks(work_dir, [parse_size(size) for size in args.sizes], args.content,
+                                 args.stages, args.repeat)
+    finally:
+        shutil.rmtree(work_dir)
+    run = {'environment': environment(), 'results': results}
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(run, f, indent=1)
+    if not args.baseline:
+        sys.exit(0)
+    if args.update_baseline or not os.path.exists(args.baseline):
+        with open(args.baseline, 'w') as f:
+            json.dump(run, f, indent=1)
+        print(f"Baseline written to {args.baseline}")
+        sys.exit(0)
+
+    with open(args.baseline) as f:
+        baseline = json.load(f)
+    if baseline.get('environment') != run['environment']:
+        print(f"Warning: the baseline was taken on {baseline.get('environment')}")
+    missing = [key for key in results if key not in baseline['results']]
+    if missing:
+        print(f"Not in the baseline: {', '.join(missing)}")
+    regressions = compare(results, baseline['results'], args.tolerance)
+    for message in regressions:
+        print(f"FAIL: {message}")
+    if not regressions:
+        print(f"No stage regressed by more than {args.tolerance * 100:.0f}% from {args.baseline}")
+    sys.exit(1 if regressions else 0)
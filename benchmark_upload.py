@@ -0,0 +1,160 @@
+""" End to end upload benchmark
+
+Drives the real uploader pipeline (run_pipeline in prisma20a_sleephq_uploader.py)
+against the local SleepHQ stand-in (sleephq_standin.py) so performance changes can
+be measured offline.  Three nightly scenarios are run one after another:
+
+    cold   : no hash cache, ledger or cached token, everything is new
+    no-op  : nothing changed since the cold run, e.g. the button pressed twice
+    append : therapy.pdat has grown by one night of data
+
+For each scenario the wall time, the time of each step, the number of requests
+per endpoint and the bytes sent are reported.
+
+Usage:
+    python3 benchmark_upload.py --therapy-size 20000000 --latency 0.05 --json results.json
+"""
+import argparse
+import contextlib
+import io
+import json
+import logging
+import os
+import shutil
+import tempfile
+import time
+
+import prisma20a_sleephq_uploader as uploader
+from prisma_state import UploadLedger, CredentialCache
+from sleephq_client import set_base_url
+from sleephq_hash import HashCache
+from sleephq_standin import StandinOptions, start_standin
+
+
+# Byte translations of random data: "random" keeps it, so roughly half of the bytes
+# need the UTF-8 expansion, "ascii" needs none and "high" expands every byte
+CONTENT_TABLES = {"random": None,
+                  "ascii": bytes(b & 0x7F for b in range(256)),
+                  "high": bytes(b | 0x80 for b in range(256))}
+
+
+def write_synthetic_file(file_name, size, append=False, content="random"):
+    """
+    Write random data in place of a config.pcfg or therapy.pdat file
+
+    :param file_name : The file to write
+    :param size      : Number of bytes to write
+    :param append    : Add to the end of the file instead of replacing it
+    :param content   : "random", "ascii" or "high", see CONTENT_TABLES
+    """
+    table = CONTENT_TABLES[content]
+    with open(file_name, 'ab' if append else 'wb') as f:
+        remaining = size
+        while remaining > 0:
+            block = os.urandom(min(remaining, 1024 * 1024))
+            if table is not None:
+                block = block.translate(table)
+            f.write(block)
+            remaining -= len(block)
+
+
+def endpoint_delta(before, after):
+    """
+    Return the requests and bytes received per endpoint between two stand-in snapshots
+    """
+    delta = {}
+    for endpoint, counts in after['endpoints'].items():
+        previous = before['endpoints'].get(endpoint, {'requests': 0, 'bytes_received': 0})
+        requests_made = counts['requests'] - previous['requests']
+        if requests_made:
+            delta[endpoint] = {'requests': requests_made,
+                               'bytes_sent': counts['bytes_received'] - previous['bytes_received']}
+    return delta
+
+
+def run_scenario(name, work_dir, data_dir, serial, my_ntfy, state, verbose, stream_hash):
+    """
+    Run the uploader once the way the __main__ block does and measure it
+
+    Return value: a dictionary with the measurements of the run
+    """
+    hash_cache = HashCache(os.path.join(work_dir, 'prisma-hash-cache.json'))
+    ledger = UploadLedger(os.path.join(work_dir, 'prisma-upload-ledger.json'))
+    cred_cache = CredentialCache(os.path.join(work_dir, 'prisma-token-cache.json'))
+    stage_times = {}
+    before = state.snapshot()
+    output = io.StringIO()
+    status = None
+    start = time.monotonic()
+    with contextlib.redirect_stdout(None if verbose else output):
+        try:
+            if uploader.all_files_imported(data_dir, hash_cache, ledger):
+                status = "nothing new"
+            else:
+                status = uploader.run_pipeline("standin-client", "standin-secret", "1", serial, data_dir,
+                                               my_ntfy, hash_cache, ledger, cred_cache,
+                                               defer_hash=stream_hash, stage_times=stage_times)
+        except SystemExit:
+            status = "failed"
+    wall_time = time.monotonic() - start
+    return {'scenario': name,
+            'status': status or "nothing new",
+            'wall_time': round(wall_time, 3),
+            'steps': {stage: round(seconds, 3) for stage, seconds in sorted(stage_times.items())},
+            'requests': endpoint_delta(before, state.snapshot())}
+
+
+def print_result(result):
+    print(f"{result['scenario']}: {result['status']} in {result['wall_time']:.3f}s")
+    for stage, seconds in result['steps'].items():
+        print(f"\t{stage:<24} {seconds:8.3f}s")
+    total_requests = sum(counts['requests'] for counts in result['requests'].values())
+    total_bytes = sum(counts['bytes_sent'] for counts in result['requests'].values())
+    for endpoint, counts in sorted(result['requests'].items()):
+        print(f"\t{endpoint:<24} {counts['requests']:4d} requests {counts['bytes_sent']:12d} bytes")
+    print(f"\t{'total':<24} {total_requests:4d} requests {total_bytes:12d} bytes")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Benchmark the uploader against a local SleepHQ stand-in")
+    parser.add_argument('--config-size', type=int, default=4096, help="bytes in config.pcfg")
+    parser.add_argument('--therapy-size', type=int, default=8 * 1024 * 1024, help="bytes in therapy.pdat")
+    parser.add_argument('--append-size', type=int, default=64 * 1024, help="bytes added for the append run")
+    parser.add_argument('--latency', type=float, default=0.05, help="seconds added to every response")
+    parser.add_argument('--rate-limit-every', type=int, default=0, help="answer every Nth upload with HTTP 429")
+    parser.add_argument('--error-rate', type=float, default=0.0, help="fraction of requests answered with HTTP 500")
+    parser.add_argument('--processing-time', type=float, default=1.0, help="seconds an import takes to process")
+    parser.add_argument('--stream-hash', action='store_true', help="run the uploader with --stream-hash")
+    parser.add_argument('--verbose', action='store_true', help="show the uploader output")
+    parser.add_argument('--json', help="also write the results to this file")
+    args = parser.parse_args()
+
+    options = StandinOptions(latency=args.latency, rate_limit_every=args.rate_limit_every,
+                             error_rate=args.error_rate, processing_time=args.processing_time)
+    standin = start_standin(options)
+    set_base_url(f"http://127.0.0.1:{standin.server_port}")
+    work_dir = tempfile.mkdtemp(prefix="prisma-bench-")
+    try:
+        data_dir = os.path.join(work_dir, 'data')
+        os.mkdir(data_dir)
+        write_synthetic_file(os.path.join(data_dir, 'config.pcfg'), args.config_size)
+        write_synthetic_file(os.path.join(data_dir, 'therapy.pdat'), args.therapy_size)
+        logger = logging.getLogger('benchmark')
+        logger.addHandler(logging.FileHandler(os.path.join(work_dir, 'prisma-api.log')))
+        logger.setLevel(logging.INFO)
+        my_ntfy = uploader.NTFY("NO", None, None, logger)
+
+        results = []
+        for scenario in ("cold", "no-op", "append"):
+            if scenario == "append":
+                write_synthetic_file(os.path.join(data_dir, 'therapy.pdat'), args.append_size, append=True)
+            result = run_scenario(scenario, work_dir, data_dir, options.serial, my_ntfy,
+                                  standin.state, args.verbose, args.stream_hash)
+            print_result(result)
+            results.append(result)
+        if args.json:
+            with open(args.json, 'w') as f:
+                json.dump(results, f, indent=1)
+    finally:
+        standin.shutdown()
+        shutil.rmtree(work_dir)
@@ -0,0 +1,85 @@
+""" Startup budget check for prisma_quick.py
+
+Runs the nothing new path of prisma_quick.py (with --check, so nothing is ever
+uploaded) under python -X importtime and fails if its imports take longer than
+the budget, or if it loads the HTTP stack.  Interpreter start up is measured
+separately with an empty script and left out of the budget.  Run it after
+changing the imports of any module prisma_quick.py uses, on the device itself
+as the budget depends on the hardware, e.g.
+
+    cd /home/USER/prisma/scripts
+    ../mypython/bin/python3 check_startup.py --budget-ms 150
+
+Exit status: 0 within budget, 1 over budget or a forbidden module was imported
+"""
+import argparse
+import os
+import statistics
+import subprocess
+import sys
+import time
+
+# Milliseconds the imports of the nothing new path may take, measured on a Pi Zero 2W
+STARTUP_BUDGET_MS = 150
+# Modules the nothing new path must not import
+FORBIDDEN_MODULES = ("requests", "urllib3", "dotenv", "sleephq_client", "prisma_notify",
+                     "prisma20a_sleephq_uploader")
+
+
+def import_times(command, cwd=None):
+    """
+    Run a python command under -X importtime
+
+    :param command : arguments after "python3 -X importtime"
+    :param cwd     : folder to run it in
+
+    Return value: (total import microseconds, dictionary of module name to
+                  (self, cumulative) microseconds, wall clock seconds)
+    """
+    start = time.monotonic()
+    result = subprocess.run([sys.executable, '-X', 'importtime'] + command, cwd=cwd,
+                            stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, text=True)
+    seconds = time.monotonic() - start
+    total = 0
+    modules = {}
+    for line in result.stderr.splitlines():
+        if not line.startswith("import time:") or "self [us]" in line:
+            continue
+        self_us, cumulative_us, name = line[len("import time:"):].split('|', 2)
+        modules[name.strip()] = (int(self_us), int(cumulative_us))
+        # top level imports are not indented, their cumulative times add up to the total
+        if not name[1:].startswith(' '):
+            total += int(cumulative_us)
+    return total, modules, seconds
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Check the start up time of prisma_quick.py")
+    parser.add_argument('--budget-ms', type=float, default=STARTUP_BUDGET_MS,
+                        help="milliseconds the imports may take (default %(default)s)")
+    parser.add_argument('--runs', type=int, default=5, help="runs to take the median of (default %(default)s)")
+    args = parser.parse_args()
+
+    my_folder = os.path.dirname(os.path.abspath(__file__))
+    my_script = os.path.join(my_folder, 'prisma_quick.py')
+    my_baseline = []
+    my_totals = []
+    my_wall = []
+    for _ in range(args.runs):
+        my_baseline.append(import_times(['-c', 'pass'])[0])
+        my_total, my_modules, my_seconds = import_times([my_script, '--check'], cwd=os.getcwd())
+        my_totals.append(my_total)
+        my_wall.append(my_seconds)
+    my_import_ms = (statistics.median(my_totals) - statistics.median(my_baseline)) / 1000
+    print(f"Interpreter start up imports: {statistics.median(my_baseline) / 1000:.1f}ms")
+    print(f"prisma_quick.py imports:      {my_import_ms:.1f}ms (budget {args.budget_ms:.0f}ms)")
+    print(f"prisma_quick.py --check run:  {statistics.median(my_wall) * 1000:.1f}ms wall clock")
+    print("Slowest modules of the last run (cumulative ms):")
+    for my_name, (my_self, my_cumulative) in sorted(my_modules.items(), key=lambda item: -item[1][1])[:10]:
+        print(f"\t{my_cumulative / 1000:7.1f} {my_name}")
+    my_forbidden = [name for name in FORBIDDEN_MODULES if name in my_modules]
+    if my_forbidden:
+        print(f"FAIL: the nothing new path imports {', '.join(my_forbidden)}")
+    if my_import_ms > args.budget_ms:
+        print(f"FAIL: imports take {my_import_ms:.1f}ms, over the {args.budget_ms:.0f}ms budget")
+    sys.exit(1 if my_forbidden or my_import_ms > args.budget_ms else 0)
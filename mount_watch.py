@@ -0,0 +1,51 @@
+""" Mount table events
+
+The kernel flags /proc/self/mounts with POLLPRI whenever something is mounted
+or unmounted, so a process can sleep until the Weinmann card appears instead of
+checking on a timer.  Used by prisma_daemon.py and usb_connect.py.
+"""
+import select
+
+MOUNTS_FILE = "/proc/self/mounts"
+
+
+def mount_points(mounts_file=MOUNTS_FILE):
+    """
+    Return value: the set of mounted paths
+    """
+    points = set()
+    with open(mounts_file) as f:
+        for line in f:
+            fields = line.split()
+            if len(fields) > 1:
+                # spaces and other special characters are octal escaped, e.g. \\040
+                points.add(fields[1].encode('latin-1').decode('unicode_escape'))
+    return points
+
+
+class MountWatcher:
+    """
+     Waits for the kernel to report a change to the mount table
+    """
+
+    def __init__(self, mounts_file=MOUNTS_FILE):
+        """
+        Construct a new MountWatcher object.
+
+        :param mounts_file : the mount table, the kernel flags it with POLLPRI when it changes
+        """
+        self.file = open(mounts_file)
+        self.file.read()
+        self.poller = select.poll()
+        self.poller.register(self.file, select.POLLPRI | select.POLLERR)
+
+    def wait(self, timeout=None):
+        """
+        Block until the mount table changes or timeout seconds have passed
+
+        Return value: True if the mount table changed
+        """
+        events = self.poller.poll(None if timeout is None else timeout * 1000)
+        self.file.seek(0)
+        self.file.read()
+        return bool(events)
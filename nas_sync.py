@@ -0,0 +1,247 @@
+""" Incremental archive sync to the NAS
+
+nas_sync.sh used to run rsync over the whole archive on every connect, which
+stats every file ever archived over NFS.  transfer_data.py and archive_store.py
+now append every archive file they write to a local journal, and this script
+only pushes the files in the journal.  Files are copied in parallel to a
+temporary name on the NAS and renamed into place, so the NAS never holds a half
+written file.  Files that share a blob are hardlinked on the NAS as well.
+
+Every few days, or with --full, the whole archive is compared with the NAS
+(size and modification time, like rsync -t) as a safety net.
+
+Usage:
+    python3 nas_sync.py --source /home/USER/prisma/archive/ --target /mnt/mynas
+    python3 nas_sync.py --target /tmp/fake-nas --allow-unmounted --full
+"""
+import argparse
+import fcntl
+import os
+import shutil
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from prisma_state import load_json_file, save_json_file
+
+SOURCE_PATH = "/home/USER/prisma/archive/"
+TARGET_PATH = "/mnt/mynas"
+JOURNAL_FILE = "./prisma-sync-journal.txt"
+STATE_FILE = "./prisma-sync-state.json"
+SYNC_WORKERS = 2
+FULL_SYNC_DAYS = 7
+
+
+def record_changes(entries, journal_file=JOURNAL_FILE):
+    """
+    Append archive files to the sync journal
+
+    :param entries      : list of paths relative to the archive, or (path, link source)
+                          tuples where the path has the same contents as link source
+                          and is hardlinked to it on the NAS when possible
+    :param journal_file : The journal file
+    """
+    lines = []
+    for entry in entries:
+        if isinstance(entry, str):
+            lines.append(entry + "\n")
+        else:
+            lines.append("\t".join(entry) + "\n")
+    # a single O_APPEND write keeps lines whole if two writers run at once
+    fd = os.open(journal_file, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+    try:
+        os.write(fd, "".join(lines).encode('utf-8'))
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+def read_journal(journal_file):
+    """
+    Return value: dictionary of relative path -> link source or None, in journal order
+    """
+    entries = {}
+    if os.path.exists(journal_file):
+        with open(journal_file, encoding='utf-8') as f:
+            for line in f:
+                fields = line.rstrip("\n").split("\t")
+                if fields[0]:
+                    entries[fields[0]] = fields[1] if len(fields) > 1 else None
+    return entries
+
+
+def is_current(source_stat, target_file):
+    """
+    True if the target has the same size and modification time as the source
+    """
+    try:
+        target_stat = os.stat(target_file)
+    except FileNotFoundError:
+        return False
+    return target_stat.st_size == source_stat.st_size and \
+        int(target_stat.st_mtime) == int(source_stat.st_mtime)
+
+
+def push_file(source_root, target_root, relative_path, link_source=None):
+    """
+    Copy one archive file to the NAS, through a temporary file renamed into place
+
+    :param source_root   : the archive folder
+    :param target_root   : the NAS folder
+    :param relative_path : the file to copy, relative to both folders
+    :param link_source   : a file with the same contents to hardlink instead of copying
+
+    Return value: "skipped", "linked", "copied" or "removed"
+    """
+    source_file = os.path.join(source_root, relative_path)
+    target_file = os.path.join(target_root, relative_path)
+    try:
+        source_stat = os.stat(source_file)
+    except FileNotFoundError:
+        # written and removed again before the sync, e.g. a compacted snapshot
+        return "removed"
+    if is_current(source_stat, target_file):
+        return "skipped"
+    os.makedirs(os.path.dirname(target_file), exist_ok=True)
+    tmp_file = f"{target_file}.{os.getpid()}.tmp"
+    if link_source is not None and is_current(source_stat, os.path.join(target_root, link_source)):
+        try:
+            os.link(os.path.join(target_root, link_source), tmp_file)
+            os.replace(tmp_file, target_file)
+            return "linked"
+        except OSError:
+            if os.path.lexists(tmp_file):
+                os.unlink(tmp_file)
+    try:
+        with open(source_file, 'rb') as src, open(tmp_file, 'wb') as dst:
+            shutil.copyfileobj(src, dst, 1024 * 1024)
+            dst.flush()
+            os.fsync(dst.fileno())
+        os.utime(tmp_file, ns=(source_stat.st_atime_ns, source_stat.st_mtime_ns))
+        os.replace(tmp_file, target_file)
+    except BaseException:
+        # e.g. the NAS is full or went away, don't leave the partial copy behind
+        if os.path.lexists(tmp_file):
+            os.unlink(tmp_file)
+        raise
+    return "copied"
+
+
+def full_scan(source_root):
+    """
+    Return value: every file in the archive, relative to it, with the first file
+                  seen that is hardlinked to it as its link source
+    """
+    entries = {}
+    first_link = {}
+    # .blobs sorts before the year folders, so blobs are the link sources
+    for dirpath, dirnames, filenames in os.walk(source_root):
+        dirnames.sort()
+        for f in sorted(filenames):
+            if f.endswith(".tmp"):
+                continue
+            relative_path = os.path.relpath(os.path.join(dirpath, f), source_root)
+            file_stat = os.stat(os.path.join(dirpath, f))
+            link_source = None
+            if file_stat.st_nlink > 1:
+                link_source = first_link.setdefault(file_stat.st_ino, relative_path)
+            entries[relative_path] = link_source if link_source != relative_path else None
+    return entries
+
+
+def sync(source_root, target_root, journal_file=JOURNAL_FILE, state_file=STATE_FILE,
+         workers=SYNC_WORKERS, full=None):
+    """
+    Push the journalled files to the NAS, or every file on a full reconciliation.
+    Runs one at a time, a second sync waits for the first one to finish
+
+    :param source_root  : the archive folder
+    :param target_root  : the NAS folder
+    :param journal_file : The journal written by transfer_data.py
+    :param state_file   : JSON file holding the time of the last full reconciliation
+    :param workers      : number of files copied at once
+    :param full         : True to force a full reconciliation, None to do one when due
+
+    Return value: dictionary of result -> count, failures are counted as "failed"
+    """
+    # the daemon and a sync started from the command line take the same journal
+    with open(journal_file + ".lock", 'w') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        return _sync(source_root, target_root, journal_file, state_file, workers, full)
+
+
+def _sync(source_root, target_root, journal_file, state_file, workers, full):
+    state = load_json_file(state_file, {})
+    if full is None:
+        full = time.time() - state.get('last_full', 0) > FULL_SYNC_DAYS * 86400
+    # entries journalled from now on are picked up by the next run
+    inflight_file = journal_file + ".inflight"
+    if os.path.exists(journal_file):
+        taken_file = journal_file + ".taken"
+        os.replace(journal_file, taken_file)
+        with open(taken_file, 'rb') as src, open(inflight_file, 'ab') as dst:
+            shutil.copyfileobj(src, dst)
+            dst.flush()
+            os.fsync(dst.fileno())
+        os.unlink(taken_file)
+    entries = read_journal(inflight_file)
+    if full:
+        for relative_path, link_source in full_scan(source_root).items():
+            entries.setdefault(relative_path, link_source)
+    counts = {}
+    failed = []
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        # blobs first so the day folder files can be hardlinked to them
+        blobs = [(path, executor.submit(push_file, source_root, target_root, path, link))
+                 for path, link in entries.items() if link is None]
+        for relative_path, future in blobs:
+            try:
+                result = future.result()
+            except OSError as e:
+                print(f"Failed to sync {relative_path}: {e}")
+                result = "failed"
+                failed.append(relative_path)
+            counts[result] = counts.get(result, 0) + 1
+        linked = [(path, executor.submit(push_file, source_root, target_root, path, link))
+                  for path, link in entries.items() if link is not None]
+        for relative_path, future in linked:
+            try:
+                result = future.result()
+            except OSError as e:
+                print(f"Failed to sync {relative_path}: {e}")
+                result = "failed"
+                failed.append((relative_path, entries[relative_path]))
+            counts[result] = counts.get(result, 0) + 1
+    if failed:
+        record_changes(failed, journal_file)
+    if os.path.exists(inflight_file):
+        os.unlink(inflight_file)
+    if full and not failed:
+        state['last_full'] = time.time()
+    state['last_sync'] = time.time()
+    save_json_file(state_file, state)
+    return counts
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Push new archive files to the NAS")
+    parser.add_argument('--source', default=SOURCE_PATH, help="archive folder (default %(default)s)")
+    parser.add_argument('--target', default=TARGET_PATH, help="NAS folder (default %(default)s)")
+    parser.add_argument('--journal', default=JOURNAL_FILE, help="sync journal (default %(default)s)")
+    parser.add_argument('--state', default=STATE_FILE, help="sync state file (default %(default)s)")
+    parser.add_argument('--workers', type=int, default=SYNC_WORKERS, help="files copied at once")
+    parser.add_argument('--full', action='store_true', help="compare the whole archive with the NAS")
+    parser.add_argument('--allow-unmounted', action='store_true',
+                        help="sync to a target that is not a mount point, e.g. a local test folder")
+    args = parser.parse_args()
+
+    if not args.allow_unmounted and not os.path.ismount(args.target):
+        # never fill the SD card by writing into the empty mount point
+        print(f"{args.target} is not mounted, nothing synced")
+        sys.exit(1)
+    start = time.monotonic()
+    counts = sync(args.source, args.target, args.journal, args.state, args.workers,
+                  True if args.full else None)
+    summary = ", ".join(f"{count} {result}" for result, count in sorted(counts.items())) or "nothing to do"
+    print(f"NAS sync: {summary} in {time.monotonic() - start:.2f}s")
+    sys.exit(1 if counts.get("failed") else 0)
@@ -1,3 +1,6 @@
 #!/bin/bash
 
-rsync -rt /home/USER/prisma/archive/ /mnt/mynas
\ No newline at end of file
+# push only the archive files written since the last sync, with a full
+# comparison against the NAS every few days
+cd /home/USER/prisma/scripts
+/home/USER/prisma/mypython/bin/python3 /home/USER/prisma/scripts/nas_sync.py --source /home/USER/prisma/archive/ --target /mnt/mynas
\ No newline at end of file
@@ -4,6 +4,55 @@ Script used to uploading Lowenstein Prisma device data to SleepHQ via API
 
 
 Version History:
+    Version 1.1.0: 18-Oct-2026
+    Changes:
+       - MD5 file hashing moved to sleephq_hash.py and done a buffer at a time
+         instead of byte by byte
+       - File hashes are cached in prisma-hash-cache.json and only recalculated
+         when a file changes. Use --rehash to force every file to be hashed again
+       - Imported files are recorded in prisma-upload-ledger.json. If nothing is new
+         the import is skipped entirely, otherwise every file is sent so the import
+         always holds both config.pcfg and therapy.pdat
+       - Files are uploaded in parallel over a shared connection (sleephq_client.py).
+         The fixed pause between uploads is replaced by a rate limiter that only
+         slows down when SleepHQ returns HTTP 429
+       - Uploads are streamed from disk instead of being built in memory.
+         --stream-hash calculates the hash of new files during the upload
+       - Import status is checked with a short first wait and then exponential
+         backoff, stops on failed imports and gives up after --poll-deadline seconds
+       - The access token and machine ID are kept in prisma-token-cache.json and reused
+         until the token expires. A rejected token is replaced automatically
+       - Hashing runs alongside authorization and the import reservation, and the
+         next file is hashed while the previous one uploads
+       - Optional SLEEPHQ_BASE_URL and NTFY_URL .env entries to use other servers, e.g.
+         the local stand-in sleephq_standin.py used by benchmark_upload.py
+       - Step and HTTP timings are logged as JSON records and can be exported for
+         Prometheus with the optional PROM_TEXTFILE .env entry (prisma_metrics.py)
+       - When therapy.pdat has only been appended to, just the new data is hashed.
+         The previously hashed part is read and compared in full unless --sample-verify
+         is given, and transfer_data.py keeps the checkpoints while copying the card
+       - The upload after the .env setup is done by upload_from_env(), which the
+         resident service prisma_daemon.py calls without starting a new interpreter.
+         stop_polling() ends a wait for SleepHQ early when the service is stopped
+       - Snapshots queued by transfer_data.py in prisma-upload-queue.db (upload_queue.py)
+         are uploaded newest first and retried with backoff after a failure.
+         --no-queue uploads the DIR_PATH folder as before
+       - prisma_fleet.py uploads several devices listed in prisma-fleet.json from one
+         process. Token refreshes work for several header dictionaries at once and
+         NTFY messages can carry a device name prefix
+       - ntfy notifications are queued and sent by a background thread with timeouts and
+         retries, bursts are combined into one message and the queue is flushed at exit.
+         The log file and screen messages are written by a QueueListener thread (prisma_notify.py)
+       - Every SleepHQ call goes through SleepHQClient (sleephq_client.py), with connect and
+         read timeouts per endpoint, retries with jittered backoff where sending a call again
+         is safe, a circuit breaker failing fast while SleepHQ is down and per endpoint
+         latency counters written to the log after each run
+       - The .env file is read once into a PrismaConfig object (prisma_config.py).
+         prisma_quick.py checks for new data without importing requests and only loads
+         this script when there is something to upload
+       - The upload status of each file is copied into the archive catalogue
+         prisma-archive.db (archive_catalogue.py) after each run
+
     Verison 1.0.3: 22-Jan-2025
     Author: Mike Stone
     Changes:
@@ -38,11 +87,19 @@ Thorsten Brinkmann.
 
 Requirements:
  - This requires the python-dotenv to be installed via pip install python-dotenv
+ - sleephq_hash.py, sleephq_client.py, prisma_state.py, prisma_metrics.py,
+   prisma_notify.py, prisma_logging.py, prisma_config.py, upload_queue.py,
+   archive_catalogue.py, archive_store.py and nas_sync.py located in the same folder
+   as the script
  - a .env located in the same folder as the script with the following lines:
     CLIENT_ID = '<your client id>'
     CLIENT_SECRET = '<your secret>'
     DIR_PATH = '<path to the config.pcfg and therapy.pdat files>'
     SERIAL = 'ANY | <serial number of your  Prisma device>'
+ Optional .env entries:
+    SLEEPHQ_BASE_URL = '<SleepHQ server, default https://sleephq.com>'
+    NTFY_URL = '<ntfy server, default https://ntfy.sh>'
+    PROM_TEXTFILE = '<.prom file for the node_exporter textfile collector>'
  If you have more than one xPAP machine associated with your account, goto My Devices
  and locate the Lowenstein device serial number to attach the date to.  If you have
  a single xPAP machine only on your account, use the 'ANY' value to get the serial number
@@ -54,6 +111,27 @@ Requirements:
     - email notification
   2 - A routine to notify users about failures
 """
+# Import states that mean SleepHQ has given up on an import
+IMPORT_FAILED_STATES = ("failed", "error", "errored", "cancelled")
+# Default number of seconds to wait for SleepHQ to process an import
+POLL_DEADLINE = 1800
+# HTTP statuses that mean the credentials or .env settings are wrong, trying again won't help
+PERMANENT_STATUSES = (400, 401, 403, 404)
+
+
+class UploadFailed(SystemExit):
+    """
+     Raised by display_failure_and_exit.  Ends the script with exit status 1
+     like sys.exit(1), but keeps the message for callers that carry on, such
+     as the upload queue.  permanent is True for failures a retry can't fix,
+     e.g. rejected credentials or a serial number that does not exist
+    """
+    def __init__(self, message, permanent=False):
+        super().__init__(1)
+        self.message = message
+        self.permanent = permanent
+
+
 class NTFY:
     """
      Encapsulataed everything needed to utilize ntfy notifications
@@ -61,7 +139,7 @@ class NTFY:
      This keeps all messaging to a single object rather than passing
      multiple paramters to all function definitions
     """
-    def __init__(self, enabled, token, topic, logger):
+    def __init__(self, enabled, token, topic, logger, server="https://ntfy.sh", prefix=""):
         """
         Construct a new ntfy object.
 
@@ -69,47 +147,52 @@ class NTFY:
                          do disable it
         :param token   : ntfy token for protected topics
         :param topic   : topic to post messages to
+        :param server  : the ntfy server to post to
+        :param prefix  : text put in front of every message, e.g. the device name in fleet mode
         """
         self.enabled = enabled
         self.token = token
         self.topic = topic
         self.logger = logger
+        self.server = server.rstrip('/')
+        self.prefix = prefix
 
     def display_message(self, message):
         """
         Display a message to the screen and log it to the logfile
         """
-        self.logger.info(message)
-        print(message)
+        console_message(self.logger, self.prefix + message)
         return
 
     def send_success(self, message):
         """
-        Send a success message via the ntfy service
+        Queue a success message for the ntfy service, it is sent in the background
 
         :param message : The message to send 
         """
         if self.enabled == "YES":
-            ntfy_url = "https://ntfy.sh/" + self.topic
-            requests.post(ntfy_url,
-                data=message,
-                headers={ "Title": "Success",
-                          "Priority": "default",
-                          "Tags": "white_check_mark"})
+            get_dispatcher(self.server + "/" + self.topic).post("Success", self.prefix + message,
+                                                                "white_check_mark")
 
     def send_failure(self, message):
         """
-        Send a failure message via the ntfy service
+        Queue a failure message for the ntfy service, it is sent in the background
 
         :param message : The message to send 
         """
         if self.enabled == "YES":
-            ntfy_url = "https://ntfy.sh/" + self.topic
-            requests.post(ntfy_url,
-                data=message,
-                headers={ "Title": "Failure",
-                          "Priority": "default",
-                          "Tags": "rotating_light"})
+            get_dispatcher(self.server + "/" + self.topic).post("Failure", self.prefix + message,
+                                                                "rotating_light")
+
+    def flush(self, timeout=10.0):
+        """
+        Wait until the queued messages have been sent
+
+        Return value: True if nothing is left to send
+        """
+        if self.enabled == "YES":
+            return get_dispatcher(self.server + "/" + self.topic).flush(timeout)
+        return True
 
 class FileDetails:
     """
@@ -137,34 +220,53 @@ class FileDetails:
         return f"(Filename = {self.ShortName}, Full path = {self.LongName}, MD5 File hash is {self.FileHash})"
 
 
-def display_failure_and_exit(message, msg_ntfy):
+def display_failure_and_exit(message, msg_ntfy, permanent=False):
     """
     Routine for displaying any error messages related to a failure of an API call
-    After displaying the message, exit the script.
+    After displaying the message, exit the script by raising UploadFailed.
 
     Any hooks into additional notifications can be added here
 
     :param message: The message to display
     :param my_ntfy : the ntfy object for sending notifications
+    :param permanent : True if retrying can't help, so the upload queue gives the job up
 
     Return value: None
     """
-    ntfy.display_message( message)
+    msg_ntfy.display_message( message)
     msg_ntfy.send_failure(message)
-    sys.exit(1)
+    raise UploadFailed(message, permanent)
+
 
+def is_permanent(error):
+    """
+    Is a failed SleepHQ call caused by the credentials or settings rather than by
+    SleepHQ or the network being down?
 
-def get_access_token(client_id, client_secret, my_ntfy):
+    :param error : the requests exception
+    """
+    return isinstance(error, requests.HTTPError) and error.response is not None and \
+        error.response.status_code in PERMANENT_STATUSES
+
+
+def get_access_token(client_id, client_secret, my_ntfy, cred_cache=None):
     """
     Function to obtain an API access token for querying and uploading a user's SleepHQ account
 
     :param client_id     : The client UUID generated when adding an API key
     :param client_secret : The client secret generated when adding an API key
     :param my_ntfy : the ntfy object for sending notifications
+    :param cred_cache : Optional CredentialCache object. A cached token is used until
+                        it expires and new tokens are added to the cache
 
     Return value: an API token if the API call is successful; otherwise terminate the script
     """
-    url = "https://sleephq.com/oauth/token"
+    if cred_cache is not None:
+        cached_token = cred_cache.get_token(client_id)
+        if cached_token is not None:
+            my_ntfy.display_message("\tUsing cached authorization")
+            return cached_token
+    url = api_url("/oauth/token")
     payload = {
         'client_id': client_id,
         'client_secret': client_secret,
@@ -172,33 +274,31 @@ def get_access_token(client_id, client_secret, my_ntfy):
         'scope': 'read write'
     }
     try:
-        response = requests.post(url, data=payload)
+        # asking for a token twice does no harm, so it is retried like a GET
+        response = get_client().post("token", url, data=payload, idempotent=True)
         response.raise_for_status()
-        ntfy.display_message("\tAuthorization successful")
-        return 'Bearer ' + response.json()['access_token']
+        my_ntfy.display_message("\tAuthorization successful")
+        token_details = response.json()
+        token = 'Bearer ' + token_details['access_token']
+        if cred_cache is not None:
+            cred_cache.store_token(client_id, token, token_details.get('expires_in', 3600))
+        return token
     except requests.RequestException as e:
-        display_failure_and_exit(f"\tFailed to get access token: {e}", my_ntfy)
+        display_failure_and_exit(f"\tFailed to get access token: {e}", my_ntfy, is_permanent(e))
 
 
 def calculate_md5(full_file_name):
     """
     Create a SleepHQ API compliance file hash.  Each of the data chunks
     need to be utf-8 encoded to ensure the file hash matches how SleepHQ
-    calculates the hash values.
+    calculates the hash values.  The encoding is done a whole buffer at a
+    time by the sleephq_hash module rather than byte by byte.
 
     :param full_file_name : The full path of the file to create the MD5 hash from
 
     returns: a SleepHQ API compliant hash
     """
-    hasher = hashlib.md5()  # Create a hasher instance
-    short_file_name = os.path.basename(full_file_name)
-    with open(full_file_name, 'rb') as f:
-        for chunk in iter(lambda: f.read(4096), b''):
-            utf8_chunk = ''.join([chr(b) for b in chunk])
-            hasher.update(utf8_chunk.encode('utf-8'))
-    # Update the hasher with the file name encoded in UTF-8
-    hasher.update(short_file_name.encode('utf-8'))
-    return hasher.hexdigest()
+    return calculate_content_hash(full_file_name)
 
 
 def get_team_id(headers, my_ntfy):
@@ -210,43 +310,55 @@ def get_team_id(headers, my_ntfy):
 
     Return value:  None
     """
-    url = "https://sleephq.com/api/v1/teams"
+    url = api_url("/api/v1/teams")
     try:
-        response = requests.request("GET", url, headers=headers)
+        response = get_client().get("teams", url, headers=headers)
         response.raise_for_status()
-
+        teams = response.json()['data']
         for index, team in enumerate(teams):
-            ntfy.display_message(f"Found:id {team['id']}, " + 
+            my_ntfy.display_message(f"Found:id {team['id']}, " + 
                                  f"Name: {team['attributes']['name']}, ")
         return()
     except requests.RequestException as e:
-        display_failure_and_exit(f"\tFailed to get Team Id: {e}", my_ntfy)
+        display_failure_and_exit(f"\tFailed to get Team Id: {e}", my_ntfy, is_permanent(e))
+
+
+def make_file_details(short_name, fullname, hash_cache=None, defer_hash=False):
+    """
+    Create a FileDetails object for a file, hashing it if needed
 
+    :param short_name : The filename
+    :param fullname   : The full path and filename
+    :param hash_cache : Optional HashCache object. A file that has not changed since
+                        it was last hashed reuses the cached hash
+    :param defer_hash : Don't hash a file that is not in hash_cache, its FileHash is left
+                        as None and is calculated while the file is uploaded
 
-def collect_files(dir_path):
+    Return value: a FileDetails object
+    """
+    if defer_hash:
+        hash_value = None if hash_cache is None else hash_cache.lookup(fullname, os.stat(fullname))
+    elif hash_cache is None:
+        hash_value = calculate_md5(fullname)
+    else:
+        hash_value = hash_cache.get_hash(fullname)
+    return FileDetails(short_name, fullname, hash_value)
+
+
+def collect_files(dir_path, hash_cache=None, defer_hash=False):
     """
     Create a list of FileDetail class objects based upon files found
            in the given folder.
 
-    :param dir_path : The full path to where the xPAP data files are
+    :param dir_path   : The full path to where the xPAP data files are
+    :param hash_cache : Optional HashCache object. Files that have not changed since
+                        they were last hashed reuse the cached hash
+    :param defer_hash : Don't hash files that are not in hash_cache, their FileHash is left
+                        as None and is calculated while the file is uploaded
 
     Return value: a List of FileDetail objects
     """
-    # create an empty list
-    import_files = []
-    # retrieve the list of files and directories from the file system
-    # only care about the list of files
-    for (dirpath, dirnames, filenames) in walk(dir_path):
-        for f in filenames:
-            # Create an instance of the FileDetails class and assign values
-            #  to all members
-            fullname = os.path.abspath(os.path.join(dir_path, f))
-            hash_value = calculate_md5(fullname)
-            # Get the calculated hash
-            fdetail = FileDetails(f, fullname, hash_value)
-            # Add the FileDetail object to the list of files
-            import_files.append(fdetail)
-    return import_files
+    return [make_file_details(f, fullname, hash_cache, defer_hash) for (f, fullname) in list_files(dir_path)]
 
 
 def reserve_import_id(team_id, headers, my_ntfy):
@@ -259,16 +371,16 @@ def reserve_import_id(team_id, headers, my_ntfy):
 
     Return value: The import ID to be used with the current data upload
     """
-    url = f"https://sleephq.com/api/v1/teams/{team_id}/imports"
+    url = api_url(f"/api/v1/teams/{team_id}/imports")
     payload = {'programmatic': False}
     try:
-        response = requests.post(url, headers=headers, data=payload)
+        response = get_client().post("reserve_import", url, headers=headers, data=payload)
         response.raise_for_status()
         return response.json()['data']['id']
     except requests.RequestException as e:
-        display_failure_and_exit(f"\tFailed to reserve import ID: {e}", my_ntfy)
+        display_failure_and_exit(f"\tFailed to reserve import ID: {e}", my_ntfy, is_permanent(e))
 
-def get_machine_id(team_id, headers, serial_number, my_ntfy):
+def get_machine_id(team_id, headers, serial_number, my_ntfy, cred_cache=None, client_id=None):
     """
     Get the machine ID to associate data to. Match against the provided serial number
 
@@ -276,19 +388,25 @@ def get_machine_id(team_id, headers, serial_number, my_ntfy):
     :param headers : JSON headers for the request
     :param serial_number : The Serial Number of the Machine to upload data against
     :param my_ntfy : the ntfy object for sending notifications
+    :param cred_cache : Optional CredentialCache object used to remember the machine ID
+    :param client_id  : The client UUID the cache entry belongs to
 
     Return value : The machine_id that matches the serial number provided
     """
-    url = f"https://sleephq.com/api/v1/teams/{team_id}/machines"
+    if cred_cache is not None and serial_number != "GETLIST":
+        machine_id = cred_cache.get_machine_id(client_id, team_id, serial_number)
+        if machine_id is not None:
+            return machine_id
+    url = api_url(f"/api/v1/teams/{team_id}/machines")
     payload = {'programmatic': True}
     status_message = ""
     try:
-        response = requests.get(url, headers=headers, data=payload)
+        response = get_client().get("machines", url, headers=headers, data=payload)
         response.raise_for_status()
         machines = response.json()['data']
         for index, machine in enumerate(machines):
             if serial_number == "GETLIST":
-                ntfy.display_message(f"Found:{machine['attributes']['brand']}, " + 
+                my_ntfy.display_message(f"Found:{machine['attributes']['brand']}, " + 
                       f"{machine['attributes']['model']}, " +
                       f"Serial Number: {machine['attributes']['serial_number']}")
             else:
@@ -297,45 +415,134 @@ def get_machine_id(team_id, headers, serial_number, my_ntfy):
                                 f"{machine['attributes']['model']}, " +
                                 f"Serial Number: {machine['attributes']['serial_number']}\n")
                 if shq_machine_serial == serial_number or serial_number == "ANY":
-                    ntfy.display_message(f"Found machine ID {machine['id']}")
+                    my_ntfy.display_message(f"Found machine ID {machine['id']}")
+                    if cred_cache is not None:
+                        cred_cache.store_machine_id(client_id, team_id, serial_number, machine['id'])
                     return (machine['id'])
         if serial_number == "GETLIST":
             return()
         # fail as a last resort if the matching serial number can't be located
         display_failure_and_exit(f"Failed to get Device_ID that matches {serial_number}\nFound:\n" + status_message + 
-                                  "\nUpdate your .env file with the correct serial number and try again.", my_ntfy)
+                                  "\nUpdate your .env file with the correct serial number and try again.", my_ntfy,
+                                  permanent=True)
     except requests.RequestException as e:
-        display_failure_and_exit(f"\tFailed to query Device ID: {e}", my_ntfy)
+        display_failure_and_exit(f"\tFailed to query Device ID: {e}", my_ntfy, is_permanent(e))
+
+
+class UploadResult:
+    """
+     The outcome of uploading a single file to SleepHQ
+    """
+
+    def __init__(self, file_detail, status_code=None, error=None):
+        """
+        Construct a new UploadResult object.
 
+        :param file_detail : The FileDetails object that was uploaded
+        :param status_code : The last HTTP status code received, if any
+        :param error       : Description of the failure, None if the upload succeeded
+        """
+        self.FileDetail = file_detail
+        self.StatusCode = status_code
+        self.Error = error
 
-def upload_files(import_id, headers, file_detail_list, my_ntfy):
+    def __str__(self):
+        """
+        Return the details of the class instance.
+        """
+        if self.Error is None:
+            return f"{self.FileDetail.ShortName}: uploaded"
+        return f"{self.FileDetail.ShortName}: failed ({self.Error})"
+
+
+def upload_file(url, import_id, headers, item, limiter, my_ntfy, hash_cache=None, max_attempts=5):
     """
-    Upload data files one by one to SleepHQ
+    Upload a single data file to SleepHQ, retrying when SleepHQ asks us to slow down,
+    is briefly unavailable or could not be connected to.  The file is streamed from disk, if it does not have a hash yet the hash is
+    calculated while the file is being sent.
+
+    :param url          : The import files URL
+    :param import_id    : The import identifier previously obtained
+    :param headers      : JSON headers for the request
+    :param item         : The FileDetails object to upload
+    :param limiter      : RateLimiter shared by all uploads
+    :param my_ntfy      : the ntfy object for sending notifications
+    :param hash_cache   : Optional HashCache object to store a hash calculated during the upload
+    :param max_attempts : Number of attempts before giving up
+
+    Return value: an UploadResult object
+    """
+    client = get_client()
+    status_code = None
+    for attempt in range(max_attempts):
+        limiter.acquire()
+        try:
+            body = MultipartUpload(import_id, item.ShortName, item.LongName, item.FileHash)
+            try:
+                response = client.post("files", url, data=body,
+                                       headers={**headers, 'Content-Type': body.content_type})
+            finally:
+                body.close()
+            status_code = response.status_code
+            if status_code == 401 and refresh_authorization(headers.get('Authorization')) is not None:
+                # the token was rejected, the streamed body can't be resent by
+                # the session so retry here with the refreshed headers
+                my_ntfy.display_message(f"\tAuthorization expired, retrying {item.ShortName}")
+                continue
+            if status_code == 429:
+                retry_after = parse_retry_after(response.headers.get('Retry-After'))
+                limiter.throttled(retry_after)
+                my_ntfy.display_message(f"\tSleepHQ is rate limiting, retrying {item.ShortName}")
+                continue
+            if status_code in (502, 503, 504) and attempt + 1 < max_attempts:
+                # the gateway could not hand the file to SleepHQ, the client can't
+                # resend a streamed body so retry here
+                my_ntfy.display_message(f"\tSleepHQ is unavailable (HTTP {status_code}), retrying {item.ShortName}")
+                time.sleep(client.backoff(attempt))
+                continue
+            response.raise_for_status()
+            limiter.succeeded()
+            if item.FileHash is None:
+                item.FileHash = body.file_hash
+                if hash_cache is not None:
+                    hash_cache.store(item.LongName, body.file_stat, item.FileHash)
+            my_ntfy.display_message(f"\tFile {item.ShortName} has been imported")
+            return UploadResult(item, status_code)
+        except requests.RequestException as e:
+            if request_not_sent(e) and not isinstance(e, CircuitOpenError) and attempt + 1 < max_attempts:
+                my_ntfy.display_message(f"\tCould not connect to SleepHQ, retrying {item.ShortName}")
+                time.sleep(client.backoff(attempt))
+                continue
+            return UploadResult(item, status_code, str(e))
+        except OSError as e:
+            return UploadResult(item, status_code, str(e))
+    return UploadResult(item, status_code, f"still failing after {max_attempts} attempts")
+
+
+def upload_files(import_id, headers, file_detail_list, my_ntfy, max_workers=None, hash_cache=None):
+    """
+    Upload data files to SleepHQ in parallel over a shared connection pool
 
     :param import_id  : The import identifier previously obtained
     :param headers : JSON headers for the request
     :param file_details_list : List of FileDetail objects to import
     :param my_ntfy : the ntfy object for sending notifications
+    :param max_workers : The maximum number of files uploaded at the same time,
+                         defaults to UPLOAD_WORKERS
+    :param hash_cache : Optional HashCache object to store hashes calculated during the upload
 
-    Return value: None
+    Return value: a list of UploadResult objects, one per file, in the same order
+                  as file_detail_list
     """
-    url = f"https://sleephq.com/api/v1/imports/{import_id}/files"
-    for item in file_detail_list:
-        with open(item.LongName, 'rb') as f:
-            file_content = f
-            files = {
-                'import_id': import_id,
-                'name': (None, item.ShortName),
-                'path': (None, "./"),
-                # 'file': (file_name, file_content),
-                'file': (file_content),'content_hash': (None, item.FileHash)}
-            try:
-                response = requests.post(url, headers=headers, files=files)
-                response.raise_for_status()
-                ntfy.display_message(f"\tFile {item.ShortName} has been imported")
-            except requests.RequestException as e:
-                display_failure_and_exit(f"\tFailed to upload file {item.ShortName}: {e}", my_ntfy)
-            time.sleep(1.5)
+    url = api_url(f"/api/v1/imports/{import_id}/files")
+    limiter = RateLimiter()
+    if max_workers is None:
+        max_workers = UPLOAD_WORKERS
+    workers = max(1, min(max_workers, len(file_detail_list)))
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = [executor.submit(upload_file, url, import_id, headers, item, limiter, my_ntfy, hash_cache)
+                   for item in file_detail_list]
+        return [future.result() for future in futures]
 
 
 def process_imported_files(import_id, headers, my_ntfy):
@@ -349,48 +556,152 @@ def process_imported_files(import_id, headers, my_ntfy):
 
     Return values: None
     """
-    url = f"https://sleephq.com/api/v1/imports/{import_id}/process_files"
+    url = api_url(f"/api/v1/imports/{import_id}/process_files")
     try:
-        response = requests.post(url, headers=headers)
+        response = get_client().post("process_files", url, headers=headers)
         response.raise_for_status()
-        ntfy.display_message(f"\tFiles are now being processed in SleepHQ for Import ID: {import_id}")
+        my_ntfy.display_message(f"\tFiles are now being processed in SleepHQ for Import ID: {import_id}")
     except requests.RequestException as e:
         display_failure_and_exit(f"\tFailed to process imported files: {e}" +
                                  f"But you can try the Process Import request again later by calling: {url}", my_ntfy)
 
 
-def check_imported_files(import_id, headers, my_ntfy):
+def poll_delays(first_delay=2.0, factor=1.6, max_delay=30.0, jitter=0.2):
+    """
+    Generate the waits between import status checks: a short first wait, then
+    exponentially longer waits up to max_delay, each randomised by +/- jitter
+
+    :param first_delay : seconds before the first status check
+    :param factor      : growth of the wait after each check
+    :param max_delay   : the longest wait between two checks
+    :param jitter      : fraction the wait is randomly varied by
+    """
+    delay = first_delay
+    while True:
+        yield delay * random.uniform(1 - jitter, 1 + jitter)
+        delay = min(max_delay, delay * factor)
+
+
+def wait_for_import(import_id, headers, my_ntfy, deadline=POLL_DEADLINE):
+    """
+    Poll SleepHQ until an import reaches a final state or the deadline passes
+
+    :param import_id : The import_id to check
+    :param headers : JSON headers for the request
+    :param my_ntfy : the ntfy object for sending notifications
+    :param deadline : The maximum number of seconds to wait
+
+    Return value: a tuple of the import status ("timeout" if the deadline passed,
+                  "stopped" if stop_polling() was called) and the failure reason.
+                  requests.RequestException is raised if SleepHQ could not be queried
+    """
+    url = api_url(f"/api/v1/imports/{import_id}")
+    end_time = time.monotonic() + deadline
+    r_result = "timeout"
+    f_result = None
+    for delay in poll_delays():
+        remaining = end_time - time.monotonic()
+        if remaining <= 0:
+            return "timeout", f_result
+        if _polling_stopped.wait(min(delay, remaining)):
+            return "stopped", f_result
+        response = get_client().get("import_status", url, headers=headers)
+        response.raise_for_status()
+        status_msg = response.json()['data']
+        r_result = status_msg['attributes']['status']
+        f_result = status_msg['attributes']['failed_reason']
+        my_ntfy.display_message(f"\timport status:{r_result}; Failure Reason: {f_result}")
+        if r_result == "complete" or r_result in IMPORT_FAILED_STATES:
+            return r_result, f_result
+
+
+class ImportStatusPoller:
+    """
+     Waits for an import to finish in a background thread so other work
+     can carry on while SleepHQ processes the files
+    """
+
+    def __init__(self, import_id, headers, my_ntfy, deadline=POLL_DEADLINE):
+        """
+        Construct a new ImportStatusPoller object. Call start() to begin polling.
+
+        :param import_id : The import_id to check
+        :param headers : JSON headers for the request
+        :param my_ntfy : the ntfy object for sending notifications
+        :param deadline : The maximum number of seconds to wait
+        """
+        self.import_id = import_id
+        self.headers = headers
+        self.my_ntfy = my_ntfy
+        self.deadline = deadline
+        self.status = None
+        self.failed_reason = None
+        self.error = None
+        self.thread = threading.Thread(target=self.run, name=f"poll-import-{import_id}", daemon=True)
+
+    def start(self):
+        """
+        Start polling in a background thread
+        """
+        self.thread.start()
+
+    def run(self):
+        try:
+            self.status, self.failed_reason = wait_for_import(self.import_id, self.headers,
+                                                              self.my_ntfy, self.deadline)
+        except (requests.RequestException, ValueError, KeyError) as e:
+            self.error = e
+
+    def result(self):
+        """
+        Wait for polling to finish
+
+        Return value: a tuple of the import status and the failure reason.  The
+                      exception is re-raised if SleepHQ could not be queried
+        """
+        self.thread.join()
+        if self.error is not None:
+            raise self.error
+        return self.status, self.failed_reason
+
+
+def check_imported_files(import_id, headers, my_ntfy, deadline=POLL_DEADLINE):
     """
     Check for errors with an import ID
 
     :param: import_id : The import_id to check
     :param headers : JSON headers for the request
     :param my_ntfy : the ntfy object for sending notifications
+    :param deadline : The maximum number of seconds to wait for SleepHQ to process the import
 
-    Return value: None
+    Return value: The final import status
     """
-    url = f"https://sleephq.com/api/v1/imports/{import_id}"
-    r_result = ""
-    f_result = ""
+    url = api_url(f"/api/v1/imports/{import_id}")
     try:
-        while (not r_result == "complete"):
-            time.sleep(15)
-            response = requests.get(url, headers=headers)
-            response.raise_for_status()
-            status_msg = response.json()['data']
-            ntfy.display_message(f"\timport status:{status_msg['attributes']['status']}; Failure Reason: " +
-                  f"{status_msg['attributes']['failed_reason']}")
-            r_result = status_msg['attributes']['status']
-            f_result = status_msg['attributes']['failed_reason']
+        r_result, f_result = wait_for_import(import_id, headers, my_ntfy, deadline)
     except requests.RequestException as e:
         display_failure_and_exit(f"\tFailed to process imported files: {e}" +
-                                 f"But you can try the Process Import request again later by calling: {url}". my_ntfy)
-        sys.exit(1)
-    if not r_result == "complete":
+                                 f"But you can try the Process Import request again later by calling: {url}", my_ntfy)
+    if r_result == "timeout":
+        display_failure_and_exit(f"\tSleepHQ did not finish processing the import within {deadline} seconds. " +
+                                 f"Check the status later by calling: {url}", my_ntfy)
+    elif r_result == "stopped":
+        display_failure_and_exit(f"\tStopped before SleepHQ finished processing the import. " +
+                                 f"Check the status later by calling: {url}", my_ntfy)
+    elif not r_result == "complete":
         display_failure_and_exit(f"\tFailed to process imported files.  Result is {r_result}. Failure code is {f_result}", my_ntfy)
     else:
         my_ntfy.send_success("Data import into SleepIQ was successful")
-    return
+    return r_result
+
+def stop_polling():
+    """
+    Make every wait for SleepHQ to process an import return "stopped" straight
+    away, e.g. when prisma_daemon.py is asked to stop.  Waits started afterwards
+    return at once too
+    """
+    _polling_stopped.set()
+
 
 def display_message(logme, message):
     """
@@ -399,24 +710,241 @@ def display_message(logme, message):
     :param logme   : a logger instance
     :param message : the message to display/log
     """
-    logme.info(message)
-    print(message)
+    console_message(logme, message)
     return
 
 
+def run_pipeline(client_id, client_secret, team_id, serial_number, dir_path, my_ntfy,
+                 hash_cache, ledger, cred_cache, defer_hash=False, poll_deadline=POLL_DEADLINE,
+                 stage_times=None, metrics=None):
+    """
+    Run Steps 1 to 7 with the stages overlapped where they don't depend on each other:
+
+      - files are hashed one after another in their own thread (Step 1)
+      - at the same time the token and machine ID are obtained (Steps 2 and 3)
+      - the import ID is reserved as soon as the first new file is found (Step 4)
+      - each new file is uploaded as soon as it is hashed, so the next file is
+        hashed while the previous one uploads (Step 5)
+      - Steps 6 and 7 follow once every upload has finished
+
+    :param client_id     : The client UUID generated when adding an API key
+    :param client_secret : The client secret generated when adding an API key
+    :param team_id       : your team ID
+    :param serial_number : The Serial Number of the Machine to upload data against
+    :param dir_path      : The full path to where the xPAP data files are
+    :param my_ntfy       : the ntfy object for sending notifications
+    :param hash_cache    : HashCache object holding the hashes from previous runs
+    :param ledger        : UploadLedger object recording the files already imported
+    :param cred_cache    : CredentialCache object holding the token and machine ID
+    :param defer_hash    : Hash uncached files while they upload instead of in Step 1
+    :param poll_deadline : The maximum number of seconds to wait for SleepHQ to process the import
+    :param stage_times   : Optional dictionary that receives the seconds taken by each stage
+    :param metrics       : Optional Metrics object the stage timings are also recorded in
+
+    Return value: the final import status, or None if there was nothing new to import
+    """
+    if stage_times is None:
+        stage_times = {}
+
+    def timed(stage, func, *func_args):
+        # run one stage and remember how long it took
+        start = time.monotonic()
+        success = False
+        try:
+            result = func(*func_args)
+            success = True
+            return result
+        finally:
+            stage_times[stage] = time.monotonic() - start
+            if metrics is not None:
+                metrics.observe_step(stage, stage_times[stage], success)
+
+    def setup_api():
+        # Steps 2 and 3
+        my_ntfy.display_message("Starting Step 2: Obtain Access Token")
+        headers = {
+            'Authorization': timed("Step 2", get_access_token, client_id, client_secret, my_ntfy, cred_cache),
+            'Accept': 'application/json'
+        }
+
+        def refresh_token():
+            # called when SleepHQ rejects the cached token
+            cred_cache.invalidate_token(client_id)
+            return get_access_token(client_id, client_secret, my_ntfy, cred_cache)
+        set_auth_refresher(headers, refresh_token)
+        my_ntfy.display_message("Completed Step 2")
+        my_ntfy.display_message("Starting Step 3: Obtaining machine ID")
+        machine_id = timed("Step 3", get_machine_id, team_id, headers, serial_number, my_ntfy,
+                           cred_cache, client_id)
+        my_ntfy.display_message(f"\tMachine ID retrieved successfully: {machine_id}")
+        my_ntfy.display_message("Completed Step 3")
+        return headers
+
+    found_files = list_files(dir_path)
+    if len(found_files) == 0:
+        display_failure_and_exit(f"\tNo files found at path {dir_path} to import to SleepHQ." +
+                                  "Check your folder path and update the .env file if needed.", my_ntfy,
+                                  permanent=True)
+    pipeline_start = time.monotonic()
+    my_ntfy.display_message("Step 1: Gather files for uploading and comput MD5 hash.")
+    new_files = []
+    # files SleepHQ has already imported, sent again if another file turns out to be new
+    imported_files = []
+    upload_futures = []
+    import_id = None
+    limiter = RateLimiter()
+    with ThreadPoolExecutor(max_workers=1) as hash_executor, \
+            ThreadPoolExecutor(max_workers=1 + UPLOAD_WORKERS) as api_executor:
+        hash_futures = [hash_executor.submit(timed, f"Step 1 {f}", make_file_details, f, fullname,
+                                             hash_cache, defer_hash)
+                        for (f, fullname) in found_files]
+        api_future = api_executor.submit(setup_api)
+        for future in hash_futures:
+            item = future.result()
+            my_ntfy.display_message(f"\tProcessed: {item.LongName} hash: {item.FileHash or 'calculated during upload'}")
+            # hold back files SleepHQ has already imported, e.g. the button was pressed twice
+            if import_id is None and ledger.is_imported(item.FileHash):
+                my_ntfy.display_message(f"\t{item.ShortName} has already been imported")
+                imported_files.append(item)
+                continue
+            headers = api_future.result()
+            if import_id is None:
+                my_ntfy.display_message("Starting Step 4: Obtain an Import ID")
+                import_id = timed("Step 4", reserve_import_id, team_id, headers, my_ntfy)
+                my_ntfy.display_message(f"\tImport Id reserved successfully: {import_id}")
+                my_ntfy.display_message("Completed Step 4")
+                my_ntfy.display_message("Starting Step 5: Uploading files")
+                url = api_url(f"/api/v1/imports/{import_id}/files")
+            # SleepHQ reads a night from the files of one import, so config.pcfg and
+            # therapy.pdat are always sent together once either of them is new
+            for my_item in imported_files + [item]:
+                if my_item is not item:
+                    my_ntfy.display_message(f"\tSending {my_item.ShortName} again with the new data")
+                new_files.append(my_item)
+                upload_futures.append(api_executor.submit(timed, f"Step 5 {my_item.ShortName}", upload_file,
+                                                          url, import_id, headers, my_item, limiter,
+                                                          my_ntfy, hash_cache))
+            imported_files = []
+        my_ntfy.display_message("Completed Step 1")
+        upload_results = [future.result() for future in upload_futures]
+        api_future.result()
+    hash_cache.save()
+    if len(new_files) == 0:
+        my_ntfy.display_message("No new data to import. Data Import Process is complete.")
+        return None
+
+    pipeline_time = time.monotonic() - pipeline_start
+    serial_time = sum(stage_times.values())
+    my_ntfy.display_message(f"\tSteps 1-5 took {pipeline_time:.2f}s, {serial_time:.2f}s if run one after another " +
+                            f"(saved {serial_time - pipeline_time:.2f}s)")
+
+    for result in upload_results:
+        if result.Error is None:
+            ledger.record(result.FileDetail.FileHash, result.FileDetail.ShortName, import_id, "uploaded")
+    ledger.save()
+    failed_uploads = [result for result in upload_results if result.Error is not None]
+    if len(failed_uploads) > 0:
+        display_failure_and_exit("\tFailed to upload files:\n" +
+                                 "\n".join(f"\t{result}" for result in failed_uploads), my_ntfy)
+    my_ntfy.display_message("Completed Step 5")
+    # tell SleepHQ to process the files
+    my_ntfy.display_message("Starting Step 6: Processing Files")
+    timed("Step 6", process_imported_files, import_id, headers, my_ntfy)
+    my_ntfy.display_message("Completed Step 6")
+
+    # check the status for the file processing
+    my_ntfy.display_message("Starting Step 7: Check processing status")
+    import_status = timed("Step 7", check_imported_files, import_id, headers, my_ntfy, poll_deadline)
+    for item in new_files:
+        ledger.record(item.FileHash, item.ShortName, import_id, import_status)
+    ledger.save()
+    my_ntfy.display_message("Completed Step 7.\nData Import Process is complete.")
+    return import_status
+
+
+def upload_from_env(rehash=False, full_verify=True, stream_hash=False, poll_deadline=POLL_DEADLINE,
+                    queue=None, config=None):
+    """
+    Upload new data using the settings in the .env file, which must already exist.
+    Used by the __main__ block, prisma_quick.py and prisma_daemon.py
+
+    :param rehash        : ignore the hash cache and hash every file again
+    :param full_verify   : read the whole previously hashed part of appended files, False to sample it
+    :param stream_hash   : hash new files while they are uploaded
+    :param poll_deadline : seconds to wait for SleepHQ to process the import
+    :param queue         : UploadQueue of snapshots to upload instead of the DIR_PATH folder
+    :param config        : PrismaConfig already read from the .env file, read here if None
+
+    Return value: the import status, or None if there was nothing new
+    """
+    if config is None:
+        config = PrismaConfig.load()
+    # optional, point the script at another server e.g. sleephq_standin.py for testing
+    set_base_url(config.sleephq_base_url or DEFAULT_BASE_URL)
+    ntfy = NTFY(config.ntfy_enable, config.ntfy_token, config.ntfy_topic, logging, config.ntfy_url)
+
+    # Collect information on the config.pcfg and therapy.pdat files
+    # Those two files should be the only files in the folder
+    # specified by my_dir_path
+    # unchanged files reuse the hash from the previous run
+    my_hash_cache = HashCache('./prisma-hash-cache.json', rehash=rehash, full_verify=full_verify)
+    my_ledger = UploadLedger('./prisma-upload-ledger.json')
+    # the token and machine ID are reused from previous runs until the token expires
+    my_cred_cache = CredentialCache('./prisma-token-cache.json')
+    # step and HTTP timings, optionally exported for the node_exporter textfile collector
+    my_metrics = Metrics('./prisma-metrics.json')
+    set_metrics(my_metrics)
+
+    def upload(dir_path):
+        if not rehash and all_files_imported(dir_path, my_hash_cache, my_ledger):
+            ntfy.display_message("No new data to import. Data Import Process is complete.")
+            return None
+        return run_pipeline(config.client_id, config.client_secret, config.team_id, config.serial,
+                            dir_path, ntfy, my_hash_cache, my_ledger, my_cred_cache,
+                            stream_hash, poll_deadline, metrics=my_metrics)
+
+    my_run_ok = False
+    import_status = None
+    try:
+        if queue is None:
+            import_status = upload(config.dir_path)
+        else:
+            # snapshots that failed before are retried, only the newest one is uploaded
+            import_status = drain(queue, upload)
+        my_run_ok = True
+    finally:
+        # the archive catalogue shows which snapshots SleepHQ has imported
+        record_uploads(my_ledger)
+        my_metrics.finish(my_run_ok, config.prom_textfile)
+        get_client().log_latency(logging)
+    return import_status
+
+
 ##################
 # Module imports #
 ##################
 import importlib.util
 import os  # used for OS file operations
 import sys  # used to raise a system error
-from os import walk  # used to get files from a folder
 import time  # used for sleeping
+import random  # used to add jitter to the status polling
+import threading  # used for background status polling
 from pathlib import Path
 import json
-import hashlib
 import logging
-from logging.handlers import RotatingFileHandler
+import argparse  # used for the command line options
+from sleephq_hash import calculate_content_hash, HashCache  # SleepHQ compliant file hashing
+from prisma_state import UploadLedger, CredentialCache  # record of files already imported, cached token
+from prisma_state import list_files, all_files_imported  # quick check for new data
+from prisma_config import PrismaConfig  # the .env settings
+from prisma_logging import console_message, setup_logging, set_console_logging  # background logging
+from concurrent.futures import ThreadPoolExecutor  # used for parallel uploads
+from prisma_metrics import Metrics  # step and HTTP timings
+from upload_queue import UploadQueue, QUEUE_FILE, drain  # snapshots waiting to be uploaded
+from archive_catalogue import record_uploads  # upload status of the archived files
+
+# Set by stop_polling()
+_polling_stopped = threading.Event()
 
 # Modules not installed by debault on python3
 requests_spec = importlib.util.find_spec("requests")
@@ -427,18 +955,37 @@ if requests_spec is None:
     display_failure_and_exit("Required module \"requests\" is not found. Please run: pip3 install requests")
 else:
     import requests
+    from sleephq_client import get_client, parse_retry_after, MultipartUpload, RateLimiter, UPLOAD_WORKERS
+    from sleephq_client import refresh_authorization, set_auth_refresher, api_url, set_base_url
+    from sleephq_client import DEFAULT_BASE_URL, set_metrics, request_not_sent, CircuitOpenError
+    from prisma_notify import get_dispatcher
 if dotenv_spec is None:
     display_failure_and_exit("Required module \"dotenv\" is not found. Please run: pip3 install python-dotenv")
 else:
-    from dotenv import load_dotenv, find_dotenv, set_key  # For loading environment variables
+    from dotenv import set_key  # For writing the .env file during the first run setup
 
 if __name__ == '__main__':
-    # define a rotating log file
-    logging.basicConfig(
-        handlers=[RotatingFileHandler('./prisma-api.log', maxBytes=100000, backupCount=3)],
-        level=logging.DEBUG,
-        format="[%(asctime)s] %(message)s",
-        datefmt='%Y-%m-%dT%H:%M:%S')
+    parser = argparse.ArgumentParser(description="Upload Lowenstein Prisma data to SleepHQ")
+    parser.add_argument('--rehash', action='store_true',
+                        help="ignore the hash cache and hash every file again")
+    parser.add_argument('--sample-verify', action='store_true',
+                        help="when only hashing the data appended to therapy.pdat, only sample the " +
+                             "previously hashed part to check it is unchanged instead of reading all of it. " +
+                             "Faster, but a change outside the samples gives a wrong hash")
+    # reading the whole prefix is now the default, the option is still accepted
+    parser.add_argument('--full-verify', action='store_true', help=argparse.SUPPRESS)
+    parser.add_argument('--stream-hash', action='store_true',
+                        help="hash new files while they are uploaded instead of in Step 1, " +
+                             "so each file is only read once")
+    parser.add_argument('--poll-deadline', type=int, default=POLL_DEADLINE,
+                        help="seconds to wait for SleepHQ to process the import (default %(default)s)")
+    parser.add_argument('--no-queue', action='store_true',
+                        help="upload the DIR_PATH folder instead of the snapshots queued by transfer_data.py")
+    args = parser.parse_args()
+
+    # define a rotating log file, written by a background thread
+    # messages are printed directly until the first run setup has asked its questions
+    setup_logging('./prisma-api.log', console=False)
 
     # create a dummy entry for logging purposes
     # this can't send out any notifications at this time
@@ -449,9 +996,10 @@ if __name__ == '__main__':
     my_client_secret = ""
     my_device_serial = ""
     my_dir_path = ""
-    env_file_path = Path(os.getcwd()+ "/.env")
-    env_path = find_dotenv()
-    if not env_path:
+    # the .env file is read once, and again only after the setup below has changed it
+    my_config = PrismaConfig.load()
+    env_file_path = Path(my_config.env_file or os.getcwd() + "/.env")
+    if my_config.env_file is None:
         ntfy.display_message(".env file does not exist, let's create it..")
         my_client_id = input("Please enter your SleepHQ Client ID > ")
         my_client_secret = input("Please enter your SleepHQ Client Secret > ")
@@ -479,17 +1027,9 @@ if __name__ == '__main__':
         set_key(dotenv_path=env_file_path, key_to_set="DIR_PATH", value_to_set=my_dir_path)
         set_key(dotenv_path=env_file_path, key_to_set="TEAM_ID", value_to_set=my_team_id)
         ntfy.display_message(".env has been created, proceeding with uploading data")
-    load_dotenv()
-    my_client_id = os.getenv('CLIENT_ID')
-    my_client_secret = os.getenv('CLIENT_SECRET')
-    my_device_serial = os.getenv('SERIAL')
-    my_dir_path = os.getenv('DIR_PATH')
-    my_team_id = os.getenv('TEAM_ID')
-    ntfy_enable = os.getenv('NTFY_ENABLE')
-    ntfy_topic = os.getenv('NTFY_TOPIC')
-    ntfy_token = os.getenv('NTFY_TOKEN')
+        my_config = PrismaConfig.load(str(env_file_path))
     ## Add in ntfy entries if they don't exist
-    if ntfy_enable == None:
+    if my_config.ntfy_enable == None:
         ntfy.display_message(".env does not contain entries for ntfy... creating")
         my_ntfy_enable = input("Enable ntfy push notifications? (YES/NO) > ")
         my_ntfy_token = input("Enter in your ntfy token (currently not used) > ")
@@ -497,50 +1037,8 @@ if __name__ == '__main__':
         set_key(dotenv_path=env_file_path, key_to_set="NTFY_ENABLE", value_to_set=my_ntfy_enable)
         set_key(dotenv_path=env_file_path, key_to_set="NTFY_TOKEN", value_to_set=my_ntfy_token)
         set_key(dotenv_path=env_file_path, key_to_set="NTFY_TOPIC", value_to_set=my_ntfy_topic)
-        load_dotenv() # reload environment variables
-    ntfy = NTFY(ntfy_enable, ntfy_token, ntfy_topic, logging)
-
-    # Collect information on the config.pcfg and therapy.pdat files
-    # Those two files should be the only files in the folder
-    # specified by my_dir_path
-    ntfy.display_message("Step 1: Gather files for uploading and comput MD5 hash.")
-    my_file_details_list = collect_files(my_dir_path)
-    if len(my_file_details_list) == 0:
-        display_failure_and_exit(f"\tNo files found at path {my_dir_path} to import to SleepHQ." +
-                                  "Check your folder path and update the .env file if needed.", ntfy)
-    # Print out result file list
-    for fname in my_file_details_list:  ntfy.display_message(f"\tProcessed: {fname.LongName} hash: {fname.FileHash}")
-    ntfy.display_message("Completed Step 1")
-    # Get the API authorization token
-    ntfy.display_message("Starting Step 2: Obtain Access Token")
-    my_auth_token = get_access_token(my_client_id, my_client_secret, ntfy)
-    # Create header used for most API calls
-    my_header = {
-        'Authorization': my_auth_token,
-        'Accept': 'application/json'
-    }
-    ntfy.display_message("Completed Step 2")
-    # get the correct machine id to attach the data uplaod to
-    machine_id = get_machine_id(my_team_id, my_header, my_device_serial, ntfy)
-    ntfy.display_message("Starting Step 3: Obtaining machine ID")
-    ntfy.display_message(f"\tMachine ID retrieved successfully: {machine_id}")
-    ntfy.display_message("Completed Step 3")
-    # get an import ID reservation
-    ntfy.display_message("Starting Step 4: Obtain an Import ID")
-    my_import_id = reserve_import_id(my_team_id, my_header, ntfy)
-    ntfy.display_message(f"\tImport Id reserved successfully: {my_import_id}")
-    ntfy.display_message("Completed Step 4")
-    # upload files to SleepHQ API
-    ntfy.display_message("Starting Step 5: Uploading files")
-    upload_files(my_import_id, my_header, my_file_details_list, ntfy)
-    ntfy.display_message("Completed Step 5")
-    # tell SleepHQ to process the files
-    ntfy.display_message("Starting Step 6: Processing Files")
-    process_imported_files(my_import_id, my_header, ntfy)
-    ntfy.display_message("Completed Step 6")
-    time.sleep(10)
-
-    # check the status for the file processing
-    ntfy.display_message("Starting Step 7: Check processing status")
-    check_imported_files(my_import_id, my_header,ntfy)
-    ntfy.display_message("Completed Step 7.\nData Import Process is complete.")
+        my_config = PrismaConfig.load(str(env_file_path)) # reload the settings
+    set_console_logging(True)
+    # transfer_data.py queues each snapshot it copies, without it the DIR_PATH folder is uploaded
+    my_queue = UploadQueue(QUEUE_FILE) if not args.no_queue and os.path.exists(QUEUE_FILE) else None
+    upload_from_env(args.rehash, not args.sample_verify, args.stream_hash, args.poll_deadline, my_queue, my_config)
@@ -0,0 +1,312 @@
+""" Backfill SleepHQ from the archive
+
+The uploader only reads DIR_PATH, the newest data.  After an outage or when
+moving to a new SleepHQ account the older nights in archive/YYYY/MM/DD can be
+replayed with this script.  It walks the day folders in a date range, oldest
+first, and imports every snapshot holding a file whose content hash has not
+been imported yet (prisma-upload-ledger.json), with all of the snapshot's files.  Compacted days are restored to
+a temporary folder first.
+
+Up to --workers snapshots are uploaded at once.  The status of each import is
+polled in the background while the next snapshots upload.  Progress is written
+to a checkpoint file after every step, so an interrupted backfill carries on
+where it stopped: finished days are skipped and imports that were already
+uploaded are only polled again.
+
+Usage:
+    python3 prisma_backfill.py --from 2025-01-01 --to 2025-02-15
+"""
+import argparse
+import datetime
+import logging
+import os
+import shutil
+import sys
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+import prisma20a_sleephq_uploader as uploader
+from archive_catalogue import record_uploads
+from archive_store import ArchiveStore, REF_SUFFIX
+from prisma_config import PrismaConfig
+from prisma_metrics import Metrics
+from prisma_logging import setup_logging
+from prisma_state import load_json_file, save_json_file, UploadLedger, CredentialCache
+from sleephq_client import get_client, set_base_url, set_metrics, set_auth_refresher, set_pool_size
+from sleephq_client import DEFAULT_BASE_URL, UPLOAD_WORKERS
+from sleephq_hash import HashCache, calculate_content_hash
+from transfer_data import ARCHIVE_PATH
+
+CHECKPOINT_FILE = "./prisma-backfill.json"
+BACKFILL_WORKERS = 2
+# Imports waiting for SleepHQ to finish processing before new uploads wait for them
+MAX_PENDING_POLLS = 8
+
+
+def archive_days(archive_path, first_day=None, last_day=None):
+    """
+    Generate the day folders of the archive in a date range, oldest first
+
+    :param archive_path : the archive folder holding the YYYY/MM/DD folders
+    :param first_day    : datetime.date of the first day, None for the oldest
+    :param last_day     : datetime.date of the last day, None for the newest
+
+    Return value: (datetime.date, folder) tuples
+    """
+    def numbered(path):
+        if not os.path.isdir(path):
+            return []
+        return sorted(name for name in os.listdir(path) if name.isdigit())
+
+    for year in numbered(archive_path):
+        for month in numbered(os.path.join(archive_path, year)):
+            for day in numbered(os.path.join(archive_path, year, month)):
+                try:
+                    date = datetime.date(int(year), int(month), int(day))
+                except ValueError:
+                    continue
+                if (first_day is None or date >= first_day) and (last_day is None or date <= last_day):
+                    yield date, os.path.join(archive_path, year, month, day)
+
+
+class BackfillCheckpoint:
+    """
+     Progress of a backfill, one entry per day:
+
+        skipped  : nothing in the snapshot needed importing
+        uploaded : files uploaded and processing started, the import ID is kept
+        complete : SleepHQ imported the snapshot
+        failed   : the snapshot failed, it is tried again on the next run
+    """
+
+    def __init__(self, checkpoint_file):
+        """
+        Construct a new BackfillCheckpoint object.
+
+        :param checkpoint_file : The JSON file holding the progress
+        """
+        self.checkpoint_file = checkpoint_file
+        self.days = load_json_file(checkpoint_file, {}).get('days', {})
+
+    def get(self, day):
+        return self.days.get(day, {}).get('state')
+
+    def set(self, day, state, **details):
+        """
+        Record the state of a day and write the checkpoint to disk
+        """
+        self.days[day] = dict(details, state=state, updated=int(time.time()))
+        save_json_file(self.checkpoint_file, {'days': self.days})
+
+
+class Backfill:
+    """
+     Imports the snapshots of a range of archive days
+    """
+
+    def __init__(self, team_id, headers, my_ntfy, store, hash_cache, ledger, checkpoint,
+                 workers=BACKFILL_WORKERS, poll_deadline=uploader.POLL_DEADLINE):
+        """
+        Construct a new Backfill object.
+
+        :param team_id       : your team ID
+        :param headers       : JSON headers for the requests, with a valid token
+        :param my_ntfy       : the ntfy object for sending notifications
+        :param store         : ArchiveStore used to restore compacted days
+        :param hash_cache    : HashCache object for the archived files
+        :param ledger        : UploadLedger object recording the files already imported
+        :param checkpoint    : BackfillCheckpoint object
+        :param workers       : number of snapshots uploaded at once
+        :param poll_deadline : seconds to wait for SleepHQ to process each import
+        """
+        self.team_id = team_id
+        self.headers = headers
+        self.my_ntfy = my_ntfy
+        self.store = store
+        self.hash_cache = hash_cache
+        self.ledger = ledger
+        self.checkpoint = checkpoint
+        self.workers = workers
+        self.poll_deadline = poll_deadline
+        self.pollers = []
+        self.counts = {}
+        self.scratch = tempfile.mkdtemp(prefix="prisma-backfill-")
+
+    def count(self, state):
+        self.counts[state] = self.counts.get(state, 0) + 1
+
+    def new_files(self, day, folder, selected):
+        """
+        Return every file of a snapshot if any of them has not been imported or selected
+        yet, SleepHQ reads a night from config.pcfg and therapy.pdat in the same import
+
+        :param day      : the day, e.g. 2025-01-14
+        :param folder   : the day folder
+        :param selected : set of content hashes already selected in this backfill
+        """
+        names = sorted(os.listdir(folder))
+        if any(name.endswith(REF_SUFFIX) for name in names):
+            # compacted day, restore it so it can be hashed and uploaded
+            restored = os.path.join(self.scratch, day)
+            self.store.restore_day(os.path.relpath(folder, self.store.archive_path), restored)
+            folder = restored
+            names = sorted(os.listdir(folder))
+            get_hash = calculate_content_hash
+        else:
+            get_hash = self.hash_cache.get_hash
+        files = []
+        for name in names:
+            full_name = os.path.join(folder, name)
+            if name.endswith(".tmp") or not os.path.isfile(full_name):
+                continue
+            files.append(uploader.FileDetails(name, full_name, get_hash(full_name)))
+        if all(self.ledger.is_imported(item.FileHash) or item.FileHash in selected for item in files):
+            return []
+        selected.update(item.FileHash for item in files)
+        return files
+
+    def import_snapshot(self, day, files):
+        """
+        Reserve an import, upload the files and start processing.  Runs in a worker thread
+
+        Return value: the import ID
+        """
+        import_id = uploader.reserve_import_id(self.team_id, self.headers, self.my_ntfy)
+        results = uploader.upload_files(import_id, self.headers, files, self.my_ntfy)
+        failed = [result for result in results if result.Error is not None]
+        if failed:
+            uploader.display_failure_and_exit(f"\t{day}: failed to upload files:\n" +
+                                              "\n".join(f"\t{result}" for result in failed), self.my_ntfy)
+        uploader.process_imported_files(import_id, self.headers, self.my_ntfy)
+        return import_id
+
+    def start_polling(self, day, import_id, files):
+        poller = uploader.ImportStatusPoller(import_id, self.headers, self.my_ntfy, self.poll_deadline)
+        poller.start()
+        self.pollers.append((day, import_id, files, poller))
+        while len(self.pollers) > MAX_PENDING_POLLS:
+            self.finish_poll(*self.pollers.pop(0))
+
+    def finish_poll(self, day, import_id, files, poller):
+        try:
+            status, failed_reason = poller.result()
+        except Exception as e:
+            # still processing as far as we know, the next run polls it again
+            self.my_ntfy.display_message(f"\t{day}: could not check import {import_id}: {e}")
+            self.count("uploaded")
+            return
+        for item in files:
+            self.ledger.record(item.FileHash, item.ShortName, import_id, status)
+        self.ledger.save()
+        if status == "complete":
+            self.checkpoint.set(day, "complete", import_id=import_id)
+            self.count("complete")
+        elif status in ("timeout", "stopped"):
+            self.my_ntfy.display_message(f"\t{day}: import {import_id} still processing, checked again next run")
+            self.count("uploaded")
+        else:
+            self.checkpoint.set(day, "failed", import_id=import_id, error=f"{status}: {failed_reason}")
+            self.count("failed")
+
+    def run(self, days):
+        """
+        Import the snapshots of the given (datetime.date, folder) days
+
+        Return value: dictionary of outcome -> number of days
+        """
+        selected = set()
+        try:
+            with ThreadPoolExecutor(max_workers=self.workers) as executor:
+                futures = {}
+                for date, folder in days:
+                    day = date.isoformat()
+                    state = self.checkpoint.get(day)
+                    if state in ("complete", "skipped"):
+                        self.count("already done")
+                        continue
+                    if state == "uploaded":
+                        # interrupted while SleepHQ was processing it, only the status is needed
+                        details = self.checkpoint.days[day]
+                        files = [uploader.FileDetails(name, None, file_hash)
+                                 for name, file_hash in details['files'].items()]
+                        self.start_polling(day, details['import_id'], files)
+                        continue
+                    files = self.new_files(day, folder, selected)
+                    if not files:
+                        self.checkpoint.set(day, "skipped")
+                        self.count("skipped")
+                        continue
+                    self.my_ntfy.display_message(f"{day}: importing {', '.join(f.ShortName for f in files)}")
+                    futures[executor.submit(self.import_snapshot, day, files)] = (day, files)
+                for future in as_completed(futures):
+                    day, files = futures[future]
+                    try:
+                        import_id = future.result()
+                    except (Exception, SystemExit) as e:
+                        self.checkpoint.set(day, "failed", error=getattr(e, 'message', None) or repr(e))
+                        self.count("failed")
+                        continue
+                    self.checkpoint.set(day, "uploaded", import_id=import_id,
+                                        files={item.ShortName: item.FileHash for item in files})
+                    self.start_polling(day, import_id, files)
+            while self.pollers:
+                self.finish_poll(*self.pollers.pop(0))
+        finally:
+            self.hash_cache.save()
+            shutil.rmtree(self.scratch, ignore_errors=True)
+        return self.counts
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Import archived snapshots into SleepHQ")
+    parser.add_argument('--from', dest='first_day', type=datetime.date.fromisoformat,
+                        help="first day, YYYY-MM-DD (default the oldest archived day)")
+    parser.add_argument('--to', dest='last_day', type=datetime.date.fromisoformat,
+                        help="last day, YYYY-MM-DD (default the newest archived day)")
+    parser.add_argument('--archive', default=ARCHIVE_PATH, help="archive folder (default %(default)s)")
+    parser.add_argument('--workers', type=int, default=BACKFILL_WORKERS, help="snapshots uploaded at once")
+    parser.add_argument('--checkpoint', default=CHECKPOINT_FILE, help="checkpoint file (default %(default)s)")
+    parser.add_argument('--restart', action='store_true', help="ignore the checkpoint and start again")
+    parser.add_argument('--poll-deadline', type=int, default=uploader.POLL_DEADLINE,
+                        help="seconds to wait for SleepHQ to process each import (default %(default)s)")
+    args = parser.parse_args()
+
+    setup_logging('./prisma-api.log')
+    my_config = PrismaConfig.load()
+    set_base_url(my_config.sleephq_base_url or DEFAULT_BASE_URL)
+    # every snapshot uploading at once and every import being polled needs its own connection
+    set_pool_size(args.workers * (UPLOAD_WORKERS + 2) + MAX_PENDING_POLLS)
+    my_client_id = my_config.client_id
+    my_client_secret = my_config.client_secret
+    my_ntfy = uploader.NTFY(my_config.ntfy_enable, my_config.ntfy_token, my_config.ntfy_topic,
+                            logging, my_config.ntfy_url)
+    if args.restart and os.path.exists(args.checkpoint):
+        os.unlink(args.checkpoint)
+    my_metrics = Metrics('./prisma-metrics.json')
+    set_metrics(my_metrics)
+    my_cred_cache = CredentialCache('./prisma-token-cache.json')
+    my_headers = {
+        'Authorization': uploader.get_access_token(my_client_id, my_client_secret, my_ntfy, my_cred_cache),
+        'Accept': 'application/json'
+    }
+
+    def refresh_token():
+        # called when SleepHQ rejects the cached token
+        my_cred_cache.invalidate_token(my_client_id)
+        return uploader.get_access_token(my_client_id, my_client_secret, my_ntfy, my_cred_cache)
+    set_auth_refresher(my_headers, refresh_token)
+    uploader.get_machine_id(my_config.team_id, my_headers, my_config.serial, my_ntfy,
+                            my_cred_cache, my_client_id)
+
+    my_backfill = Backfill(my_config.team_id, my_headers, my_ntfy, ArchiveStore(args.archive),
+                           HashCache('./prisma-hash-cache.json'), UploadLedger('./prisma-upload-ledger.json'),
+                           BackfillCheckpoint(args.checkpoint), args.workers, args.poll_deadline)
+    my_start = time.monotonic()
+    my_counts = my_backfill.run(archive_days(args.archive, args.first_day, args.last_day))
+    record_uploads(my_backfill.ledger)
+    my_metrics.finish(not my_counts.get("failed"), my_config.prom_textfile)
+    get_client().log_latency(logging)
+    my_summary = ", ".join(f"{count} {state}" for state, count in sorted(my_counts.items())) or "no days found"
+    my_ntfy.display_message(f"Backfill: {my_summary} in {time.monotonic() - my_start:.1f}s")
+    sys.exit(1 if my_counts.get("failed") or my_counts.get("uploaded") else 0)
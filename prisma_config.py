@@ -0,0 +1,100 @@
+""" Uploader settings
+
+The .env file is read once into a PrismaConfig object, instead of every script
+calling load_dotenv() and os.getenv() wherever a setting is needed.  The file is
+parsed here without python-dotenv so the fast start path (prisma_quick.py) only
+uses the standard library.  As with load_dotenv(), variables already set in the
+environment take precedence over the file.
+"""
+import os
+
+ENV_FILE = ".env"
+
+# Settings read from the .env file, see the top of prisma20a_sleephq_uploader.py
+ENV_KEYS = ("CLIENT_ID", "CLIENT_SECRET", "DIR_PATH", "SERIAL", "TEAM_ID", "NTFY_ENABLE", "NTFY_TOKEN",
+            "NTFY_TOPIC", "NTFY_URL", "SLEEPHQ_BASE_URL", "PROM_TEXTFILE")
+
+
+def parse_env_file(env_file):
+    """
+    Read KEY=value lines as written by dotenv's set_key, e.g. CLIENT_ID='abc'.
+    Blank lines, comments and a leading "export" are ignored
+
+    :param env_file : the .env file
+
+    Return value: dictionary of the settings
+    """
+    values = {}
+    with open(env_file, encoding='utf-8') as f:
+        for line in f:
+            line = line.strip()
+            if not line or line.startswith('#') or '=' not in line:
+                continue
+            if line.startswith('export '):
+                line = line[len('export '):]
+            key, value = (part.strip() for part in line.split('=', 1))
+            quote = value[0] if len(value) > 1 and value[0] in "'\"" and value[-1] == value[0] else None
+            if quote is not None:
+                value = value[1:-1]
+                if quote == '"':
+                    value = value.replace('\\"', '"').replace('\\n', '\n').replace('\\\\', '\\')
+            elif ' #' in value:
+                value = value.split(' #', 1)[0].rstrip()
+            values[key] = value
+    return values
+
+
+def find_env_file(file_name=ENV_FILE):
+    """
+    Return value: the .env file in the current folder or next to the scripts,
+                  None if there is none
+    """
+    for folder in (os.getcwd(), os.path.dirname(os.path.abspath(__file__))):
+        path = os.path.join(folder, file_name)
+        if os.path.isfile(path):
+            return path
+    return None
+
+
+class PrismaConfig:
+    """
+     The settings of the .env file.  Missing optional settings are None
+    """
+
+    def __init__(self, values, env_file=None):
+        """
+        Construct a new PrismaConfig object.
+
+        :param values   : dictionary of the settings, as returned by parse_env_file
+        :param env_file : the file the settings were read from, None if there is no .env file
+        """
+        self.env_file = env_file
+        self.client_id = values.get('CLIENT_ID')
+        self.client_secret = values.get('CLIENT_SECRET')
+        self.dir_path = values.get('DIR_PATH')
+        self.serial = values.get('SERIAL')
+        self.team_id = values.get('TEAM_ID')
+        self.ntfy_enable = values.get('NTFY_ENABLE')
+        self.ntfy_token = values.get('NTFY_TOKEN')
+        self.ntfy_topic = values.get('NTFY_TOPIC')
+        self.ntfy_url = values.get('NTFY_URL') or "https://ntfy.sh"
+        self.sleephq_base_url = values.get('SLEEPHQ_BASE_URL')
+        self.prom_textfile = values.get('PROM_TEXTFILE')
+
+    @property
+    def ntfy_enabled(self):
+        return self.ntfy_enable == "YES"
+
+    @classmethod
+    def load(cls, env_file=None):
+        """
+        Read the settings from the .env file and the environment
+
+        :param env_file : the .env file, found with find_env_file() if None
+
+        Return value: a PrismaConfig object, its env_file is None if there is no .env file
+        """
+        env_file = env_file or find_env_file()
+        values = parse_env_file(env_file) if env_file is not None else {}
+        values.update({key: os.environ[key] for key in ENV_KEYS if key in os.environ})
+        return cls(values, env_file)
@@ -0,0 +1,250 @@
+""" Resident Prisma service
+
+Replaces the udev triggered upload_data.sh.  upload_data.sh waited a fixed 10
+seconds, then started a Python interpreter for the transfer, another for the
+upload (importing requests each time) and rsync for the NAS.  This service is
+started once at boot with its imports already loaded and waits for the kernel
+to report a change to the mount table.  As soon as the Weinmann card is mounted:
+
+    1. the files are copied off the card (transfer_data.py)
+    2. the card is unmounted and the YKUSH port switched off, releasing the Prisma
+    3. the new data is uploaded to SleepHQ and the archive synced to the NAS in
+       the background, while the service goes back to waiting for the card
+
+Uploads go through the upload queue (upload_queue.py).  If SleepHQ can't be
+reached the background worker retries with backoff, without the card having to
+be connected again.
+
+Usage:
+    python3 prisma_daemon.py
+    python3 prisma_daemon.py --mount-path /tmp/card --no-mount-check --nas /tmp/nas --no-ykush
+"""
+import argparse
+import logging
+import os
+import signal
+import subprocess
+import sys
+import threading
+import time
+
+import nas_sync
+import transfer_data
+import prisma20a_sleephq_uploader as uploader  # loads requests once, at start up
+from prisma_logging import setup_logging, console_message
+from mount_watch import mount_points, MountWatcher
+from upload_queue import UploadQueue, QUEUE_FILE, RETRY_FIRST_DELAY
+from ykush import open_ykush
+
+# Time between checks when mount events are not available, e.g. testing with a folder
+CHECK_INTERVAL = 60
+# Seconds to wait for the network stage to finish when stopping, systemd kills
+# the service after TimeoutStopSec=300
+STOP_TIMEOUT = 240
+
+
+class NetworkStage:
+    """
+     Drains the upload queue and runs the NAS sync in the background, one run at
+     a time.  Requests made while a run is in progress are combined into one more
+     run, and a run is started by itself when a failed upload is due for a retry
+    """
+
+    def __init__(self, queue, nas_path, archive_path, mount_check=True, logger=None):
+        """
+        Construct a new NetworkStage object.
+
+        :param queue        : UploadQueue the snapshots to upload are taken from
+        :param nas_path     : NAS folder the archive is synced to, None to skip the sync
+        :param archive_path : the archive folder
+        :param mount_check  : only sync when nas_path is a mount point
+        :param logger       : logger for failures
+        """
+        self.queue = queue
+        self.nas_path = nas_path
+        self.archive_path = archive_path
+        self.mount_check = mount_check
+        self.logger = logger or logging.getLogger('prisma.daemon')
+        self.pending = threading.Event()
+        self.stopping = False
+        # not waited for at exit, stop() has already given it STOP_TIMEOUT to finish
+        self.thread = threading.Thread(target=self.run, name="network-stage", daemon=True)
+
+    def start(self):
+        self.thread.start()
+
+    def request(self):
+        self.pending.set()
+
+    def stop(self, timeout=STOP_TIMEOUT):
+        """
+        Let the current run finish and stop the thread.  A wait for SleepHQ to
+        process an import is cut short, the queue retries the job later
+
+        :param timeout : seconds to wait for the run in progress
+
+        Return value: True if the thread stopped in time
+        """
+        self.stopping = True
+        self.pending.set()
+        uploader.stop_polling()
+        self.thread.join(timeout)
+        if self.thread.is_alive():
+            self.logger.error(f"Network stage still running after {timeout}s, stopping anyway")
+            return False
+        return True
+
+    def run_once(self):
+        start = time.monotonic()
+        try:
+            uploader.upload_from_env(queue=self.queue)
+        except SystemExit:
+            # display_failure_and_exit has already logged and notified the failure,
+            # the queue has scheduled the retry
+            pass
+        except Exception:
+            self.logger.exception("Upload failed")
+        if self.nas_path is not None:
+            if self.mount_check and not os.path.ismount(self.nas_path):
+                self.logger.error(f"{self.nas_path} is not mounted, archive not synced")
+            else:
+                try:
+                    # waits for a sync started from the command line to finish
+                    counts = nas_sync.sync(self.archive_path, self.nas_path)
+                    self.logger.info(f"NAS sync: {counts}")
+                except OSError:
+                    self.logger.exception("NAS sync failed")
+        self.logger.info(f"Network stage took {time.monotonic() - start:.2f}s")
+
+    def run(self):
+        last_run = None
+        while True:
+            next_due = self.queue.next_due()
+            timeout = None if next_due is None else max(0.0, next_due - time.time())
+            if last_run is not None and next_due is not None and next_due <= last_run:
+                # the last run failed before it took the job that was due, e.g. a broken
+                # .env file, wait as after a failed upload instead of trying again at once
+                self.logger.warning(f"Upload job due since {time.ctime(next_due)} not taken, " +
+                                    f"trying again in {RETRY_FIRST_DELAY}s")
+                timeout = RETRY_FIRST_DELAY
+            self.pending.wait(timeout)
+            self.pending.clear()
+            if self.stopping:
+                return
+            last_run = time.time()
+            self.run_once()
+
+
+class PrismaDaemon:
+    """
+     Copies the card as soon as it is mounted, then releases the Prisma
+    """
+
+    def __init__(self, mount_path, archive_path, data_path, network, ykush=None, mount_check=True,
+                 logger=None):
+        """
+        Construct a new PrismaDaemon object.
+
+        :param mount_path   : where the Weinmann card is mounted
+        :param archive_path : the archive folder
+        :param data_path    : the folder the uploader reads
+        :param network      : NetworkStage started after each new transfer
+        :param ykush        : YKUSH controller (see ykush.py) switched off after the card is read, None to skip
+        :param mount_check  : treat mount_path as a card only when it is a mount point
+        :param logger       : logger for progress and failures
+        """
+        self.mount_path = mount_path
+        self.archive_path = archive_path
+        self.data_path = data_path
+        self.network = network
+        self.ykush = ykush
+        self.mount_check = mount_check
+        self.logger = logger or logging.getLogger('prisma.daemon')
+        self.card_present = False
+
+    def card_ready(self):
+        if self.mount_check and self.mount_path not in mount_points():
+            return False
+        return all(os.path.isfile(os.path.join(self.mount_path, f)) for f in transfer_data.CARD_FILES)
+
+    def release_card(self):
+        """
+        Unmount the card and switch the YKUSH port off so the Prisma leaves USB mode
+        """
+        if self.mount_check:
+            result = subprocess.run(["umount", self.mount_path], capture_output=True, text=True)
+            if result.returncode != 0:
+                self.logger.error(f"umount {self.mount_path} failed: {result.stderr.strip()}")
+        if self.ykush is not None:
+            self.ykush.power_off()
+
+    def read_card(self):
+        """
+        Copy new data off the card, release it and start the network stage
+        """
+        start = time.monotonic()
+        new_data = False
+        try:
+            if transfer_data.has_new_data(self.mount_path, self.data_path):
+                transfer_data.create_year_month_folders(self.archive_path, self.mount_path, self.data_path)
+                new_data = True
+        except Exception:
+            # e.g. a damaged card, a full disk or a broken state file, the service keeps waiting
+            self.logger.exception("Copying the card failed")
+        finally:
+            # the card is no longer needed, release the Prisma before uploading
+            self.release_card()
+        self.logger.info(f"Card read in {time.monotonic() - start:.2f}s, new data: {new_data}")
+        if new_data:
+            self.network.request()
+
+    def check(self):
+        """
+        Read the card if it has appeared since the last check
+        """
+        ready = self.card_ready()
+        if ready and not self.card_present:
+            self.card_present = True
+            self.read_card()
+            # released cards are picked up again the next time they are mounted
+            self.card_present = self.card_ready()
+        elif not ready:
+            self.card_present = False
+
+    def serve(self, watcher, check_interval=CHECK_INTERVAL):
+        """
+        Check for the card every time the mount table changes, forever
+        """
+        self.check()
+        while True:
+            watcher.wait(check_interval)
+            self.check()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Resident service copying and uploading the Prisma card")
+    parser.add_argument('--mount-path', default=transfer_data.MOUNT_PATH, help="where the card is mounted")
+    parser.add_argument('--archive', default=transfer_data.ARCHIVE_PATH, help="archive folder")
+    parser.add_argument('--data', default=transfer_data.DATA_PATH, help="folder the uploader reads")
+    parser.add_argument('--nas', default=nas_sync.TARGET_PATH, help="NAS folder, empty to skip the sync")
+    parser.add_argument('--no-mount-check', action='store_true',
+                        help="treat --mount-path and --nas as ready without being mounted, for testing")
+    parser.add_argument('--no-ykush', action='store_true', help="do not switch the YKUSH port off")
+    parser.add_argument('--check-interval', type=int, default=CHECK_INTERVAL,
+                        help="seconds between checks if no mount event arrives")
+    args = parser.parse_args()
+
+    setup_logging('./prisma-api.log')
+    my_network = NetworkStage(UploadQueue(QUEUE_FILE), args.nas or None, args.archive, not args.no_mount_check)
+    my_daemon = PrismaDaemon(args.mount_path, args.archive, args.data, my_network,
+                             None if args.no_ykush else open_ykush(), not args.no_mount_check)
+    # systemd stops the service with SIGTERM, let an upload in progress finish
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    my_network.start()
+    console_message(logging, f"Waiting for the card at {args.mount_path}")
+    try:
+        my_daemon.serve(MountWatcher(), args.check_interval)
+    except (KeyboardInterrupt, SystemExit):
+        pass
+    finally:
+        my_network.stop()
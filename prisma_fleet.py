@@ -0,0 +1,214 @@
+""" Fleet mode: upload several Prisma devices in one process
+
+prisma20a_sleephq_uploader.py handles the single device described in the .env
+file.  This script reads a list of devices from prisma-fleet.json and uploads
+all of them from one process.  The devices share the HTTP connection pool, and
+each API client only has to authorize once.  Device pipelines run in parallel,
+with a limit on how many run at once for the same SleepHQ team.  A device that
+fails does not stop the others, and an outcome is reported for every device.
+
+prisma-fleet.json (readable only by its owner, it may hold client secrets):
+
+    {
+     "max_workers": 4,
+     "team_concurrency": 1,
+     "devices": [
+      {"name": "bedroom", "dir_path": "/home/USER/prisma/data", "serial": "ANY", "team_id": "1"},
+      {"name": "spare", "dir_path": "/home/USER/prisma2/data", "serial": "...", "team_id": "2",
+       "client_id": "...", "client_secret": "...", "ntfy_topic": "..."}
+     ]
+    }
+
+client_id, client_secret and the ntfy settings default to the .env entries
+used by the single device uploader.  Each device keeps its own hash cache and
+upload ledger (prisma-hash-cache.<name>.json, prisma-upload-ledger.<name>.json).
+
+Usage:
+    python3 prisma_fleet.py [--config prisma-fleet.json]
+"""
+import argparse
+import logging
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import prisma20a_sleephq_uploader as uploader
+from prisma_config import PrismaConfig
+from prisma_metrics import Metrics
+from prisma_logging import setup_logging, console_message
+from prisma_state import load_json_file, UploadLedger, CredentialCache
+from sleephq_client import get_client, set_base_url, set_metrics, set_pool_size, DEFAULT_BASE_URL, UPLOAD_WORKERS
+from sleephq_hash import HashCache
+
+FLEET_FILE = "./prisma-fleet.json"
+MAX_WORKERS = 4
+TEAM_CONCURRENCY = 1
+
+
+class DeviceOutcome:
+    """
+     The result of uploading one device
+    """
+
+    def __init__(self, name, status=None, error=None, seconds=0.0):
+        """
+        Construct a new DeviceOutcome object.
+
+        :param name    : the device name from the fleet file
+        :param status  : the import status, "nothing new" or None if it failed
+        :param error   : why the device failed, None on success
+        :param seconds : time the device took
+        """
+        self.Name = name
+        self.Status = status
+        self.Error = error
+        self.Seconds = seconds
+
+    def __str__(self):
+        if self.Error is not None:
+            # the first line says what went wrong, the rest is in prisma-api.log
+            return f"{self.Name}: failed after {self.Seconds:.1f}s: {self.Error.strip().splitlines()[0]}"
+        return f"{self.Name}: {self.Status} in {self.Seconds:.1f}s"
+
+
+class FleetScheduler:
+    """
+     Runs the pipelines of all devices in a thread pool, with a semaphore per team
+    """
+
+    def __init__(self, devices, cred_cache, metrics=None, max_workers=MAX_WORKERS,
+                 team_concurrency=TEAM_CONCURRENCY, poll_deadline=uploader.POLL_DEADLINE):
+        """
+        Construct a new FleetScheduler object.
+
+        :param devices          : list of device dictionaries from the fleet file, with
+                                  client_id, client_secret and ntfy settings filled in
+        :param cred_cache       : CredentialCache shared by every device
+        :param metrics          : Metrics object the step timings are recorded in
+        :param max_workers      : most device pipelines running at once
+        :param team_concurrency : most device pipelines running at once for one team
+        :param poll_deadline    : seconds to wait for SleepHQ to process each import
+        """
+        self.devices = devices
+        self.cred_cache = cred_cache
+        self.metrics = metrics
+        self.max_workers = max_workers
+        self.poll_deadline = poll_deadline
+        self.team_slots = {str(device['team_id']): threading.Semaphore(team_concurrency)
+                           for device in devices}
+        self.client_locks = {device['client_id']: threading.Lock() for device in devices}
+
+    def make_ntfy(self, device):
+        return uploader.NTFY(device.get('ntfy_enable', "NO"), device.get('ntfy_token'),
+                             device.get('ntfy_topic'), logging, device.get('ntfy_url', "https://ntfy.sh"),
+                             prefix=f"[{device['name']}] ")
+
+    def run_device(self, device):
+        """
+        Upload one device
+
+        Return value: a DeviceOutcome object, failures are never raised
+        """
+        start = time.monotonic()
+        my_ntfy = self.make_ntfy(device)
+        try:
+            # one token request per client, the other devices of the client find it in the cache
+            with self.client_locks[device['client_id']]:
+                uploader.get_access_token(device['client_id'], device['client_secret'], my_ntfy,
+                                          self.cred_cache)
+            with self.team_slots[str(device['team_id'])]:
+                hash_cache = HashCache(f"./prisma-hash-cache.{device['name']}.json")
+                ledger = UploadLedger(f"./prisma-upload-ledger.{device['name']}.json")
+                if uploader.all_files_imported(device['dir_path'], hash_cache, ledger):
+                    my_ntfy.display_message("No new data to import. Data Import Process is complete.")
+                    status = "nothing new"
+                else:
+                    status = uploader.run_pipeline(device['client_id'], device['client_secret'],
+                                                   device['team_id'], device['serial'], device['dir_path'],
+                                                   my_ntfy, hash_cache, ledger, self.cred_cache,
+                                                   poll_deadline=self.poll_deadline, metrics=self.metrics)
+            return DeviceOutcome(device['name'], status or "nothing new", seconds=time.monotonic() - start)
+        except uploader.UploadFailed as e:
+            return DeviceOutcome(device['name'], error=e.message, seconds=time.monotonic() - start)
+        except Exception as e:
+            logging.exception(f"[{device['name']}] upload failed")
+            return DeviceOutcome(device['name'], error=repr(e), seconds=time.monotonic() - start)
+
+    def run(self):
+        """
+        Upload every device
+
+        Return value: list of DeviceOutcome objects in the order of the fleet file
+        """
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            return list(executor.map(self.run_device, self.devices))
+
+
+def load_devices(fleet_file, config):
+    """
+    Read the fleet file and fill in the defaults from the .env file
+
+    :param fleet_file : the fleet file
+    :param config     : PrismaConfig holding the .env settings
+
+    Return value: (settings dictionary, list of device dictionaries)
+    """
+    settings = load_json_file(fleet_file, None)
+    if settings is None or not settings.get('devices'):
+        raise ValueError(f"{fleet_file} is missing, unreadable or lists no devices")
+    devices = []
+    names = set()
+    for index, entry in enumerate(settings['devices']):
+        device = {'name': f"device{index + 1}",
+                  'serial': "ANY",
+                  'team_id': config.team_id,
+                  'client_id': config.client_id,
+                  'client_secret': config.client_secret,
+                  'ntfy_enable': config.ntfy_enable or "NO",
+                  'ntfy_token': config.ntfy_token,
+                  'ntfy_topic': config.ntfy_topic,
+                  'ntfy_url': config.ntfy_url}
+        device.update(entry)
+        missing = [key for key in ('dir_path', 'team_id', 'client_id', 'client_secret') if not device.get(key)]
+        if missing:
+            raise ValueError(f"device {device['name']} in {fleet_file} has no {', '.join(missing)}")
+        if device['name'] in names:
+            raise ValueError(f"device name {device['name']} is used twice in {fleet_file}")
+        names.add(device['name'])
+        devices.append(device)
+    return settings, devices
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Upload several Prisma devices to SleepHQ")
+    parser.add_argument('--config', default=FLEET_FILE, help="fleet file (default %(default)s)")
+    parser.add_argument('--poll-deadline', type=int, default=uploader.POLL_DEADLINE,
+                        help="seconds to wait for SleepHQ to process each import (default %(default)s)")
+    args = parser.parse_args()
+
+    setup_logging('./prisma-api.log')
+    my_config = PrismaConfig.load()
+    set_base_url(my_config.sleephq_base_url or DEFAULT_BASE_URL)
+    try:
+        my_settings, my_devices = load_devices(args.config, my_config)
+    except ValueError as e:
+        print(e)
+        sys.exit(1)
+    my_max_workers = my_settings.get('max_workers', MAX_WORKERS)
+    # every device uploading at once needs its own connections
+    set_pool_size(my_max_workers * (UPLOAD_WORKERS + 2))
+    my_metrics = Metrics('./prisma-metrics.json')
+    set_metrics(my_metrics)
+    my_scheduler = FleetScheduler(my_devices, CredentialCache('./prisma-token-cache.json'), my_metrics,
+                                  my_max_workers, my_settings.get('team_concurrency', TEAM_CONCURRENCY),
+                                  args.poll_deadline)
+    my_start = time.monotonic()
+    my_outcomes = my_scheduler.run()
+    my_failed = [outcome for outcome in my_outcomes if outcome.Error is not None]
+    my_metrics.finish(not my_failed, my_config.prom_textfile)
+    get_client().log_latency(logging)
+    console_message(logging, f"Fleet upload of {len(my_outcomes)} devices took {time.monotonic() - my_start:.1f}s")
+    for my_outcome in my_outcomes:
+        console_message(logging, f"\t{my_outcome}")
+    sys.exit(1 if my_failed else 0)
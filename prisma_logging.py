@@ -0,0 +1,74 @@
+""" Logging through a background thread
+
+setup_logging() routes log records through a QueueHandler to a QueueListener
+thread, so the pipeline threads never wait on the log file or the console.
+Only the standard library is used, so the fast start path (prisma_quick.py)
+can log without importing requests.
+"""
+import atexit
+import logging
+import queue
+import sys
+from logging.handlers import QueueHandler, QueueListener, RotatingFileHandler
+
+_console_logging = False
+
+
+class ConsoleFilter(logging.Filter):
+    """
+     Passes the records meant for the screen, see console_message()
+    """
+
+    def filter(self, record):
+        return getattr(record, 'console', False)
+
+
+def setup_logging(log_file='./prisma-api.log', console=True, level=logging.DEBUG):
+    """
+    Log through a queue to a listener thread that writes the rotating log file,
+    and optionally the messages meant for the screen to stdout
+
+    :param log_file : the rotating log file
+    :param console  : write console_message() records from the listener thread, see
+                      set_console_logging()
+    :param level    : the root logger level
+
+    Return value: the running QueueListener, it is stopped when the script exits
+    """
+    file_handler = RotatingFileHandler(log_file, maxBytes=100000, backupCount=3)
+    file_handler.setFormatter(logging.Formatter("[%(asctime)s] %(message)s", datefmt='%Y-%m-%dT%H:%M:%S'))
+    console_handler = logging.StreamHandler(sys.stdout)
+    console_handler.addFilter(ConsoleFilter())
+    log_queue = queue.SimpleQueue()
+    listener = QueueListener(log_queue, file_handler, console_handler, respect_handler_level=True)
+    root = logging.getLogger()
+    for handler in list(root.handlers):
+        root.removeHandler(handler)
+    root.addHandler(QueueHandler(log_queue))
+    root.setLevel(level)
+    listener.start()
+    atexit.register(listener.stop)
+    set_console_logging(console)
+    return listener
+
+
+def set_console_logging(enabled):
+    """
+    Choose who writes console_message() output to the screen: the listener thread
+    (enabled), or the calling thread (disabled), which keeps messages in order with
+    input() prompts
+    """
+    global _console_logging
+    _console_logging = enabled
+
+
+def console_message(logger, message):
+    """
+    Log a message and show it on the screen.  Once setup_logging() has run the
+    screen output is written by the listener thread, otherwise it is printed here
+    """
+    if _console_logging:
+        logger.info(message, extra={'console': True})
+    else:
+        logger.info(message)
+        print(message)
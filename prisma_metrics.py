@@ -0,0 +1,166 @@
+""" Run metrics
+
+Records how long each step of the upload took and the duration, size, status
+code and retries of every HTTP call.  Each observation is written to the log as
+a JSON record, and at the end of a run the totals are written as a Prometheus
+node_exporter textfile collector file, e.g.
+
+    PROM_TEXTFILE = '/var/lib/node_exporter/textfile_collector/prisma.prom'
+
+Histograms and counters are kept across runs in a small JSON state file so
+trends over many nights can be graphed and alerted on.
+"""
+import json
+import logging
+import os
+import re
+import threading
+import time
+
+from prisma_state import load_json_file, save_json_file
+
+# Histogram buckets in seconds, from a cached token lookup to slow server processing
+DURATION_BUCKETS = (0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600)
+
+# Names used for the step label of each of the seven steps
+STEP_NAMES = {"1": "hash", "2": "token", "3": "machine", "4": "reserve",
+              "5": "upload", "6": "process", "7": "status"}
+
+
+def endpoint_name(path):
+    """
+    Turn a request path into a metric label by replacing the IDs in it,
+    e.g. /api/v1/imports/1234/files becomes /api/v1/imports/{id}/files
+    """
+    return re.sub(r'/\d+(?=/|$)', '/{id}', path)
+
+
+class Metrics:
+    """
+     Collects step and HTTP measurements for one run
+    """
+
+    def __init__(self, state_file, logger=None):
+        """
+        Construct a new Metrics object.
+
+        :param state_file : JSON file holding the histograms and counters of previous runs
+        :param logger     : logger the JSON records are written to
+        """
+        self.state_file = state_file
+        self.logger = logger or logging.getLogger('prisma.metrics')
+        self.state = load_json_file(state_file, {'histograms': {}, 'counters': {}})
+        self.lock = threading.Lock()
+        self.run_start = time.time()
+
+    def _observe(self, name, labels, value):
+        key = json.dumps([name, labels], sort_keys=True)
+        histogram = self.state['histograms'].setdefault(
+            key, {'buckets': [0] * len(DURATION_BUCKETS), 'sum': 0.0, 'count': 0})
+        for index, bound in enumerate(DURATION_BUCKETS):
+            if value <= bound:
+                histogram['buckets'][index] += 1
+        histogram['sum'] += value
+        histogram['count'] += 1
+
+    def _increment(self, name, labels, value=1):
+        key = json.dumps([name, labels], sort_keys=True)
+        self.state['counters'][key] = self.state['counters'].get(key, 0) + value
+
+    def _log(self, record):
+        self.logger.info(json.dumps(record, sort_keys=True))
+
+    def observe_step(self, stage, seconds, success=True):
+        """
+        Record how long a step took
+
+        :param stage   : the stage name used by run_pipeline, e.g. "Step 5 therapy.pdat"
+        :param seconds : duration of the step
+        :param success : False if the step failed
+        """
+        step = STEP_NAMES.get(stage.split(' ')[1], stage) if stage.startswith("Step ") else stage
+        with self.lock:
+            self._observe('prisma_step_duration_seconds', {'step': step}, seconds)
+            if not success:
+                self._increment('prisma_step_failures_total', {'step': step})
+        self._log({'type': "step", 'stage': stage, 'step': step,
+                   'seconds': round(seconds, 4), 'success': success})
+
+    def observe_http(self, method, path, status_code, seconds, bytes_sent, retry=False):
+        """
+        Record an HTTP call
+
+        :param method      : HTTP method
+        :param path        : request path, IDs are removed for the metric labels
+        :param status_code : HTTP status code of the response
+        :param seconds     : time until the response arrived
+        :param bytes_sent  : size of the request body
+        :param retry       : True if the call has to be repeated (HTTP 401 or 429)
+        """
+        labels = {'endpoint': endpoint_name(path), 'method': method}
+        with self.lock:
+            self._observe('prisma_http_request_duration_seconds', labels, seconds)
+            self._increment('prisma_http_requests_total', dict(labels, code=str(status_code)))
+            self._increment('prisma_http_sent_bytes_total', labels, bytes_sent)
+            if retry:
+                self._increment('prisma_http_retries_total', labels)
+        self._log({'type': "http", 'method': method, 'endpoint': labels['endpoint'],
+                   'status': status_code, 'seconds': round(seconds, 4),
+                   'bytes': bytes_sent, 'retry': retry})
+
+    def _format_labels(self, labels):
+        return ",".join(f'{name}="{value}"' for name, value in sorted(labels.items()))
+
+    def render(self, success):
+        """
+        Return the metrics in the Prometheus text exposition format
+
+        :param success : whether the run that just finished succeeded
+        """
+        lines = []
+        histograms = {}
+        for key, histogram in sorted(self.state['histograms'].items()):
+            name, labels = json.loads(key)
+            histograms.setdefault(name, []).append((labels, histogram))
+        for name, series in histograms.items():
+            lines.append(f"# TYPE {name} histogram")
+            for labels, histogram in series:
+                for bound, count in zip(DURATION_BUCKETS, histogram['buckets']):
+                    lines.append(f"{name}_bucket{{{self._format_labels(dict(labels, le=str(bound)))}}} {count}")
+                lines.append(f"{name}_bucket{{{self._format_labels(dict(labels, le='+Inf'))}}} {histogram['count']}")
+                lines.append(f"{name}_sum{{{self._format_labels(labels)}}} {histogram['sum']:.6f}")
+                lines.append(f"{name}_count{{{self._format_labels(labels)}}} {histogram['count']}")
+        counters = {}
+        for key, value in sorted(self.state['counters'].items()):
+            name, labels = json.loads(key)
+            counters.setdefault(name, []).append((labels, value))
+        for name, series in counters.items():
+            lines.append(f"# TYPE {name} counter")
+            for labels, value in series:
+                lines.append(f"{name}{{{self._format_labels(labels)}}} {value}")
+        lines.append("# TYPE prisma_last_run_timestamp_seconds gauge")
+        lines.append(f"prisma_last_run_timestamp_seconds {int(self.run_start)}")
+        lines.append("# TYPE prisma_last_run_duration_seconds gauge")
+        lines.append(f"prisma_last_run_duration_seconds {time.time() - self.run_start:.3f}")
+        lines.append("# TYPE prisma_last_run_success gauge")
+        lines.append(f"prisma_last_run_success {1 if success else 0}")
+        return "\n".join(lines) + "\n"
+
+    def finish(self, success, prom_file=None):
+        """
+        Save the histograms and counters and write the textfile collector file
+
+        :param success   : whether the run succeeded
+        :param prom_file : the .prom file to write, None to skip it
+        """
+        with self.lock:
+            self._increment('prisma_runs_total', {'result': "success" if success else "failure"})
+            save_json_file(self.state_file, self.state)
+            if prom_file:
+                # node_exporter must never see a half written file
+                tmp_name = f"{prom_file}.{os.getpid()}.tmp"
+                with open(tmp_name, 'w') as f:
+                    f.write(self.render(success))
+                os.replace(tmp_name, prom_file)
+        self._log({'type': "run", 'success': success,
+                   'seconds': round(time.time() - self.run_start, 3)})
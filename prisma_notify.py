@@ -0,0 +1,160 @@
+""" Background notifications
+
+NTFY used to post to ntfy.sh from the calling thread without a timeout, so a
+slow or unreachable ntfy server could hang a run, even while it was reporting a
+failure.  Notifications are now handed to a NotificationDispatcher thread
+through a bounded queue.  It posts with timeouts and retries, and folds a burst
+of notifications into one summary message.  Anything still queued when the
+script exits is sent then, for a limited time.
+"""
+import atexit
+import logging
+import queue
+import threading
+import time
+
+import requests
+
+# Most notifications waiting to be sent, the oldest are dropped first
+MAX_QUEUED = 100
+# Seconds to connect to and to wait for an answer from the ntfy server
+NTFY_TIMEOUT = (3.05, 10)
+# Attempts to send a notification before it is given up
+NTFY_ATTEMPTS = 3
+# Seconds to wait for more notifications to fold into one message
+COALESCE_DELAY = 1.0
+# Most seconds spent sending queued notifications when the script exits
+FLUSH_TIMEOUT = 10.0
+
+_dispatchers = {}
+_dispatchers_lock = threading.Lock()
+
+
+class NotificationDispatcher:
+    """
+     Posts notifications to an ntfy topic from a background thread
+    """
+
+    def __init__(self, url, max_queued=MAX_QUEUED, timeout=NTFY_TIMEOUT, attempts=NTFY_ATTEMPTS,
+                 coalesce_delay=COALESCE_DELAY, flush_at_exit=True):
+        """
+        Construct a new NotificationDispatcher object.
+
+        :param url            : the ntfy topic URL, e.g. https://ntfy.sh/mytopic
+        :param max_queued     : most notifications waiting to be sent
+        :param timeout        : (connect, read) timeout of each post in seconds
+        :param attempts       : attempts to send a notification before giving up
+        :param coalesce_delay : seconds to wait for more notifications to send as one message
+        :param flush_at_exit  : send what is still queued when the script exits
+        """
+        self.url = url
+        self.timeout = timeout
+        self.attempts = attempts
+        self.coalesce_delay = coalesce_delay
+        self.queue = queue.Queue(maxsize=max_queued)
+        self.condition = threading.Condition()
+        self.pending = 0
+        self.dropped = 0
+        self.session = requests.Session()
+        self.thread = threading.Thread(target=self.run, name="ntfy-dispatcher", daemon=True)
+        self.thread.start()
+        if flush_at_exit:
+            atexit.register(self.flush, FLUSH_TIMEOUT)
+
+    def post(self, title, message, tags):
+        """
+        Queue a notification, never blocks
+
+        :param title   : notification title, "Success" or "Failure"
+        :param message : notification text
+        :param tags    : ntfy tags, e.g. an emoji name
+        """
+        with self.condition:
+            self.pending += 1
+        while True:
+            try:
+                self.queue.put_nowait((title, message, tags))
+                return
+            except queue.Full:
+                try:
+                    self.queue.get_nowait()
+                except queue.Empty:
+                    continue
+                with self.condition:
+                    self.dropped += 1
+                    self.pending -= 1
+                    self.condition.notify_all()
+
+    def flush(self, timeout=FLUSH_TIMEOUT):
+        """
+        Wait until every queued notification has been sent or given up
+
+        Return value: True if nothing is left to send
+        """
+        end_time = time.monotonic() + timeout
+        with self.condition:
+            while self.pending > 0:
+                remaining = end_time - time.monotonic()
+                if remaining <= 0:
+                    return False
+                self.condition.wait(remaining)
+        return True
+
+    def _collect(self):
+        # wait for the next notification, then for any that quickly follow it
+        batch = [self.queue.get()]
+        end_time = time.monotonic() + self.coalesce_delay
+        while True:
+            remaining = end_time - time.monotonic()
+            try:
+                batch.append(self.queue.get(timeout=max(0.0, remaining)) if remaining > 0
+                             else self.queue.get_nowait())
+            except queue.Empty:
+                return batch
+
+    def _summarise(self, batch):
+        with self.condition:
+            dropped, self.dropped = self.dropped, 0
+        if len(batch) == 1 and not dropped:
+            return batch[0]
+        failures = [entry for entry in batch if entry[0] == "Failure"]
+        title, _, tags = failures[0] if failures else batch[0]
+        lines = [f"{len(batch)} notifications:"] + [f"- {title_}: {message}" for title_, message, _ in batch]
+        if dropped:
+            lines.append(f"({dropped} older notifications were dropped)")
+        return title, "\n".join(lines), tags
+
+    def _send(self, title, message, tags):
+        for attempt in range(self.attempts):
+            try:
+                response = self.session.post(self.url, data=message.encode('utf-8'), timeout=self.timeout,
+                                             headers={"Title": title, "Priority": "default", "Tags": tags})
+                if response.status_code < 500 and response.status_code != 429:
+                    return True
+            except requests.RequestException:
+                pass
+            if attempt + 1 < self.attempts:
+                time.sleep(2 ** attempt)
+        logging.getLogger('prisma.notify').error(f"Could not send the {title} notification to {self.url}")
+        return False
+
+    def run(self):
+        while True:
+            batch = self._collect()
+            try:
+                self._send(*self._summarise(batch))
+            finally:
+                with self.condition:
+                    self.pending -= len(batch)
+                    self.condition.notify_all()
+
+
+def get_dispatcher(url):
+    """
+    Return the dispatcher of an ntfy topic URL, creating it on first use, so all
+    NTFY objects posting to the same topic share one queue and thread
+    """
+    with _dispatchers_lock:
+        if url not in _dispatchers:
+            _dispatchers[url] = NotificationDispatcher(url)
+        return _dispatchers[url]
@@ -0,0 +1,95 @@
+""" Fast start for the uploader
+
+Most runs of the uploader find nothing new to import, e.g. a scheduled retry of
+the upload queue after the last snapshot went through.  On a Pi Zero 2W starting
+the interpreter and importing requests takes a noticeable share of such a run.
+This entry point reads the .env file once and checks for new data using only the
+standard library and the state files.  prisma20a_sleephq_uploader.py, and with it
+requests, is only imported when there is something to upload.
+
+It takes the same options as the uploader.  Before the .env file exists the
+uploader is started instead, to ask the first run setup questions.
+
+Usage:
+    python3 prisma_quick.py
+    python3 prisma_quick.py --check    # only report whether there is something to upload
+
+check_startup.py measures the imports of the nothing new path against a budget.
+"""
+import argparse
+import logging
+import os
+import sys
+
+from prisma_config import PrismaConfig
+from prisma_logging import setup_logging, console_message
+from prisma_state import UploadLedger, all_files_imported
+from sleephq_hash import HashCache
+from upload_queue import UploadQueue, QUEUE_FILE
+
+
+def pending_upload(config, queue, hash_cache, ledger):
+    """
+    Find data SleepHQ does not have yet, without hashing anything.  Due queue jobs
+    whose snapshot has already been imported are recorded as done
+
+    :param config     : PrismaConfig with the DIR_PATH folder
+    :param queue      : UploadQueue of snapshots, None to check the DIR_PATH folder
+    :param hash_cache : HashCache object holding the hashes from previous runs
+    :param ledger     : UploadLedger object recording the files already imported
+
+    Return value: the folder to upload, or None if there is nothing new
+    """
+    if queue is None:
+        return None if all_files_imported(config.dir_path, hash_cache, ledger) else config.dir_path
+    while True:
+        job = queue.peek()
+        if job is None:
+            return None
+        if not all_files_imported(job['path'], hash_cache, ledger):
+            return job['path']
+        queue.complete(job['id'], "nothing new")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Upload Lowenstein Prisma data to SleepHQ if there is any")
+    parser.add_argument('--rehash', action='store_true',
+                        help="ignore the hash cache and hash every file again")
+    parser.add_argument('--sample-verify', action='store_true',
+                        help="only sample the previously hashed part of therapy.pdat instead of reading all of it")
+    parser.add_argument('--full-verify', action='store_true', help=argparse.SUPPRESS)
+    parser.add_argument('--stream-hash', action='store_true',
+                        help="hash new files while they are uploaded instead of in Step 1")
+    parser.add_argument('--poll-deadline', type=int,
+                        help="seconds to wait for SleepHQ to process the import (default 1800)")
+    parser.add_argument('--no-queue', action='store_true',
+                        help="upload the DIR_PATH folder instead of the snapshots queued by transfer_data.py")
+    parser.add_argument('--check', action='store_true',
+                        help="only report whether there is new data, never upload")
+    args = parser.parse_args()
+
+    my_config = PrismaConfig.load()
+    if my_config.env_file is None or my_config.ntfy_enable is None:
+        if args.check:
+            print("The .env file is missing or incomplete, run prisma20a_sleephq_uploader.py first")
+            sys.exit(1)
+        # the first run setup asks its questions in the uploader
+        my_uploader = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'prisma20a_sleephq_uploader.py')
+        os.execv(sys.executable, [sys.executable, my_uploader] + sys.argv[1:])
+
+    setup_logging('./prisma-api.log')
+    my_queue = UploadQueue(QUEUE_FILE) if not args.no_queue and os.path.exists(QUEUE_FILE) else None
+    my_path = pending_upload(my_config, my_queue, HashCache('./prisma-hash-cache.json'),
+                             UploadLedger('./prisma-upload-ledger.json'))
+    if my_path is None and not args.rehash:
+        console_message(logging, "No new data to import. Data Import Process is complete.")
+        sys.exit(0)
+    if args.check:
+        console_message(logging, f"New data to import from {my_path}" if my_path is not None
+                        else "No new data to import, --rehash would hash every file again")
+        sys.exit(0)
+
+    # only now load the uploader and the HTTP stack
+    import prisma20a_sleephq_uploader as uploader
+    uploader.upload_from_env(args.rehash, not args.sample_verify, args.stream_hash,
+                             args.poll_deadline or uploader.POLL_DEADLINE, my_queue, my_config)
@@ -0,0 +1,260 @@
+""" Small on-disk state files
+
+Helpers for the JSON state files the scripts keep next to prisma-api.log
+(hash cache, upload ledger and so on).  Files are replaced atomically so a
+power cut or a killed run never leaves a half written file behind.  Files that
+more than one process writes, e.g. prisma_daemon.py and a transfer_data.py run
+from the command line, are updated with update_json_file() so neither loses the
+other's changes.
+
+all_files_imported() uses the hash cache and the upload ledger to tell, without
+hashing anything, whether a folder holds data SleepHQ does not have yet.
+"""
+import fcntl
+import json
+import os
+import threading
+import time
+
+
+def load_json_file(file_name, default):
+    """
+    Load a JSON state file
+
+    :param file_name : The state file to read
+    :param default   : The value to return if the file is missing or unreadable
+
+    Return value: the decoded JSON contents, or default
+    """
+    try:
+        with open(file_name, 'r', encoding='utf-8') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return default
+
+
+def save_json_file(file_name, data, mode=0o644):
+    """
+    Atomically write a JSON state file
+
+    :param file_name : The state file to write
+    :param data      : The data to store
+    :param mode      : Permissions for the file, use 0o600 for anything secret
+    """
+    tmp_name = f"{file_name}.tmp.{os.getpid()}"
+    fd = os.open(tmp_name, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, mode)
+    try:
+        with os.fdopen(fd, 'w', encoding='utf-8') as f:
+            json.dump(data, f, indent=1, sort_keys=True)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_name, file_name)
+    except BaseException:
+        if os.path.exists(tmp_name):
+            os.unlink(tmp_name)
+        raise
+
+
+def update_json_file(file_name, update, mode=0o644):
+    """
+    Read a JSON state file again, apply changes to it and write it back, holding
+    a lock so changes written by another process in the meantime are kept
+
+    :param file_name : The state file to update
+    :param update    : function called with the current contents of the file, a
+                       dictionary, to apply the changes to it in place
+    :param mode      : Permissions for the file, use 0o600 for anything secret
+
+    Return value: the contents written, including the other process's changes
+    """
+    with open(file_name + ".lock", 'a') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        data = load_json_file(file_name, {})
+        update(data)
+        save_json_file(file_name, data, mode)
+    return data
+
+
+def list_files(dir_path):
+    """
+    List the files to upload in the given folder
+
+    :param dir_path : The full path to where the xPAP data files are
+
+    Return value: a list of (filename, full path and filename) tuples
+    """
+    found_files = []
+    # retrieve the list of files and directories from the file system
+    # only care about the list of files
+    for (dirpath, dirnames, filenames) in os.walk(dir_path):
+        for f in filenames:
+            # .tmp files are copies still being written, or left by an interrupted one
+            if f.endswith(".tmp"):
+                continue
+            found_files.append((f, os.path.abspath(os.path.join(dir_path, f))))
+    return found_files
+
+
+def all_files_imported(dir_path, hash_cache, ledger):
+    """
+    Quick check, without hashing anything, whether every file in the folder is
+    unchanged since it was last hashed and has already been imported
+
+    :param dir_path   : The full path to where the xPAP data files are
+    :param hash_cache : HashCache object holding the hashes from previous runs
+    :param ledger     : UploadLedger object recording the files already imported
+
+    Return value: True if there is nothing new to upload
+    """
+    found_files = list_files(dir_path)
+    if len(found_files) == 0:
+        return False
+    for (f, fullname) in found_files:
+        hash_value = hash_cache.lookup(fullname, os.stat(fullname))
+        if hash_value is None or not ledger.is_imported(hash_value):
+            return False
+    return True
+
+
+class UploadLedger:
+    """
+     Record of every file content hash sent to SleepHQ, the import it was sent
+     with and the last known status of that import.  Used to skip files SleepHQ
+     has already imported.
+    """
+
+    def __init__(self, ledger_file):
+        """
+        Construct a new UploadLedger object.
+
+        :param ledger_file : The JSON file used to store the ledger
+        """
+        self.ledger_file = ledger_file
+        self.entries = load_json_file(ledger_file, {})
+        self.changed = set()
+
+    def is_imported(self, file_hash):
+        """
+        Has a file with this content hash already been imported successfully?
+
+        :param file_hash : SleepHQ content hash of the file
+        """
+        entry = self.entries.get(file_hash)
+        return entry is not None and entry['status'] == "complete"
+
+    def record(self, file_hash, short_name, import_id, status):
+        """
+        Record the status of a file upload
+
+        :param file_hash  : SleepHQ content hash of the file
+        :param short_name : The filename that was uploaded
+        :param import_id  : The import ID the file was uploaded with
+        :param status     : The upload or import status
+        """
+        self.entries[file_hash] = {'name': short_name,
+                                   'import_id': import_id,
+                                   'status': status,
+                                   'updated': int(time.time())}
+        self.changed.add(file_hash)
+
+    def save(self):
+        """
+        Write the changed entries back to disk, keeping the entries recorded by
+        other processes since the ledger was loaded
+        """
+        def merge(entries):
+            for file_hash in self.changed:
+                entry = self.entries[file_hash]
+                # the later of two records of the same file wins
+                if entry['updated'] >= entries.get(file_hash, {}).get('updated', 0):
+                    entries[file_hash] = entry
+        self.entries = update_json_file(self.ledger_file, merge)
+        self.changed = set()
+
+
+class CredentialCache:
+    """
+     Keeps the SleepHQ bearer token and the machine ID found for the device
+     serial number between runs, so a normal run needs no API calls for them.
+     The file holds a secret so it is only readable by its owner.  One cache
+     can be shared by the device threads of prisma_fleet.py.
+    """
+
+    def __init__(self, cache_file, expiry_margin=300):
+        """
+        Construct a new CredentialCache object.
+
+        :param cache_file    : The JSON file used to store the cache
+        :param expiry_margin : Treat tokens as expired this many seconds early
+        """
+        self.cache_file = cache_file
+        self.expiry_margin = expiry_margin
+        self.entries = load_json_file(cache_file, {})
+        self.lock = threading.RLock()
+
+    def _client(self, client_id):
+        return self.entries.setdefault(client_id, {'machines': {}})
+
+    def get_token(self, client_id):
+        """
+        Return the cached 'Bearer ...' token for a client, or None if there is no
+        token or it is about to expire
+        """
+        client = self.entries.get(client_id, {})
+        if client.get('token') and client.get('expires_at', 0) - self.expiry_margin > time.time():
+            return client['token']
+        return None
+
+    def store_token(self, client_id, token, expires_in):
+        """
+        Record a new token
+
+        :param client_id  : The client UUID the token was issued to
+        :param token      : The 'Bearer ...' authorization header value
+        :param expires_in : Lifetime of the token in seconds
+        """
+        with self.lock:
+            client = self._client(client_id)
+            client['token'] = token
+            client['expires_at'] = int(time.time() + expires_in)
+            self.save()
+
+    def invalidate_token(self, client_id):
+        """
+        Forget the token of a client, e.g. after SleepHQ rejected it
+        """
+        with self.lock:
+            client = self.entries.get(client_id)
+            if client is not None and 'token' in client:
+                del client['token']
+                self.save()
+
+    @staticmethod
+    def _machine_key(team_id, serial_number):
+        # JSON object keys must be strings
+        return f"{team_id}/{serial_number}"
+
+    def get_machine_id(self, client_id, team_id, serial_number):
+        """
+        Return the cached machine ID for a device serial number, or None
+        """
+        machines = self.entries.get(client_id, {}).get('machines', {})
+        machine = machines.get(self._machine_key(team_id, serial_number))
+        return None if machine is None else machine['machine_id']
+
+    def store_machine_id(self, client_id, team_id, serial_number, machine_id):
+        """
+        Record the machine ID of a device serial number.  Each device of a team
+        has its own entry, so fleet devices sharing a team don't replace each other's
+        """
+        with self.lock:
+            self._client(client_id)['machines'][self._machine_key(team_id, serial_number)] = \
+                {'serial': serial_number, 'machine_id': machine_id}
+            self.save()
+
+    def save(self):
+        """
+        Write the cache back to disk
+        """
+        with self.lock:
+            save_json_file(self.cache_file, self.entries, mode=0o600)
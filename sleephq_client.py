@@ -0,0 +1,638 @@
+""" SleepHQ HTTP plumbing
+
+A single requests.Session shared by all SleepHQ API calls so TLS connections
+are reused, and an adaptive rate limiter that lets requests run at full speed
+until SleepHQ answers with HTTP 429 (Too Many Requests), then slows down and
+honours any Retry-After header.
+
+When a cached bearer token is rejected with HTTP 401 the shared session fetches
+a new token through the refresher registered with set_auth_refresher and sends
+the request again.
+
+Every SleepHQ API call goes through the shared SleepHQClient, which gives each
+endpoint its own connect and read timeouts, retries with jittered backoff where
+sending the request again is safe, fails fast through a circuit breaker while
+SleepHQ is down and keeps latency counters per endpoint.
+
+MultipartUpload streams a file upload from disk in fixed size blocks instead
+of letting requests build the whole multipart body in memory, and can work out
+the SleepHQ content hash from the same read.
+"""
+import email.utils
+import json
+import os
+import random
+import threading
+import time
+import uuid
+from urllib.parse import urlsplit
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.exceptions import NewConnectionError
+
+from sleephq_hash import ContentHasher
+
+# SleepHQ server used unless set_base_url is called
+DEFAULT_BASE_URL = "https://sleephq.com"
+
+# Number of files uploaded in parallel
+UPLOAD_WORKERS = 2
+
+# Size of each block read from disk while streaming an upload, this is the
+# most file data held in memory at any time per upload
+STREAM_BLOCK_SIZE = 64 * 1024
+
+# Length of an MD5 hex digest
+HASH_LENGTH = 32
+
+# (connect, read) timeouts in seconds of each API endpoint
+ENDPOINT_TIMEOUTS = {
+    'token': (3.05, 20),
+    'teams': (3.05, 20),
+    'machines': (3.05, 20),
+    'reserve_import': (3.05, 30),
+    'files': (3.05, 120),
+    'process_files': (3.05, 60),
+    'import_status': (3.05, 20),
+}
+DEFAULT_TIMEOUT = (3.05, 30)
+# Attempts at an API call before its failure is passed on
+API_ATTEMPTS = 4
+# Backoff between attempts: random up to RETRY_BASE_DELAY * 2 ** attempt, at most RETRY_MAX_DELAY
+RETRY_BASE_DELAY = 1.0
+RETRY_MAX_DELAY = 30.0
+# Responses that mean the server did not handle the request and it may be sent again
+RETRY_STATUSES = (500, 502, 503, 504)
+# Methods that can be sent twice without changing the result
+IDEMPOTENT_METHODS = ("GET", "HEAD", "OPTIONS", "PUT", "DELETE")
+# Consecutive failures that open the circuit breaker, and seconds before it lets a call try again
+BREAKER_THRESHOLD = 5
+BREAKER_RESET = 30.0
+
+_base_url = DEFAULT_BASE_URL
+_pool_size = UPLOAD_WORKERS + 2
+_session = None
+_session_lock = threading.Lock()
+_client = None
+# Most header dictionaries kept for token refreshes, and most rejected tokens
+# remembered with their replacement, the oldest are forgotten first
+MAX_AUTH_REFRESHERS = 32
+
+_auth_refreshers = {}
+_replaced_tokens = {}
+_auth_lock = threading.Lock()
+_auth_state = threading.local()
+_metrics = None
+
+
+def set_base_url(base_url):
+    """
+    Send API calls to another server, e.g. sleephq_standin.py for testing
+
+    :param base_url : scheme, host and optional port such as http://127.0.0.1:8080
+    """
+    global _base_url
+    _base_url = base_url.rstrip('/')
+
+
+def api_url(path):
+    """
+    Return the full URL of a SleepHQ API path
+
+    :param path : The path starting with /, e.g. /api/v1/teams
+    """
+    return _base_url + path
+
+
+def set_pool_size(pool_size):
+    """
+    Keep more connections open, e.g. when several devices upload at once.
+    Must be called before the first API call
+
+    :param pool_size : connections kept per host
+    """
+    global _pool_size
+    _pool_size = pool_size
+
+
+def get_session():
+    """
+    Return the shared requests.Session, creating it on first use
+
+    Return value: a requests.Session with a connection pool large enough for
+                  the upload workers
+    """
+    global _session
+    with _session_lock:
+        if _session is None:
+            _session = requests.Session()
+            adapter = HTTPAdapter(pool_connections=2, pool_maxsize=_pool_size)
+            _session.mount('https://', adapter)
+            _session.mount('http://', adapter)
+            # metrics first so the rejected response of a 401 retry is recorded too
+            _session.hooks['response'].append(_record_metrics)
+            _session.hooks['response'].append(_retry_unauthorized)
+        return _session
+
+
+def set_metrics(metrics):
+    """
+    Record every HTTP call made through the shared session
+
+    :param metrics : a prisma_metrics.Metrics object, None to stop recording
+    """
+    global _metrics
+    _metrics = metrics
+
+
+def _record_metrics(response, *args, **kwargs):
+    """
+    Session response hook passing the details of each call to the Metrics object
+    """
+    if _metrics is None:
+        return response
+    request = response.request
+    retry = response.status_code == 429 or (response.status_code == 401 and
+                                            'Authorization' in request.headers)
+    _metrics.observe_http(request.method, urlsplit(request.url).path, response.status_code,
+                          response.elapsed.total_seconds(),
+                          int(request.headers.get('Content-Length', 0)), retry)
+    return response
+
+
+def set_auth_refresher(headers, fetch_token):
+    """
+    Register how to get a new bearer token when SleepHQ rejects the current one.
+    Several header dictionaries can be registered, e.g. one per device in fleet mode
+
+    :param headers     : The JSON headers dictionary used for API calls, its
+                         Authorization entry is updated with the new token
+    :param fetch_token : Function without arguments returning a new 'Bearer ...' token
+    """
+    with _auth_lock:
+        _auth_refreshers.pop(id(headers), None)
+        _auth_refreshers[id(headers)] = (headers, fetch_token)
+        while len(_auth_refreshers) > MAX_AUTH_REFRESHERS:
+            del _auth_refreshers[next(iter(_auth_refreshers))]
+
+
+def refresh_authorization(rejected_token):
+    """
+    Replace a token SleepHQ rejected.  When several requests are rejected at the
+    same time only the first one fetches a new token, and every registered header
+    dictionary holding the rejected token is updated
+
+    :param rejected_token : The 'Bearer ...' value that was rejected
+
+    Return value: the new 'Bearer ...' token, or None if no refresher is registered for it
+    """
+    with _auth_lock:
+        if rejected_token in _replaced_tokens:
+            return _replaced_tokens[rejected_token]
+        new_token = None
+        for headers, fetch_token in list(_auth_refreshers.values()):
+            if headers.get('Authorization') == rejected_token:
+                if new_token is None:
+                    new_token = fetch_token()
+                headers['Authorization'] = new_token
+        if new_token is not None:
+            # only requests still in flight with a recently rejected token need the
+            # replacement, a resident service must not keep every token ever used
+            _replaced_tokens[rejected_token] = new_token
+            while len(_replaced_tokens) > MAX_AUTH_REFRESHERS:
+                del _replaced_tokens[next(iter(_replaced_tokens))]
+        return new_token
+
+
+def _retry_unauthorized(response, *args, **kwargs):
+    """
+    Session response hook that sends a request again with a new token after a 401.
+    Streamed bodies can't be sent twice, their callers handle the 401 themselves
+    """
+    request = response.request
+    rejected_token = request.headers.get('Authorization')
+    if (response.status_code != 401 or rejected_token is None or hasattr(request.body, 'read')
+            or getattr(_auth_state, 'retrying', False)):
+        return response
+    _auth_state.retrying = True
+    try:
+        new_token = refresh_authorization(rejected_token)
+        if new_token is None:
+            return response
+        retry = request.copy()
+        retry.headers['Authorization'] = new_token
+        return get_session().send(retry, **kwargs)
+    finally:
+        _auth_state.retrying = False
+
+
+def parse_retry_after(value):
+    """
+    Convert a Retry-After header into a number of seconds
+
+    :param value : The header value, either delta seconds or an HTTP date
+
+    Return value: seconds to wait, or None if the header is missing or invalid
+    """
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        retry_at = email.utils.parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    return max(0.0, retry_at.timestamp() - time.time())
+
+
+class CircuitOpenError(requests.ConnectionError):
+    """
+     Raised instead of sending a request while the circuit breaker is open.  It
+     is a requests.RequestException so callers handle it like SleepHQ being down
+    """
+
+
+def request_not_sent(error):
+    """
+    Return value: True if the request certainly did not reach the server, so
+                  sending it again can't do anything twice
+    """
+    if isinstance(error, (requests.ConnectTimeout, CircuitOpenError)):
+        return True
+    reason = getattr(error.args[0], 'reason', None) if error.args else None
+    return isinstance(error, requests.ConnectionError) and isinstance(reason, NewConnectionError)
+
+
+class CircuitBreaker:
+    """
+     Counts consecutive failed API calls.  After threshold failures the breaker
+     opens and calls fail straight away with CircuitOpenError.  Once reset_timeout
+     seconds have passed a single call is let through: if it succeeds the breaker
+     closes, if it fails the breaker stays open for another reset_timeout
+    """
+
+    def __init__(self, threshold=BREAKER_THRESHOLD, reset_timeout=BREAKER_RESET):
+        """
+        Construct a new CircuitBreaker object.
+
+        :param threshold     : consecutive failures that open the breaker
+        :param reset_timeout : seconds the breaker stays open before a call may try again
+        """
+        self.threshold = threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.opened_at = None
+        self.trial_at = None
+        self.lock = threading.Lock()
+
+    @property
+    def state(self):
+        with self.lock:
+            if self.opened_at is None:
+                return "closed"
+            return "open" if time.monotonic() - self.opened_at < self.reset_timeout else "half-open"
+
+    def before_call(self, name):
+        """
+        Raise CircuitOpenError unless a call may be made now
+
+        :param name : the endpoint, used in the error message
+        """
+        with self.lock:
+            if self.opened_at is None:
+                return
+            now = time.monotonic()
+            # one trial call at a time, a trial that never reported back is replaced
+            if (now - self.opened_at >= self.reset_timeout and
+                    (self.trial_at is None or now - self.trial_at >= self.reset_timeout)):
+                self.trial_at = now
+                return
+            raise CircuitOpenError(f"SleepHQ failed {self.failures} times in a row, not calling {name} " +
+                                   f"for up to {self.reset_timeout - (now - self.opened_at):.0f}s")
+
+    def succeeded(self):
+        with self.lock:
+            self.failures = 0
+            self.opened_at = None
+            self.trial_at = None
+
+    def failed(self):
+        with self.lock:
+            self.failures += 1
+            if self.trial_at is not None or self.failures >= self.threshold:
+                self.opened_at = time.monotonic()
+                self.trial_at = None
+
+
+class SleepHQClient:
+    """
+     Sends SleepHQ API calls over the shared session.  Each call is named after
+     its endpoint, which selects its timeouts and labels its latency counters.
+
+     Calls that failed with a connection error, a timeout or a 5xx response are
+     sent again after a jittered backoff when that is safe: always if the request
+     never reached SleepHQ, otherwise only for idempotent calls.  HTTP 429 is
+     retried after the Retry-After time.  Streamed bodies are sent only once, their
+     callers retry themselves.  The response of the last attempt is returned, so
+     callers still see the status code and call raise_for_status() as before
+    """
+
+    def __init__(self, session=None, timeouts=None, attempts=API_ATTEMPTS, breaker=None):
+        """
+        Construct a new SleepHQClient object.
+
+        :param session  : requests.Session to use, defaults to the shared session
+        :param timeouts : dictionary of endpoint name to (connect, read) timeouts,
+                          defaults to ENDPOINT_TIMEOUTS
+        :param attempts : attempts at a call before its failure is passed on
+        :param breaker  : CircuitBreaker shared by all endpoints
+        """
+        self.session = session
+        self.timeouts = ENDPOINT_TIMEOUTS if timeouts is None else timeouts
+        self.attempts = attempts
+        self.breaker = breaker or CircuitBreaker()
+        self.counters = {}
+        self.lock = threading.Lock()
+
+    def _count(self, name, seconds=None, error=False, retry=False):
+        with self.lock:
+            counter = self.counters.setdefault(name, {'calls': 0, 'errors': 0, 'retries': 0,
+                                                      'seconds': 0.0, 'max_seconds': 0.0})
+            if seconds is not None:
+                counter['calls'] += 1
+                counter['seconds'] += seconds
+                counter['max_seconds'] = max(counter['max_seconds'], seconds)
+            if error:
+                counter['errors'] += 1
+            if retry:
+                counter['retries'] += 1
+
+    def latency(self):
+        """
+        Return value: dictionary of endpoint name to its calls, errors, retries,
+                      total, mean and longest seconds
+        """
+        with self.lock:
+            return {name: dict(counter, mean_seconds=counter['seconds'] / counter['calls']
+                               if counter['calls'] else 0.0)
+                    for name, counter in self.counters.items()}
+
+    def log_latency(self, logger):
+        """
+        Write the latency counters and the breaker state to the log as a JSON record
+        """
+        logger.info(json.dumps({'type': "client", 'breaker': self.breaker.state,
+                                'endpoints': {name: {key: round(value, 4) for key, value in counter.items()}
+                                              for name, counter in self.latency().items()}},
+                               sort_keys=True))
+
+    def request(self, name, method, url, idempotent=None, **kwargs):
+        """
+        Send an API call, retrying it where that is safe
+
+        :param name       : the endpoint name, e.g. "import_status", see ENDPOINT_TIMEOUTS
+        :param method     : HTTP method
+        :param url        : the full URL
+        :param idempotent : whether sending the call twice is harmless, defaults to
+                            True for GET and the other idempotent methods
+        :param kwargs     : passed on to requests.Session.request
+
+        Return value: the requests.Response of the last attempt.  requests.RequestException
+                      is raised if no response was received, CircuitOpenError while
+                      the circuit breaker is open
+        """
+        if idempotent is None:
+            idempotent = method.upper() in IDEMPOTENT_METHODS
+        kwargs.setdefault('timeout', self.timeouts.get(name, DEFAULT_TIMEOUT))
+        attempts = 1 if hasattr(kwargs.get('data'), 'read') else self.attempts
+        session = self.session or get_session()
+        for attempt in range(attempts):
+            self.breaker.before_call(name)
+            start = time.monotonic()
+            try:
+                response = session.request(method, url, **kwargs)
+            except requests.RequestException as e:
+                self._count(name, time.monotonic() - start, error=True)
+                self.breaker.failed()
+                # a breaker opened by this failure ends the retries with the failure itself
+                if (attempt + 1 >= attempts or not (idempotent or request_not_sent(e)) or
+                        self.breaker.state == "open"):
+                    raise
+                delay = self.backoff(attempt)
+            else:
+                server_error = response.status_code >= 500
+                self._count(name, time.monotonic() - start, error=server_error)
+                if server_error:
+                    self.breaker.failed()
+                else:
+                    self.breaker.succeeded()
+                if response.status_code == 429:
+                    delay = parse_retry_after(response.headers.get('Retry-After'))
+                    delay = self.backoff(attempt) if delay is None else delay
+                elif idempotent and response.status_code in RETRY_STATUSES:
+                    delay = self.backoff(attempt)
+                else:
+                    return response
+                if attempt + 1 >= attempts or delay > RETRY_MAX_DELAY or self.breaker.state == "open":
+                    return response
+                response.close()
+            self._count(name, retry=True)
+            time.sleep(delay)
+
+    def backoff(self, attempt):
+        """
+        Return value: seconds to wait before the next attempt, with full jitter
+        """
+        return random.uniform(0, min(RETRY_MAX_DELAY, RETRY_BASE_DELAY * 2 ** attempt))
+
+    def get(self, name, url, **kwargs):
+        return self.request(name, "GET", url, **kwargs)
+
+    def post(self, name, url, **kwargs):
+        return self.request(name, "POST", url, **kwargs)
+
+
+def get_client():
+    """
+    Return the shared SleepHQClient, creating it on first use
+    """
+    global _client
+    with _session_lock:
+        if _client is None:
+            _client = SleepHQClient()
+        return _client
+
+
+class RateLimiter:
+    """
+     Token bucket rate limiter shared by the upload workers.
+
+     The bucket starts at max_rate.  Every HTTP 429 halves the rate and blocks
+     all callers until the Retry-After time has passed, every success nudges the
+     rate back up towards max_rate.
+    """
+
+    def __init__(self, max_rate=10.0, burst=UPLOAD_WORKERS, min_rate=0.2, clock=time.monotonic,
+                 sleep=time.sleep):
+        """
+        Construct a new RateLimiter object.
+
+        :param max_rate : Requests per second allowed when SleepHQ is not pushing back
+        :param burst    : Number of requests that may be sent back to back
+        :param min_rate : The rate never drops below this many requests per second
+        :param clock    : function returning the current time in seconds, e.g. a fake clock for testing
+        :param sleep    : function waiting a number of seconds on that clock
+        """
+        self.max_rate = max_rate
+        self.min_rate = min_rate
+        self.rate = max_rate
+        self.burst = burst
+        self.clock = clock
+        self.sleep = sleep
+        self.tokens = float(burst)
+        self.last = clock()
+        self.blocked_until = 0.0
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        """
+        Block until a request may be sent
+        """
+        while True:
+            with self.lock:
+                now = self.clock()
+                self.tokens = min(self.burst, self.tokens + (now - self.last) * self.rate)
+                self.last = now
+                if now >= self.blocked_until and self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = max(self.blocked_until - now, (1 - self.tokens) / self.rate)
+            self.sleep(wait)
+
+    def throttled(self, retry_after=None):
+        """
+        Tell the limiter SleepHQ answered with HTTP 429
+
+        :param retry_after : seconds to wait as given by the Retry-After header, if any
+        """
+        with self.lock:
+            self.rate = max(self.min_rate, self.rate / 2)
+            self.tokens = 0.0
+            delay = retry_after if retry_after is not None else 1 / self.rate
+            self.blocked_until = max(self.blocked_until, self.clock() + delay)
+
+    def succeeded(self):
+        """
+        Tell the limiter a request went through
+        """
+        with self.lock:
+            self.rate = min(self.max_rate, self.rate * 1.25)
+
+
+class MultipartUpload:
+    """
+     A multipart/form-data body for the SleepHQ import files endpoint that is
+     generated while it is being sent.  requests sees a file like object with a
+     known length, so the upload goes out with a Content-Length header and the
+     file is read one block at a time.
+
+     When no content hash is supplied it is calculated while the file part is
+     sent.  The content_hash part comes after the file part so its value is
+     known by the time it is needed, and a hex digest is always 32 characters
+     so the body length is known up front.
+    """
+
+    def __init__(self, import_id, short_name, full_file_name, file_hash=None):
+        """
+        Construct a new MultipartUpload object.
+
+        :param import_id      : The import identifier previously obtained
+        :param short_name     : The filename of the file to upload
+        :param full_file_name : The full path and filename of the file to upload
+        :param file_hash      : The SleepHQ content hash, None to calculate it while sending
+        """
+        self.boundary = uuid.uuid4().hex
+        self.full_file_name = full_file_name
+        self.file_hash = file_hash
+        self.hasher = None if file_hash is not None else ContentHasher(short_name)
+        self.file = open(full_file_name, 'rb')
+        self.file_stat = os.fstat(self.file.fileno())
+        self.head = (self._part('import_id', str(import_id), 'import_id') +
+                     self._part('name', short_name) +
+                     self._part('path', "./") +
+                     self._part_header('file', short_name))
+        self.tail_length = len(self._tail('0' * HASH_LENGTH))
+        self.length = len(self.head) + self.file_stat.st_size + self.tail_length
+        self.chunks = iter(self)
+        self.buffer = bytearray()
+
+    @property
+    def content_type(self):
+        return f"multipart/form-data; boundary={self.boundary}"
+
+    def _part_header(self, name, filename=None):
+        disposition = f'form-data; name="{name}"'
+        if filename is not None:
+            disposition += f'; filename="{filename}"'
+        return (f"--{self.boundary}\r\n"
+                f"Content-Disposition: {disposition}\r\n\r\n").encode('utf-8')
+
+    def _part(self, name, value, filename=None):
+        return self._part_header(name, filename) + value.encode('utf-8') + b"\r\n"
+
+    def _tail(self, file_hash):
+        return (b"\r\n" + self._part('content_hash', file_hash) +
+                f"--{self.boundary}--\r\n".encode('utf-8'))
+
+    def __len__(self):
+        return self.length
+
+    def __iter__(self):
+        """
+        Generate the body one block at a time
+        """
+        yield self.head
+        sent = 0
+        while sent < self.file_stat.st_size:
+            block = self.file.read(min(STREAM_BLOCK_SIZE, self.file_stat.st_size - sent))
+            if not block:
+                break
+            sent += len(block)
+            if self.hasher is not None:
+                self.hasher.update(block)
+            yield block
+        self.file.close()
+        if sent != self.file_stat.st_size:
+            raise OSError(f"{self.full_file_name} changed size during the upload")
+        if self.hasher is not None:
+            self.file_hash = self.hasher.hexdigest()
+        yield self._tail(self.file_hash)
+
+    def read(self, size=-1):
+        """
+        Return up to size bytes of the body, as used by http.client when sending it
+        """
+        if not self.buffer and 0 <= size:
+            # a block that fits is handed out as it is, without copying it
+            chunk = next(self.chunks, b'')
+            if len(chunk) <= size:
+                return chunk
+            self.buffer += chunk
+        while size < 0 or len(self.buffer) < size:
+            chunk = next(self.chunks, None)
+            if chunk is None:
+                break
+            self.buffer += chunk
+        if size < 0:
+            size = len(self.buffer)
+        # http.client reads 8 KiB at a time, deleting from the front of a
+        # bytearray doesn't copy the rest of the block on every read
+        data = bytes(self.buffer[:size])
+        del self.buffer[:size]
+        return data
+
+    def close(self):
+        self.file.close()
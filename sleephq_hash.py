@@ -0,0 +1,569 @@
+""" SleepHQ content hash engine
+
+SleepHQ expects the content hash of an uploaded file to be the MD5 of the file
+data with every byte treated as a unicode code point and UTF-8 encoded (so bytes
+0x80-0xFF expand to two bytes), followed by the UTF-8 encoded file name.  Please
+refer to the /v1/imports/files/calculate_content_hash information at
+https://sleephq.com/api-docs/index.html
+
+Treating each byte as a code point is exactly what the latin-1 codec does, so the
+transform can be done on a whole buffer at C speed with
+chunk.decode('latin-1').encode('utf-8') rather than a per-byte python loop.
+
+HashCache keeps the hashes of unchanged files between runs.  For large files it
+also keeps a checkpoint of the hash so that when therapy.pdat has only been
+appended to, just the new data is hashed (calculate_content_hash_incremental).
+The previously hashed part is still read in full and compared with the plain
+MD5 held in the checkpoint, which costs far less than the transform and MD5 of
+the content hash.  transfer_data.py resumes from the checkpoint of the last
+snapshot in the same way while it copies the card (CheckpointContentHasher).
+
+This module only relies on the python standard library so it can be used by
+transfer_data.py as well as the uploader.
+"""
+import ctypes
+import hashlib
+import math
+import mmap
+import os
+import struct
+import time
+
+from prisma_state import load_json_file, update_json_file
+
+# Size of each read from disk.  Large reads keep the number of system calls and
+# interpreter round trips down; the UTF-8 expansion at most doubles this in memory
+CHUNK_SIZE = 1024 * 1024
+
+# Files smaller than this are always hashed in full, a checkpoint isn't worth keeping
+INCREMENTAL_MIN_SIZE = 256 * 1024
+
+
+def transform_chunk(chunk):
+    """
+    Apply the SleepHQ byte transform to a chunk of raw file data
+
+    :param chunk : bytes read from the file
+
+    Return value: the bytes to feed into the MD5 hasher
+    """
+    if chunk.isascii():
+        # Bytes 0x00-0x7F encode to themselves, nothing to expand
+        return chunk
+    return chunk.decode('latin-1').encode('utf-8')
+
+
+class ContentHasher:
+    """
+     Incrementally builds a SleepHQ content hash from raw file data.
+     Used where the file data is already being read for another purpose
+     (copying or uploading) so the file does not have to be read twice
+    """
+
+    def __init__(self, short_name):
+        """
+        Construct a new ContentHasher object.
+
+        :param short_name : The filename that is appended to the hash
+        """
+        self.short_name = short_name
+        self.hasher = hashlib.md5()
+        self.length = 0
+
+    def update(self, chunk):
+        """
+        Add a chunk of raw file data to the hash
+
+        :param chunk : the next chunk of raw file data
+        """
+        self.length += len(chunk)
+        self.hasher.update(transform_chunk(chunk))
+
+    def hexdigest(self):
+        """
+        Return the SleepHQ content hash of the data seen so far.  The hasher
+        can still be updated afterwards.
+        """
+        final = self.hasher.copy()
+        final.update(self.short_name.encode('utf-8'))
+        return final.hexdigest()
+
+
+def calculate_content_hash(full_file_name, use_mmap=False, chunk_size=CHUNK_SIZE, short_name=None):
+    """
+    Create a SleepHQ API compliant file hash
+
+    :param full_file_name : The full path of the file to create the MD5 hash from
+    :param use_mmap       : Map the file into memory rather than reading it in chunks
+    :param chunk_size     : Number of bytes processed per step
+    :param short_name     : The filename appended to the hash, the name of the file if None
+
+    Return value: a SleepHQ API compliant hash
+    """
+    hasher = ContentHasher(short_name or os.path.basename(full_file_name))
+    with open(full_file_name, 'rb') as f:
+        if use_mmap and os.fstat(f.fileno()).st_size > 0:
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+                for offset in range(0, len(mapped), chunk_size):
+                    hasher.update(mapped[offset:offset + chunk_size])
+        else:
+            for chunk in iter(lambda: f.read(chunk_size), b''):
+                hasher.update(chunk)
+    return hasher.hexdigest()
+
+
+class HashCache:
+    """
+     Persistent cache of SleepHQ content hashes so unchanged files are not
+     hashed again on every run.  Entries are keyed by the full path and are only
+     used while the size, modification time and inode of the file still match.
+    """
+
+    def __init__(self, cache_file, rehash=False, max_age_days=30, incremental=True, full_verify=True):
+        """
+        Construct a new HashCache object.
+
+        :param cache_file   : The JSON file used to store the cache
+        :param rehash       : Ignore all cached values and hash every file again
+        :param max_age_days : Entries not used for this many days are evicted
+        :param incremental  : Only hash the data appended to a large file since it was last hashed
+        :param full_verify  : Read the whole previously hashed part of a file to check it is
+                              unchanged.  False only samples it, which misses changes
+                              outside the sampled windows
+        """
+        self.cache_file = cache_file
+        self.rehash = rehash
+        self.incremental = incremental and not rehash
+        self.full_verify = full_verify
+        self.max_age = max_age_days * 86400
+        self.entries = load_json_file(cache_file, {})
+        # names stored or used, and names evicted, since the cache was loaded
+        self.changed = set()
+        self.evicted = {}
+
+    @staticmethod
+    def _signature(file_stat):
+        return [file_stat.st_size, file_stat.st_mtime_ns, file_stat.st_ino]
+
+    def lookup(self, full_file_name, file_stat):
+        """
+        Return the cached hash of a file, or None if it has to be hashed
+
+        :param full_file_name : The full path of the file
+        :param file_stat      : os.stat() result for the file
+        """
+        entry = self.entries.get(full_file_name)
+        if self.rehash or entry is None or entry['sig'] != self._signature(file_stat):
+            return None
+        entry['used'] = int(time.time())
+        self.changed.add(full_file_name)
+        return entry['hash']
+
+    def store(self, full_file_name, file_stat, file_hash, checkpoint=None):
+        """
+        Record the hash of a file
+
+        :param full_file_name : The full path of the file
+        :param file_stat      : os.stat() result taken before the file was hashed
+        :param file_hash      : The SleepHQ content hash of the file
+        :param checkpoint     : Optional checkpoint to resume hashing from if the file grows
+        """
+        entry = {'sig': self._signature(file_stat),
+                 'hash': file_hash,
+                 'used': int(time.time())}
+        if checkpoint is not None:
+            entry['checkpoint'] = checkpoint
+        self.entries[full_file_name] = entry
+        self.changed.add(full_file_name)
+
+    def get_hash(self, full_file_name):
+        """
+        Return the SleepHQ content hash of a file, from the cache when the file
+        is unchanged, otherwise by hashing it and caching the result
+
+        :param full_file_name : The full path of the file
+        """
+        file_stat = os.stat(full_file_name)
+        file_hash = self.lookup(full_file_name, file_stat)
+        if file_hash is not None:
+            return file_hash
+        checkpoint = None
+        if self.incremental and file_stat.st_size >= INCREMENTAL_MIN_SIZE:
+            previous = self.entries.get(full_file_name, {}).get('checkpoint')
+            file_hash, checkpoint = calculate_content_hash_incremental(full_file_name, previous,
+                                                                       self.full_verify)
+        else:
+            file_hash = calculate_content_hash(full_file_name)
+        self.store(full_file_name, file_stat, file_hash, checkpoint)
+        return file_hash
+
+    def evict(self):
+        """
+        Drop entries for files that no longer exist or have not been used recently
+        """
+        oldest = time.time() - self.max_age
+        for name in list(self.entries):
+            if self.entries[name]['used'] < oldest or not os.path.exists(name):
+                self.evicted[name] = self.entries.pop(name)['used']
+                self.changed.discard(name)
+
+    def save(self):
+        """
+        Evict stale entries and write the changes back to disk if there are any,
+        keeping the entries stored by other processes since the cache was loaded
+        """
+        self.evict()
+        if self.changed or self.evicted:
+            def merge(entries):
+                for name, used in self.evicted.items():
+                    # unless another process has used the file since
+                    if entries.get(name, {}).get('used', 0) <= used:
+                        entries.pop(name, None)
+                entries.update((name, self.entries[name]) for name in self.changed)
+            self.entries = update_json_file(self.cache_file, merge)
+            self.changed = set()
+            self.evicted = {}
+
+
+##############################
+# Resumable (checkpoint) MD5 #
+##############################
+# hashlib objects can't be saved to disk, so incremental hashing of the append
+# only therapy.pdat uses an MD5 whose internal state can be saved and restored.
+# OpenSSL's MD5_CTX is used through ctypes when libcrypto is available, with a
+# pure python implementation as the fallback.  Both use the same saved state:
+# the four MD5 registers, the number of bytes hashed and the bytes waiting to
+# fill the next 64 byte block.
+
+_MD5_SHIFTS = [7, 12, 17, 22] * 4 + [5, 9, 14, 20] * 4 + [4, 11, 16, 23] * 4 + [6, 10, 15, 21] * 4
+_MD5_CONSTANTS = [int(abs(math.sin(i + 1)) * 2 ** 32) & 0xFFFFFFFF for i in range(64)]
+_MD5_INITIAL = [0x67452301, 0xEFCDAB89, 0x98BADCFE, 0x10325476]
+
+
+def _md5_compress(registers, block):
+    """
+    Run the MD5 compression function over one 64 byte block
+    """
+    words = struct.unpack('<16I', block)
+    a, b, c, d = registers
+    for i in range(64):
+        if i < 16:
+            f = (b & c) | (~b & d)
+            g = i
+        elif i < 32:
+            f = (d & b) | (~d & c)
+            g = (5 * i + 1) % 16
+        elif i < 48:
+            f = b ^ c ^ d
+            g = (3 * i + 5) % 16
+        else:
+            f = c ^ (b | ~d)
+            g = (7 * i) % 16
+        f = (f + a + _MD5_CONSTANTS[i] + words[g]) & 0xFFFFFFFF
+        a, d, c = d, c, b
+        b = (b + ((f << _MD5_SHIFTS[i]) | (f >> (32 - _MD5_SHIFTS[i])))) & 0xFFFFFFFF
+    return [(x + y) & 0xFFFFFFFF for x, y in zip(registers, (a, b, c, d))]
+
+
+class _MD5Context(ctypes.Structure):
+    # MD5_CTX from openssl/md5.h
+    _fields_ = [('A', ctypes.c_uint32), ('B', ctypes.c_uint32),
+                ('C', ctypes.c_uint32), ('D', ctypes.c_uint32),
+                ('Nl', ctypes.c_uint32), ('Nh', ctypes.c_uint32),
+                ('data', ctypes.c_uint8 * 64), ('num', ctypes.c_uint)]
+
+
+def _load_libcrypto():
+    # ctypes.util runs ldconfig to find the library, so it is only done when first needed
+    import ctypes.util
+    try:
+        library = ctypes.CDLL(ctypes.util.find_library('crypto') or 'libcrypto.so')
+        for function in (library.MD5_Init, library.MD5_Update, library.MD5_Final):
+            function.restype = ctypes.c_int
+        library.MD5_Update.argtypes = [ctypes.POINTER(_MD5Context), ctypes.c_char_p, ctypes.c_size_t]
+        return library
+    except (OSError, AttributeError):
+        return None
+
+
+_libcrypto = None
+_libcrypto_loaded = False
+
+
+def _get_libcrypto():
+    """
+    Return value: libcrypto loaded on first use, None if it is not available
+    """
+    global _libcrypto, _libcrypto_loaded
+    if not _libcrypto_loaded:
+        _libcrypto = _load_libcrypto()
+        _libcrypto_loaded = True
+    return _libcrypto
+
+
+class ResumableMD5:
+    """
+     MD5 hasher whose state can be saved with state() and restored by passing
+     that state to the constructor
+    """
+
+    def __init__(self, state=None):
+        """
+        Construct a new ResumableMD5 object.
+
+        :param state : a state returned by state(), None to start a new hash
+        """
+        if state is None:
+            state = {'registers': _MD5_INITIAL, 'length': 0, 'pending': ""}
+        registers = list(state['registers'])
+        self.length = state['length']
+        pending = bytes.fromhex(state['pending'])
+        if _get_libcrypto() is not None:
+            self.context = _MD5Context()
+            self.context.A, self.context.B, self.context.C, self.context.D = registers
+            bits = self.length * 8
+            self.context.Nl = bits & 0xFFFFFFFF
+            self.context.Nh = bits >> 32
+            ctypes.memmove(self.context.data, pending, len(pending))
+            self.context.num = len(pending)
+        else:
+            self.context = None
+            self.registers = registers
+            self.pending = pending
+
+    @property
+    def native(self):
+        """
+        True when the fast OpenSSL implementation is in use
+        """
+        return self.context is not None
+
+    def update(self, data):
+        """
+        Add data to the hash
+        """
+        self.length += len(data)
+        if self.context is not None:
+            _libcrypto.MD5_Update(ctypes.byref(self.context), data, len(data))
+            return
+        data = self.pending + data
+        full_blocks = len(data) - len(data) % 64
+        for offset in range(0, full_blocks, 64):
+            self.registers = _md5_compress(self.registers, data[offset:offset + 64])
+        self.pending = data[full_blocks:]
+
+    def state(self):
+        """
+        Return the state of the hash as a JSON serialisable dictionary
+        """
+        if self.context is not None:
+            registers = [self.context.A, self.context.B, self.context.C, self.context.D]
+            pending = bytes(self.context.data)[:self.context.num]
+        else:
+            registers = list(self.registers)
+            pending = self.pending
+        return {'registers': registers, 'length': self.length, 'pending': pending.hex()}
+
+    def copy(self):
+        """
+        Return an independent copy of the hasher
+        """
+        return ResumableMD5(self.state())
+
+    def hexdigest(self):
+        """
+        Return the MD5 of the data added so far.  The hasher can still be updated afterwards
+        """
+        final = self.copy()
+        if final.context is not None:
+            digest = ctypes.create_string_buffer(16)
+            _libcrypto.MD5_Final(digest, ctypes.byref(final.context))
+            return digest.raw.hex()
+        bit_length = final.length * 8
+        padding = b'\x80' + b'\x00' * ((55 - final.length) % 64) + struct.pack('<Q', bit_length & (2 ** 64 - 1))
+        data = final.pending + padding
+        registers = final.registers
+        for offset in range(0, len(data), 64):
+            registers = _md5_compress(registers, data[offset:offset + 64])
+        return struct.pack('<4I', *registers).hex()
+
+
+# Number of windows of the already hashed prefix compared to detect a rewritten file
+VERIFY_WINDOWS = 16
+VERIFY_WINDOW_SIZE = 4096
+VERIFY_TAIL_SIZE = 64 * 1024
+
+
+def prefix_fingerprint(f, prefix_length):
+    """
+    MD5 of evenly spread windows of the first prefix_length bytes of a file plus
+    its last 64 KiB.  Used to check the prefix of an append only file has not
+    been rewritten without reading all of it.
+
+    :param f             : the file, opened in binary mode
+    :param prefix_length : number of bytes that were hashed before
+    """
+    hasher = hashlib.md5()
+    windows = [(prefix_length * i // VERIFY_WINDOWS, VERIFY_WINDOW_SIZE) for i in range(VERIFY_WINDOWS)]
+    windows.append((max(0, prefix_length - VERIFY_TAIL_SIZE), VERIFY_TAIL_SIZE))
+    for offset, length in windows:
+        f.seek(offset)
+        hasher.update(f.read(min(length, prefix_length - offset)))
+    return hasher.hexdigest()
+
+
+def prefix_md5(f, prefix_length, chunk_size=CHUNK_SIZE):
+    """
+    Plain MD5 of the first prefix_length bytes of a file
+
+    :param f             : the file, opened in binary mode
+    :param prefix_length : number of bytes to hash
+    :param chunk_size    : Number of bytes read per step
+    """
+    hasher = hashlib.md5()
+    f.seek(0)
+    remaining = prefix_length
+    while remaining > 0:
+        chunk = f.read(min(chunk_size, remaining))
+        if not chunk:
+            break
+        hasher.update(chunk)
+        remaining -= len(chunk)
+    return hasher.hexdigest()
+
+
+def calculate_content_hash_incremental(full_file_name, checkpoint=None, full_verify=True,
+                                       chunk_size=CHUNK_SIZE, short_name=None):
+    """
+    Create a SleepHQ API compliant file hash, only hashing the data appended to
+    the file since the checkpoint was taken.
+
+    The checkpoint holds the MD5 state after the SleepHQ byte transform but
+    before the filename is added.  Before it is used the already hashed prefix
+    is checked by reading all of it, or only sampling it without full_verify,
+    and the whole file is hashed again if the file was rewritten rather than
+    appended to.
+
+    :param full_file_name : The full path of the file to create the MD5 hash from
+    :param checkpoint     : The checkpoint returned by the previous call for this
+                            file, None to hash the whole file
+    :param full_verify    : Check the whole previously hashed prefix is unchanged.
+                            False only samples it, which misses changes outside the
+                            sampled windows
+    :param chunk_size     : Number of bytes processed per step
+    :param short_name     : The filename appended to the hash, the name of the file if None
+
+    Return value: a tuple of the SleepHQ API compliant hash and a new checkpoint,
+                  or None for the checkpoint if no fast resumable MD5 is available
+    """
+    short_file_name = short_name or os.path.basename(full_file_name)
+    with open(full_file_name, 'rb') as f:
+        size = os.fstat(f.fileno()).st_size
+        hasher = None
+        if checkpoint is not None and checkpoint['prefix_length'] <= size:
+            prefix_length = checkpoint['prefix_length']
+            raw_hasher = ResumableMD5(checkpoint['raw_md5'])
+            if full_verify:
+                unchanged = prefix_md5(f, prefix_length, chunk_size) == raw_hasher.hexdigest()
+            else:
+                unchanged = prefix_fingerprint(f, prefix_length) == checkpoint['fingerprint']
+            if unchanged:
+                hasher = ResumableMD5(checkpoint['md5'])
+                f.seek(prefix_length)
+        if hasher is None:
+            # no usable checkpoint, the file is new or has been rewritten
+            hasher = ResumableMD5()
+            if not hasher.native:
+                return calculate_content_hash(full_file_name, chunk_size=chunk_size,
+                                              short_name=short_file_name), None
+            raw_hasher = ResumableMD5()
+            f.seek(0)
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            raw_hasher.update(chunk)
+            hasher.update(transform_chunk(chunk))
+        prefix_length = f.tell()
+        new_checkpoint = {'prefix_length': prefix_length,
+                          'md5': hasher.state(),
+                          'raw_md5': raw_hasher.state(),
+                          'fingerprint': prefix_fingerprint(f, prefix_length)}
+    final = hasher.copy()
+    final.update(short_file_name.encode('utf-8'))
+    return final.hexdigest(), new_checkpoint
+
+
+class CheckpointContentHasher:
+    """
+     Builds a SleepHQ content hash from raw file data like ContentHasher, and a
+     checkpoint for calculate_content_hash_incremental.  Given the checkpoint of
+     an earlier snapshot of the file, the data up to the checkpoint is only
+     compared with the plain MD5 the checkpoint holds and the content hash is
+     resumed from there.  If that data differs, valid is False and the file has
+     to be hashed again.  Without the OpenSSL MD5 it works like ContentHasher
+     and makes no checkpoint
+    """
+
+    def __init__(self, short_name, checkpoint=None):
+        """
+        Construct a new CheckpointContentHasher object.
+
+        :param short_name : The filename that is appended to the hash
+        :param checkpoint : checkpoint of an earlier snapshot of the file, None to hash everything
+        """
+        self.short_name = short_name
+        self.length = 0
+        self.valid = True
+        self.native = _get_libcrypto() is not None
+        self.hasher = ResumableMD5() if self.native else hashlib.md5()
+        self.raw_hasher = ResumableMD5() if self.native else None
+        self.resume = checkpoint if self.native and checkpoint and checkpoint['prefix_length'] > 0 else None
+
+    def update(self, chunk):
+        """
+        Add the next chunk of raw file data
+
+        :param chunk : the next chunk of raw file data
+        """
+        if self.resume is not None:
+            prefix_length = self.resume['prefix_length']
+            head = chunk[:prefix_length - self.length]
+            self.length += len(head)
+            self.raw_hasher.update(head)
+            if self.length < prefix_length:
+                return
+            if self.raw_hasher.hexdigest() == ResumableMD5(self.resume['raw_md5']).hexdigest():
+                self.hasher = ResumableMD5(self.resume['md5'])
+            else:
+                self.valid = False
+            self.resume = None
+            chunk = chunk[len(head):]
+        self.length += len(chunk)
+        if self.raw_hasher is not None:
+            self.raw_hasher.update(chunk)
+        if self.valid:
+            self.hasher.update(transform_chunk(chunk))
+
+    def hexdigest(self):
+        """
+        Return the SleepHQ content hash of the data seen so far, or None if the
+        data did not start with the data of the checkpoint
+        """
+        if not self.valid or self.resume is not None:
+            return None
+        final = self.hasher.copy()
+        final.update(self.short_name.encode('utf-8'))
+        return final.hexdigest()
+
+    def checkpoint(self, file_name):
+        """
+        Return the checkpoint of the data seen so far, or None if there is none
+
+        :param file_name : a file holding that data, read for the fingerprint
+        """
+        if not self.native or not self.valid or self.resume is not None:
+            return None
+        with open(file_name, 'rb') as f:
+            fingerprint = prefix_fingerprint(f, self.length)
+        return {'prefix_length': self.length,
+                'md5': self.hasher.state(),
+                'raw_md5': self.raw_hasher.state(),
+                'fingerprint': fingerprint}
@@ -0,0 +1,271 @@
+""" Local SleepHQ API stand-in
+
+A small HTTP server implementing the parts of the SleepHQ API used by
+prisma20a_sleephq_uploader.py, plus an ntfy style topic endpoint, so the
+uploader can be exercised and measured without sleephq.com or ntfy.sh.
+Point the uploader at it with SLEEPHQ_BASE_URL (and NTFY_URL) in the .env file.
+
+Uploaded files are checked against their content_hash.  Latency, HTTP 429
+responses, server errors, slow processing and failed imports can be injected
+to see how the uploader copes.  Request counts and bytes received per endpoint
+are available from GET /_stats.
+
+Usage:
+    python3 sleephq_standin.py --port 8080 --latency 0.05 --rate-limit-every 3
+"""
+import argparse
+import json
+import random
+import re
+import threading
+import time
+from email.parser import BytesParser
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+from sleephq_hash import ContentHasher
+
+
+class StandinOptions:
+    """
+     The faults and delays injected by the stand-in server
+    """
+
+    def __init__(self, latency=0.0, rate_limit_every=0, retry_after=1, error_rate=0.0,
+                 processing_time=1.0, fail_imports=False, serial="STANDIN-0001"):
+        """
+        Construct a new StandinOptions object.
+
+        :param latency          : seconds added before every response
+        :param rate_limit_every : answer every Nth file upload with HTTP 429, 0 to disable
+        :param retry_after      : Retry-After seconds sent with HTTP 429
+        :param error_rate       : fraction of API requests answered with HTTP 500
+        :param processing_time  : seconds an import stays "processing" after process_files
+        :param fail_imports     : finish imports as "failed" instead of "complete"
+        :param serial           : serial number of the single machine on the team
+        """
+        self.latency = latency
+        self.rate_limit_every = rate_limit_every
+        self.retry_after = retry_after
+        self.error_rate = error_rate
+        self.processing_time = processing_time
+        self.fail_imports = fail_imports
+        self.serial = serial
+
+
+class StandinState:
+    """
+     Imports and request statistics shared by all request handler threads
+    """
+
+    def __init__(self, options):
+        self.options = options
+        self.lock = threading.Lock()
+        self.next_import_id = 1000
+        self.imports = {}
+        self.uploads = 0
+        self.stats = {}
+        self.notifications = []
+
+    def count(self, endpoint, bytes_received):
+        with self.lock:
+            entry = self.stats.setdefault(endpoint, {'requests': 0, 'bytes_received': 0})
+            entry['requests'] += 1
+            entry['bytes_received'] += bytes_received
+
+    def snapshot(self):
+        with self.lock:
+            return {'endpoints': json.loads(json.dumps(self.stats)),
+                    'imports': json.loads(json.dumps(self.imports)),
+                    'notifications': list(self.notifications)}
+
+
+# Routes as (method, path pattern, endpoint name used in the statistics)
+ROUTES = [
+    ('POST', r'/oauth/token', 'token'),
+    ('GET', r'/api/v1/teams', 'teams'),
+    ('GET', r'/api/v1/teams/(?P<team_id>[^/]+)/machines', 'machines'),
+    ('POST', r'/api/v1/teams/(?P<team_id>[^/]+)/imports', 'reserve_import'),
+    ('POST', r'/api/v1/imports/(?P<import_id>\d+)/files', 'files'),
+    ('POST', r'/api/v1/imports/(?P<import_id>\d+)/process_files', 'process_files'),
+    ('GET', r'/api/v1/imports/(?P<import_id>\d+)', 'import_status'),
+    ('GET', r'/_stats', 'stats'),
+    ('POST', r'/(?P<topic>[\w-]+)', 'ntfy'),
+]
+
+
+class StandinHandler(BaseHTTPRequestHandler):
+    """
+     Request handler, the shared StandinState is attached to the server
+    """
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        self.dispatch('GET')
+
+    def do_POST(self):
+        self.dispatch('POST')
+
+    def send_json(self, code, data, headers=None):
+        body = json.dumps(data).encode('utf-8')
+        self.send_response(code)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def dispatch(self, method):
+        state = self.server.state
+        options = state.options
+        body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        path = self.path.split('?')[0]
+        for route_method, pattern, endpoint in ROUTES:
+            match = re.fullmatch(pattern, path)
+            if route_method == method and match:
+                break
+        else:
+            self.send_json(404, {'error': 'not found'})
+            return
+        if endpoint == 'stats':
+            self.send_json(200, state.snapshot())
+            return
+        state.count(endpoint, len(body))
+        if options.latency:
+            time.sleep(options.latency)
+        if endpoint == 'ntfy':
+            with state.lock:
+                state.notifications.append({'topic': match['topic'], 'title': self.headers.get('Title'),
+                                            'message': body.decode('utf-8', 'replace')})
+            self.send_json(200, {})
+            return
+        if endpoint != 'token' and self.headers.get('Authorization') != "Bearer standin-token":
+            self.send_json(401, {'error': 'invalid token'})
+            return
+        if options.error_rate and random.random() < options.error_rate:
+            self.send_json(500, {'error': 'injected failure'})
+            return
+        getattr(self, 'handle_' + endpoint)(match, body)
+
+    def handle_token(self, match, body):
+        self.send_json(200, {'access_token': "standin-token", 'token_type': "Bearer",
+                             'expires_in': 7200})
+
+    def handle_teams(self, match, body):
+        self.send_json(200, {'data': [{'id': "1", 'attributes': {'name': "Stand-in team"}}]})
+
+    def handle_machines(self, match, body):
+        self.send_json(200, {'data': [{'id': "501", 'attributes': {
+            'brand': "Lowenstein", 'model': "Prisma 20a",
+            'serial_number': self.server.state.options.serial}}]})
+
+    def handle_reserve_import(self, match, body):
+        state = self.server.state
+        with state.lock:
+            import_id = state.next_import_id
+            state.next_import_id += 1
+            state.imports[str(import_id)] = {'status': "uploading", 'files': {},
+                                             'failed_reason': None, 'process_at': None}
+        self.send_json(201, {'data': {'id': import_id}})
+
+    def handle_files(self, match, body):
+        state = self.server.state
+        options = state.options
+        with state.lock:
+            state.uploads += 1
+            throttle = options.rate_limit_every and state.uploads % options.rate_limit_every == 0
+            import_entry = state.imports.get(match['import_id'])
+        if throttle:
+            self.send_json(429, {'error': 'slow down'}, {'Retry-After': str(options.retry_after)})
+            return
+        if import_entry is None:
+            self.send_json(404, {'error': 'unknown import'})
+            return
+        message = BytesParser().parsebytes(
+            b"Content-Type: " + self.headers.get('Content-Type', '').encode('utf-8') + b"\r\n\r\n" + body)
+        fields = {}
+        for part in message.get_payload():
+            fields[part.get_param('name', header='content-disposition')] = part.get_payload(decode=True)
+        name = fields.get('name', b'').decode('utf-8')
+        hasher = ContentHasher(name)
+        hasher.update(fields.get('file', b''))
+        if hasher.hexdigest() != fields.get('content_hash', b'').decode('utf-8'):
+            self.send_json(422, {'error': f"content_hash does not match {name}"})
+            return
+        with state.lock:
+            import_entry['files'][name] = len(fields.get('file', b''))
+        self.send_json(201, {'data': {'name': name}})
+
+    def handle_process_files(self, match, body):
+        state = self.server.state
+        with state.lock:
+            import_entry = state.imports.get(match['import_id'])
+            if import_entry is not None:
+                import_entry['status'] = "processing"
+                import_entry['process_at'] = time.time()
+        if import_entry is None:
+            self.send_json(404, {'error': 'unknown import'})
+        else:
+            self.send_json(200, {})
+
+    def handle_import_status(self, match, body):
+        state = self.server.state
+        options = state.options
+        with state.lock:
+            import_entry = state.imports.get(match['import_id'])
+            if import_entry is not None and import_entry['status'] == "processing" and \
+                    time.time() - import_entry['process_at'] >= options.processing_time:
+                if options.fail_imports:
+                    import_entry['status'] = "failed"
+                    import_entry['failed_reason'] = "injected failure"
+                else:
+                    import_entry['status'] = "complete"
+        if import_entry is None:
+            self.send_json(404, {'error': 'unknown import'})
+            return
+        self.send_json(200, {'data': {'id': match['import_id'], 'attributes': {
+            'status': import_entry['status'], 'failed_reason': import_entry['failed_reason']}}})
+
+
+def start_standin(options, host="127.0.0.1", port=0):
+    """
+    Start the stand-in server in a background thread
+
+    :param options : StandinOptions object
+    :param host    : address to listen on
+    :param port    : port to listen on, 0 picks a free port
+
+    Return value: the running server, its base URL is f"http://{host}:{server.server_port}"
+                  and server.state holds the statistics.  Call server.shutdown() to stop it
+    """
+    server = ThreadingHTTPServer((host, port), StandinHandler)
+    server.daemon_threads = True
+    server.state = StandinState(options)
+    threading.Thread(target=server.serve_forever, name="sleephq-standin", daemon=True).start()
+    return server
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Local stand-in for the SleepHQ API")
+    parser.add_argument('--host', default="127.0.0.1")
+    parser.add_argument('--port', type=int, default=8080)
+    parser.add_argument('--latency', type=float, default=0.0, help="seconds added to every response")
+    parser.add_argument('--rate-limit-every', type=int, default=0, help="answer every Nth upload with HTTP 429")
+    parser.add_argument('--retry-after', type=int, default=1, help="Retry-After seconds sent with HTTP 429")
+    parser.add_argument('--error-rate', type=float, default=0.0, help="fraction of requests answered with HTTP 500")
+    parser.add_argument('--processing-time', type=float, default=1.0, help="seconds an import takes to process")
+    parser.add_argument('--fail-imports', action='store_true', help="finish imports as failed")
+    parser.add_argument('--serial', default="STANDIN-0001", help="serial number of the stand-in machine")
+    args = parser.parse_args()
+    standin = start_standin(StandinOptions(args.latency, args.rate_limit_every, args.retry_after,
+                                           args.error_rate, args.processing_time, args.fail_imports,
+                                           args.serial),
+                            args.host, args.port)
+    print(f"SleepHQ stand-in listening on http://{args.host}:{standin.server_port}")
+    try:
+        threading.Event().wait()
+    except KeyboardInterrupt:
+        standin.shutdown()
@@ -0,0 +1,180 @@
+""" Tests for archive_catalogue.py
+
+Run from the scripts folder with:
+    python3 -m unittest discover tests
+"""
+import os
+import shutil
+import tempfile
+import unittest
+
+import archive_catalogue
+from archive_catalogue import ArchiveCatalogue, folder_day, rebuild
+from archive_store import ArchiveStore, REF_SUFFIX
+from prisma_state import UploadLedger
+from sleephq_hash import HashCache, calculate_content_hash
+
+
+class CatalogueTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.work_dir = tempfile.mkdtemp(prefix="prisma-test-")
+        self.catalogue_file = os.path.join(self.work_dir, 'prisma-archive.db')
+        self.catalogue = ArchiveCatalogue(self.catalogue_file)
+
+    def tearDown(self):
+        self.catalogue.close()
+        shutil.rmtree(self.work_dir)
+
+
+class RecordTest(CatalogueTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.catalogue.record("2026-10-16", "config.pcfg", 3072, 1.0, "c1", "s-c1")
+        self.catalogue.record("2026-10-16", "therapy.pdat", 1000, 1.0, "t1", "s-t1", "complete", "11")
+        self.catalogue.record("2026-10-17", "config.pcfg", 3072, 2.0, "c1", "s-c1")
+        self.catalogue.record("2026-10-17", "therapy.pdat", 2000, 2.0, "t2", "s-t2", "failed", "12")
+        self.catalogue.record("2026-10-18", "config.pcfg", 3072, 3.0, "c2", "s-c2")
+        self.catalogue.record("2026-10-18", "therapy.pdat", 3000, 3.0, "t3", "s-t3")
+
+    def test_days(self):
+        rows = self.catalogue.days("2026-10-17", "2026-10-17")
+        self.assertEqual([(row['name'], row['size'], row['content_hash']) for row in rows],
+                         [("config.pcfg", 3072, "c1"), ("therapy.pdat", 2000, "t2")])
+        self.assertEqual(len(self.catalogue.days()), 6)
+
+    def test_changes(self):
+        self.assertEqual([row['day'] for row in self.catalogue.changes("config.pcfg")],
+                         ["2026-10-16", "2026-10-18"])
+        self.assertEqual(len(self.catalogue.changes("therapy.pdat")), 3)
+
+    def test_find_hash(self):
+        self.assertEqual([row['day'] for row in self.catalogue.find_hash("c1")], ["2026-10-16", "2026-10-17"])
+        self.assertEqual([row['day'] for row in self.catalogue.find_hash("s-t3")], ["2026-10-18"])
+        self.assertEqual(self.catalogue.find_hash("unknown"), [])
+
+    def test_record_replaces(self):
+        self.catalogue.record("2026-10-18", "therapy.pdat", 3500, 4.0, "t4", "s-t4")
+        rows = self.catalogue.find_hash("t4")
+        self.assertEqual([(row['day'], row['size']) for row in rows], [("2026-10-18", 3500)])
+        self.assertEqual(self.catalogue.find_hash("t3"), [])
+
+    def test_same_content_takes_status(self):
+        self.catalogue.record("2026-10-19", "therapy.pdat", 1000, 5.0, "t1", "s-t1")
+        row = self.catalogue.days("2026-10-19")[0]
+        self.assertEqual((row['upload_status'], row['import_id']), ("complete", "11"))
+
+    def test_not_uploaded(self):
+        rows = self.catalogue.not_uploaded()
+        self.assertEqual([(row['day'], row['name']) for row in rows],
+                         [("2026-10-16", "config.pcfg"), ("2026-10-17", "config.pcfg"),
+                          ("2026-10-17", "therapy.pdat"), ("2026-10-18", "config.pcfg"),
+                          ("2026-10-18", "therapy.pdat")])
+
+    def test_record_uploads(self):
+        entries = {"c1": {'status': "complete", 'import_id': 13},
+                   "t3": {'status': "complete", 'import_id': 13},
+                   "unknown": {'status': "complete", 'import_id': 13}}
+        self.assertEqual(self.catalogue.record_uploads(entries), 3)
+        # nothing changes the second time
+        self.assertEqual(self.catalogue.record_uploads(entries), 0)
+        self.assertEqual([(row['day'], row['name']) for row in self.catalogue.not_uploaded()],
+                         [("2026-10-17", "therapy.pdat"), ("2026-10-18", "config.pcfg")])
+        self.assertEqual(self.catalogue.find_hash("c1")[0]['import_id'], "13")
+
+    def test_record_uploads_from_ledger(self):
+        ledger = UploadLedger(os.path.join(self.work_dir, 'prisma-upload-ledger.json'))
+        ledger.record("t3", "therapy.pdat", 14, "complete")
+        self.catalogue.close()
+        archive_catalogue.record_uploads(ledger, self.catalogue_file)
+        self.catalogue = ArchiveCatalogue(self.catalogue_file)
+        self.assertEqual(self.catalogue.find_hash("t3")[0]['upload_status'], "complete")
+
+    def test_record_uploads_without_catalogue(self):
+        ledger = UploadLedger(os.path.join(self.work_dir, 'prisma-upload-ledger.json'))
+        ledger.record("t3", "therapy.pdat", 14, "complete")
+        missing = os.path.join(self.work_dir, 'missing.db')
+        archive_catalogue.record_uploads(ledger, missing)
+        self.assertFalse(os.path.exists(missing))
+
+
+class FolderDayTest(unittest.TestCase):
+
+    def test_folder_day(self):
+        archive = os.path.join(os.sep, 'archive')
+        self.assertEqual(folder_day(archive, os.path.join(archive, '2026', '10', '18')), "2026-10-18")
+        self.assertIsNone(folder_day(archive, os.path.join(archive, '2026', '10')))
+        self.assertIsNone(folder_day(archive, os.path.join(archive, '2026', '02', '30')))
+        self.assertIsNone(folder_day(archive, os.path.join(archive, '.blobs', 'ab', 'cd')))
+
+
+class RebuildTest(CatalogueTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.archive = os.path.join(self.work_dir, 'archive')
+        therapy = os.urandom(200000)
+        config = bytes(range(256)) * 12
+        # content hash of each file, by day
+        self.expected = {}
+        for day in ("16", "17", "18"):
+            therapy += os.urandom(20000)
+            folder = os.path.join(self.archive, '2026', '10', day)
+            os.makedirs(folder)
+            for name, contents in (("config.pcfg", config), ("therapy.pdat", therapy)):
+                with open(os.path.join(folder, name), 'wb') as f:
+                    f.write(contents)
+                self.expected[(f"2026-10-{day}", name)] = (len(contents),
+                                                          calculate_content_hash(os.path.join(folder, name)))
+        self.store = ArchiveStore(self.archive)
+        for day in ("16", "17", "18"):
+            for name in ("config.pcfg", "therapy.pdat"):
+                self.store.adopt(os.path.join(self.archive, '2026', '10', day, name))
+
+    def catalogued(self):
+        return {(row['day'], row['name']): (row['size'], row['content_hash'])
+                for row in self.catalogue.days()}
+
+    def test_rebuild(self):
+        self.assertEqual(rebuild(self.catalogue, self.archive, workers=1), (6, 4))
+        self.assertEqual(self.catalogued(), self.expected)
+        # the SHA-256 is the blob each day folder links to
+        for row in self.catalogue.days():
+            self.assertTrue(os.path.exists(self.store.blob_file(row['sha256'])))
+
+    def test_rebuild_compacted(self):
+        self.assertEqual(self.store.compact(keep_days=1, workers=1), 2)
+        self.assertTrue(os.path.exists(os.path.join(self.archive, '2026', '10', '16', 'therapy.pdat' + REF_SUFFIX)))
+        self.assertEqual(rebuild(self.catalogue, self.archive, workers=1), (6, 4))
+        self.assertEqual(self.catalogued(), self.expected)
+        # the restored copies are removed again
+        self.assertEqual(os.listdir(os.path.join(self.store.blob_path, "tmp")), [])
+
+    def test_rebuild_replaces(self):
+        self.catalogue.record("2025-01-01", "therapy.pdat", 1, 1.0, "gone")
+        rebuild(self.catalogue, self.archive, workers=1)
+        self.assertEqual(self.catalogue.find_hash("gone"), [])
+        self.assertEqual(len(self.catalogue.days()), 6)
+
+    def test_rebuild_with_ledger(self):
+        ledger = UploadLedger(os.path.join(self.work_dir, 'prisma-upload-ledger.json'))
+        ledger.record(self.expected[("2026-10-18", "therapy.pdat")][1], "therapy.pdat", 15, "complete")
+        ledger.record(self.expected[("2026-10-18", "config.pcfg")][1], "config.pcfg", 15, "complete")
+        rebuild(self.catalogue, self.archive, ledger, workers=1)
+        self.assertEqual([(row['day'], row['name']) for row in self.catalogue.not_uploaded()],
+                         [("2026-10-16", "therapy.pdat"), ("2026-10-17", "therapy.pdat")])
+        self.assertEqual({row['import_id'] for row in self.catalogue.find_hash(
+            self.expected[("2026-10-16", "config.pcfg")][1])}, {"15"})
+
+    def test_rebuild_with_hash_cache(self):
+        hash_cache = HashCache(os.path.join(self.work_dir, 'prisma-hash-cache.json'))
+        for (day, name), (size, content_hash) in self.expected.items():
+            full_name = os.path.abspath(os.path.join(self.archive, *day.split('-'), name))
+            hash_cache.store(full_name, os.stat(full_name), content_hash)
+        self.assertEqual(rebuild(self.catalogue, self.archive, hash_cache=hash_cache, workers=1), (6, 0))
+        self.assertEqual(self.catalogued(), self.expected)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,118 @@
+""" Tests for nas_sync.py, syncing between two local folders
+
+Run from the scripts folder with:
+    python3 -m unittest discover tests
+"""
+import os
+import shutil
+import tempfile
+import time
+import unittest
+from unittest import mock
+
+import nas_sync
+from nas_sync import record_changes, sync
+from prisma_state import load_json_file, save_json_file
+
+BLOB = os.path.join('.blobs', 'ab', 'ab12')
+DAYS = [os.path.join('2025', '01', '14', 'therapy.pdat'), os.path.join('2025', '01', '15', 'therapy.pdat')]
+
+
+class NasSyncTest(unittest.TestCase):
+    """
+     An archive holding one blob hardlinked into two day folders, as archive_store.py writes it
+    """
+
+    def setUp(self):
+        self.work_dir = tempfile.mkdtemp(prefix="prisma-test-")
+        self.archive = os.path.join(self.work_dir, 'archive')
+        self.nas = os.path.join(self.work_dir, 'nas')
+        self.journal = os.path.join(self.work_dir, 'journal.txt')
+        self.state = os.path.join(self.work_dir, 'state.json')
+        os.makedirs(self.nas)
+        self.write(BLOB, b"therapy" * 1000)
+        for day in DAYS:
+            os.makedirs(os.path.dirname(self.source(day)))
+            os.link(self.source(BLOB), self.source(day))
+        self.write(os.path.join('2025', '01', '15', 'config.pcfg'), b"config")
+
+    def tearDown(self):
+        shutil.rmtree(self.work_dir)
+
+    def source(self, relative_path):
+        return os.path.join(self.archive, relative_path)
+
+    def target(self, relative_path):
+        return os.path.join(self.nas, relative_path)
+
+    def write(self, relative_path, data):
+        os.makedirs(os.path.dirname(self.source(relative_path)), exist_ok=True)
+        with open(self.source(relative_path), 'wb') as f:
+            f.write(data)
+
+    def sync(self, full=False):
+        return sync(self.archive, self.nas, self.journal, self.state, full=full)
+
+    def nas_files(self):
+        return sorted(os.path.relpath(os.path.join(dirpath, f), self.nas)
+                      for dirpath, dirnames, filenames in os.walk(self.nas) for f in filenames)
+
+    def assert_linked(self, *paths):
+        inodes = {os.stat(self.target(path)).st_ino for path in paths}
+        self.assertEqual(len(inodes), 1)
+
+    def test_journal_replay(self):
+        record_changes([BLOB] + [(day, BLOB) for day in DAYS], self.journal)
+        self.assertEqual(self.sync(), {'copied': 1, 'linked': 2})
+        self.assertEqual(self.nas_files(), sorted([BLOB] + DAYS))
+        self.assert_linked(BLOB, *DAYS)
+        self.assertFalse(os.path.exists(self.journal))
+        # nothing journalled since
+        self.assertEqual(self.sync(), {})
+
+    def test_unchanged_files_skipped(self):
+        record_changes([BLOB] + [(day, BLOB) for day in DAYS], self.journal)
+        self.sync()
+        record_changes([BLOB], self.journal)
+        self.assertEqual(self.sync(), {'skipped': 1})
+
+    def test_inflight_recovery(self):
+        # a sync killed after taking the journal left its entries in the .inflight file
+        with open(self.journal + ".inflight", 'w', encoding='utf-8') as f:
+            f.write(BLOB + "\n")
+        record_changes([(DAYS[0], BLOB)], self.journal)
+        self.assertEqual(self.sync(), {'copied': 1, 'linked': 1})
+        self.assert_linked(BLOB, DAYS[0])
+        self.assertFalse(os.path.exists(self.journal + ".inflight"))
+
+    def test_failed_copy(self):
+        record_changes([BLOB], self.journal)
+        # fails after the temporary copy was written
+        with mock.patch.object(nas_sync.os, 'utime', side_effect=OSError("Input/output error")):
+            self.assertEqual(self.sync(), {'failed': 1})
+        # no partial copy left on the NAS, and the file is journalled for the next sync
+        self.assertEqual(self.nas_files(), [])
+        self.assertEqual(list(nas_sync.read_journal(self.journal)), [BLOB])
+        self.assertEqual(self.sync(), {'copied': 1})
+
+    def test_full_scan(self):
+        self.assertEqual(nas_sync.full_scan(self.archive),
+                         {BLOB: None, DAYS[0]: BLOB, DAYS[1]: BLOB,
+                          os.path.join('2025', '01', '15', 'config.pcfg'): None})
+        # nothing journalled, the weekly full reconciliation finds every file
+        save_json_file(self.state, {'last_full': time.time() - (nas_sync.FULL_SYNC_DAYS + 1) * 86400})
+        self.assertEqual(self.sync(full=None), {'copied': 2, 'linked': 2})
+        self.assert_linked(BLOB, *DAYS)
+        self.assertGreater(load_json_file(self.state, {})['last_full'], time.time() - 60)
+        # not due again for a week
+        os.unlink(self.target(DAYS[1]))
+        self.assertEqual(self.sync(full=None), {})
+        self.assertEqual(self.sync(full=True), {'linked': 1, 'skipped': 3})
+
+    def test_full_scan_skips_tmp(self):
+        self.write(BLOB + ".1234.tmp", b"partial")
+        self.assertNotIn(BLOB + ".1234.tmp", nas_sync.full_scan(self.archive))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,120 @@
+""" Tests for prisma_backfill.py against the SleepHQ stand-in
+
+Run from the scripts folder with:
+    python3 -m unittest discover tests
+"""
+import datetime
+import importlib.util
+import itertools
+import logging
+import os
+import shutil
+import tempfile
+import unittest
+from unittest import mock
+
+for module_name, package in (("requests", "requests"), ("dotenv", "python-dotenv")):
+    if importlib.util.find_spec(module_name) is None:
+        raise unittest.SkipTest(f"needs the {module_name} module, run: pip3 install {package}")
+
+import prisma20a_sleephq_uploader as uploader
+from archive_store import ArchiveStore
+from prisma_backfill import archive_days, Backfill, BackfillCheckpoint
+from prisma_state import load_json_file, UploadLedger
+from sleephq_client import set_base_url
+from sleephq_hash import HashCache
+from sleephq_standin import start_standin, StandinOptions
+
+HEADERS = {'Authorization': "Bearer standin-token", 'Accept': 'application/json'}
+
+
+class BackfillResumeTest(unittest.TestCase):
+    """
+     Three archived days: two with new data and a third identical to the second
+    """
+
+    def setUp(self):
+        self.work_dir = tempfile.mkdtemp(prefix="prisma-test-")
+        self.archive = os.path.join(self.work_dir, 'archive')
+        self.checkpoint_file = os.path.join(self.work_dir, 'prisma-backfill.json')
+        for day, seed in (('14', b"a"), ('15', b"b"), ('16', b"b")):
+            folder = os.path.join(self.archive, '2025', '01', day)
+            os.makedirs(folder)
+            with open(os.path.join(folder, 'config.pcfg'), 'wb') as f:
+                f.write(seed * 100)
+            with open(os.path.join(folder, 'therapy.pdat'), 'wb') as f:
+                f.write(seed * 5000)
+        self.standin = start_standin(StandinOptions(processing_time=0.1))
+        set_base_url(f"http://127.0.0.1:{self.standin.server_port}")
+        # check the import status every 50ms instead of after 2s and more
+        patcher = mock.patch.object(uploader, 'poll_delays', lambda: itertools.repeat(0.05))
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def tearDown(self):
+        self.standin.shutdown()
+        self.standin.server_close()
+        shutil.rmtree(self.work_dir)
+
+    def backfill(self, poll_deadline=10):
+        # a new run: everything is read again from the files
+        return Backfill("1", dict(HEADERS), uploader.NTFY("NO", None, None, logging), ArchiveStore(self.archive),
+                        HashCache(os.path.join(self.work_dir, 'cache.json')),
+                        UploadLedger(os.path.join(self.work_dir, 'ledger.json')),
+                        BackfillCheckpoint(self.checkpoint_file), poll_deadline=poll_deadline)
+
+    def run_backfill(self, poll_deadline=10):
+        return self.backfill(poll_deadline).run(archive_days(self.archive))
+
+    def states(self):
+        return {day: entry['state'] for day, entry in load_json_file(self.checkpoint_file, {})['days'].items()}
+
+    def imports_reserved(self):
+        return self.standin.state.snapshot()['endpoints'].get('reserve_import', {}).get('requests', 0)
+
+    def test_complete_and_skipped_are_not_sent_again(self):
+        self.assertEqual(self.run_backfill(), {'complete': 2, 'skipped': 1})
+        self.assertEqual(self.states(), {'2025-01-14': "complete", '2025-01-15': "complete",
+                                         '2025-01-16': "skipped"})
+        self.assertEqual(self.run_backfill(), {'already done': 3})
+        self.assertEqual(self.imports_reserved(), 2)
+
+    def test_uploaded_is_polled_again(self):
+        self.standin.state.options.processing_time = 60
+        self.assertEqual(self.run_backfill(poll_deadline=0.3), {'uploaded': 2, 'skipped': 1})
+        self.assertEqual(self.states()['2025-01-14'], "uploaded")
+        # SleepHQ finished processing while nothing was running
+        self.standin.state.options.processing_time = 0
+        self.assertEqual(self.run_backfill(), {'complete': 2, 'already done': 1})
+        self.assertEqual(self.imports_reserved(), 2)
+        imports = self.standin.state.snapshot()['imports']
+        self.assertEqual({entry['status'] for entry in imports.values()}, {"complete"})
+
+    def test_failed_is_tried_again(self):
+        self.standin.state.options.fail_imports = True
+        self.assertEqual(self.run_backfill(), {'failed': 2, 'skipped': 1})
+        self.assertEqual(self.states()['2025-01-15'], "failed")
+        self.standin.state.options.fail_imports = False
+        self.assertEqual(self.run_backfill(), {'complete': 2, 'already done': 1})
+        self.assertEqual(self.imports_reserved(), 4)
+
+    def test_snapshot_sent_whole(self):
+        # new therapy data next to the config.pcfg already imported on the 15th
+        folder = os.path.join(self.archive, '2025', '01', '17')
+        os.makedirs(folder)
+        with open(os.path.join(folder, 'config.pcfg'), 'wb') as f:
+            f.write(b"b" * 100)
+        with open(os.path.join(folder, 'therapy.pdat'), 'wb') as f:
+            f.write(b"b" * 5000 + b"c" * 1000)
+        self.assertEqual(self.run_backfill(), {'complete': 3, 'skipped': 1})
+        imports = self.standin.state.snapshot()['imports']
+        self.assertEqual([sorted(entry['files']) for entry in imports.values()],
+                         [['config.pcfg', 'therapy.pdat']] * 3)
+
+    def test_date_range(self):
+        days = [date for date, _ in archive_days(self.archive, datetime.date(2025, 1, 15))]
+        self.assertEqual(days, [datetime.date(2025, 1, 15), datetime.date(2025, 1, 16)])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,134 @@
+""" Tests for prisma_daemon.py
+
+Run from the scripts folder with:
+    python3 -m unittest discover tests
+"""
+import importlib.util
+import logging
+import sqlite3
+import time
+import unittest
+from unittest import mock
+
+for module_name, package in (("requests", "requests"), ("dotenv", "python-dotenv")):
+    if importlib.util.find_spec(module_name) is None:
+        raise unittest.SkipTest(f"needs the {module_name} module, run: pip3 install {package}")
+
+import prisma_daemon
+from prisma_daemon import NetworkStage, PrismaDaemon
+
+uploader = prisma_daemon.uploader
+
+
+class StubNetwork:
+
+    def __init__(self):
+        self.requests = 0
+
+    def request(self):
+        self.requests += 1
+
+
+class ReadCardTest(unittest.TestCase):
+
+    def setUp(self):
+        self.network = StubNetwork()
+        self.daemon = PrismaDaemon("/card", "/archive", "/data", self.network, mount_check=False,
+                                   logger=logging.getLogger('prisma.test'))
+        self.released = 0
+        self.daemon.release_card = self.release_card
+
+    def release_card(self):
+        self.released += 1
+
+    def test_failed_copy_keeps_running(self):
+        for error in (OSError("card removed"), sqlite3.OperationalError("database is locked"),
+                      ValueError("bad state file")):
+            with self.subTest(error=type(error).__name__):
+                with mock.patch.object(prisma_daemon.transfer_data, 'has_new_data', return_value=True), \
+                        mock.patch.object(prisma_daemon.transfer_data, 'create_year_month_folders',
+                                          side_effect=error), \
+                        self.assertLogs('prisma.test', logging.ERROR):
+                    self.daemon.read_card()
+        self.assertEqual(self.released, 3)
+        self.assertEqual(self.network.requests, 0)
+
+
+class StubQueue:
+
+    def __init__(self, next_due=None):
+        self.due = next_due
+
+    def next_due(self):
+        return self.due
+
+
+class NetworkStageStopTest(unittest.TestCase):
+
+    def setUp(self):
+        # stop_polling() is meant for a process that is about to exit
+        self.addCleanup(uploader._polling_stopped.clear)
+
+    def test_stop_ends_polling(self):
+        polls = []
+
+        def upload_from_env(queue):
+            # SleepHQ is still processing the import, the wait would last POLL_DEADLINE
+            polls.append(uploader.wait_for_import(1000, {}, uploader.NTFY("NO", None, None, logging)))
+        network = NetworkStage(StubQueue(), None, "/archive", logger=logging.getLogger('prisma.test'))
+        with mock.patch.object(uploader, 'upload_from_env', upload_from_env):
+            network.start()
+            network.request()
+            time.sleep(0.2)
+            start = time.monotonic()
+            self.assertTrue(network.stop(timeout=10))
+        self.assertLess(time.monotonic() - start, 5)
+        self.assertEqual(polls, [("stopped", None)])
+
+    def test_stop_timeout(self):
+        network = NetworkStage(StubQueue(), None, "/archive", logger=logging.getLogger('prisma.test'))
+        with mock.patch.object(uploader, 'upload_from_env', lambda queue: time.sleep(1)):
+            network.start()
+            network.request()
+            time.sleep(0.1)
+            with self.assertLogs('prisma.test', logging.ERROR):
+                self.assertFalse(network.stop(timeout=0.1))
+            network.thread.join()
+
+
+class NetworkStageRetryTest(unittest.TestCase):
+
+    def setUp(self):
+        self.addCleanup(uploader._polling_stopped.clear)
+
+    def test_failed_run_does_not_spin(self):
+        runs = []
+
+        def upload_from_env(queue):
+            # fails before the due job is claimed, so it stays due
+            runs.append(time.monotonic())
+            raise uploader.UploadFailed("settings missing")
+        network = NetworkStage(StubQueue(time.time() - 10), None, "/archive",
+                               logger=logging.getLogger('prisma.test'))
+        with mock.patch.object(uploader, 'upload_from_env', upload_from_env), \
+                self.assertLogs('prisma.test', logging.WARNING):
+            network.start()
+            time.sleep(0.5)
+            network.stop(timeout=5)
+        self.assertEqual(len(runs), 1)
+
+    def test_new_data_runs_at_once(self):
+        runs = []
+        network = NetworkStage(StubQueue(time.time() - 10), None, "/archive",
+                               logger=logging.getLogger('prisma.test'))
+        with mock.patch.object(uploader, 'upload_from_env', lambda queue: runs.append(queue)):
+            network.start()
+            time.sleep(0.2)
+            network.request()
+            time.sleep(0.2)
+            network.stop(timeout=5)
+        self.assertEqual(len(runs), 2)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,183 @@
+""" Tests for prisma_notify.py
+
+Run from the scripts folder with:
+    python3 -m unittest discover tests
+"""
+import importlib.util
+import threading
+import time
+import types
+import unittest
+from unittest import mock
+
+if importlib.util.find_spec("requests") is None:
+    raise unittest.SkipTest("needs the requests module, run: pip3 install requests")
+
+import requests
+
+import prisma_notify
+from prisma_notify import NotificationDispatcher
+
+
+class StubResponse:
+
+    def __init__(self, status_code):
+        self.status_code = status_code
+
+
+class StubSession:
+    """
+     Records the posts of a dispatcher instead of sending them to ntfy
+    """
+
+    def __init__(self, results=(), gate=None):
+        self.results = list(results)
+        self.gate = gate
+        self.posts = []
+
+    def post(self, url, data, timeout, headers):
+        if self.gate is not None:
+            self.gate.wait()
+        self.posts.append((headers["Title"], data.decode('utf-8')))
+        result = self.results.pop(0) if self.results else 200
+        if isinstance(result, Exception):
+            raise result
+        return StubResponse(result)
+
+
+class DispatcherTestCase(unittest.TestCase):
+
+    def dispatcher(self, session, **kwargs):
+        dispatcher = NotificationDispatcher("https://ntfy.example/topic", flush_at_exit=False, **kwargs)
+        dispatcher.session = session
+        return dispatcher
+
+
+class QueueTest(DispatcherTestCase):
+
+    def test_oldest_dropped(self):
+        gate = threading.Event()
+        session = StubSession(gate=gate)
+        dispatcher = self.dispatcher(session, max_queued=2, coalesce_delay=0)
+        dispatcher.post("Success", "first", "smiley")
+        # the dispatcher is now held up sending the first one
+        time.sleep(0.2)
+        for message in ("second", "third", "fourth"):
+            dispatcher.post("Success", message, "smiley")
+        self.assertEqual(dispatcher.dropped, 1)
+        gate.set()
+        self.assertTrue(dispatcher.flush(5))
+        self.assertEqual(len(session.posts), 2)
+        self.assertEqual(session.posts[0], ("Success", "first"))
+        summary = session.posts[1][1]
+        self.assertNotIn("second", summary)
+        self.assertIn("- Success: third", summary)
+        self.assertIn("- Success: fourth", summary)
+        self.assertIn("(1 older notifications were dropped)", summary)
+
+    def test_post_never_blocks(self):
+        gate = threading.Event()
+        dispatcher = self.dispatcher(StubSession(gate=gate), max_queued=1, coalesce_delay=0)
+        start = time.monotonic()
+        for number in range(50):
+            dispatcher.post("Success", f"message {number}", "smiley")
+        self.assertLess(time.monotonic() - start, 1)
+        gate.set()
+        self.assertTrue(dispatcher.flush(5))
+
+
+class CoalesceTest(DispatcherTestCase):
+
+    def test_burst_sent_as_one(self):
+        session = StubSession()
+        dispatcher = self.dispatcher(session)
+        dispatcher.post("Success", "uploaded", "smiley")
+        dispatcher.post("Failure", "import failed", "frowning")
+        dispatcher.post("Success", "uploaded again", "smiley")
+        self.assertTrue(dispatcher.flush(5))
+        self.assertEqual(len(session.posts), 1)
+        title, message = session.posts[0]
+        # a failure in the burst decides the title
+        self.assertEqual(title, "Failure")
+        self.assertEqual(message.splitlines(), ["3 notifications:", "- Success: uploaded",
+                                                "- Failure: import failed", "- Success: uploaded again"])
+
+    def test_single_sent_as_is(self):
+        session = StubSession()
+        dispatcher = self.dispatcher(session)
+        dispatcher.post("Success", "uploaded", "smiley")
+        self.assertTrue(dispatcher.flush(5))
+        self.assertEqual(session.posts, [("Success", "uploaded")])
+
+    def test_later_sent_apart(self):
+        session = StubSession()
+        dispatcher = self.dispatcher(session, coalesce_delay=0.1)
+        dispatcher.post("Success", "uploaded", "smiley")
+        time.sleep(0.5)
+        dispatcher.post("Success", "uploaded again", "smiley")
+        self.assertTrue(dispatcher.flush(5))
+        self.assertEqual(session.posts, [("Success", "uploaded"), ("Success", "uploaded again")])
+
+
+class RetryTest(DispatcherTestCase):
+
+    def setUp(self):
+        self.sleeps = []
+        clock = types.SimpleNamespace(monotonic=time.monotonic, sleep=self.sleeps.append)
+        patcher = mock.patch.object(prisma_notify, 'time', clock)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_given_up_after_attempts(self):
+        session = StubSession([503, requests.ConnectionError("refused"), 429, 200])
+        dispatcher = self.dispatcher(session, coalesce_delay=0)
+        with self.assertLogs('prisma.notify', 'ERROR'):
+            dispatcher.post("Failure", "import failed", "frowning")
+            self.assertTrue(dispatcher.flush(5))
+        self.assertEqual(len(session.posts), prisma_notify.NTFY_ATTEMPTS)
+        self.assertEqual(self.sleeps, [1, 2])
+
+    def test_retried_until_sent(self):
+        session = StubSession([500, 200])
+        dispatcher = self.dispatcher(session, coalesce_delay=0)
+        dispatcher.post("Success", "uploaded", "smiley")
+        self.assertTrue(dispatcher.flush(5))
+        self.assertEqual(len(session.posts), 2)
+
+    def test_rejected_not_retried(self):
+        session = StubSession([403])
+        dispatcher = self.dispatcher(session, coalesce_delay=0)
+        dispatcher.post("Success", "uploaded", "smiley")
+        self.assertTrue(dispatcher.flush(5))
+        self.assertEqual(len(session.posts), 1)
+
+
+class FlushTest(DispatcherTestCase):
+
+    def test_flush_registered_at_exit(self):
+        with mock.patch.object(prisma_notify.atexit, 'register') as register:
+            dispatcher = NotificationDispatcher("https://ntfy.example/topic")
+        register.assert_called_once_with(dispatcher.flush, prisma_notify.FLUSH_TIMEOUT)
+
+    def test_flush_waits_for_queued(self):
+        gate = threading.Event()
+        session = StubSession(gate=gate)
+        dispatcher = self.dispatcher(session, coalesce_delay=0)
+        dispatcher.post("Failure", "import failed", "frowning")
+        threading.Timer(0.3, gate.set).start()
+        self.assertTrue(dispatcher.flush(5))
+        self.assertEqual(session.posts, [("Failure", "import failed")])
+
+    def test_flush_bounded(self):
+        gate = threading.Event()
+        dispatcher = self.dispatcher(StubSession(gate=gate), coalesce_delay=0)
+        dispatcher.post("Failure", "import failed", "frowning")
+        start = time.monotonic()
+        self.assertFalse(dispatcher.flush(0.2))
+        self.assertLess(time.monotonic() - start, 1)
+        gate.set()
+        self.assertTrue(dispatcher.flush(5))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,72 @@
+""" Tests for the shared state files in prisma_state.py and sleephq_hash.py
+
+Run from the scripts folder with:
+    python3 -m unittest discover tests
+"""
+import os
+import shutil
+import tempfile
+import unittest
+
+from prisma_state import CredentialCache, UploadLedger
+from sleephq_hash import HashCache
+
+
+class ConcurrentSaveTest(unittest.TestCase):
+    """
+     Two processes holding the same state file, as the daemon and transfer_data.py
+     run from the command line do, must not lose each other's changes
+    """
+
+    def setUp(self):
+        self.work_dir = tempfile.mkdtemp(prefix="prisma-test-")
+        self.files = []
+        for name in ('config.pcfg', 'therapy.pdat'):
+            self.files.append(os.path.join(self.work_dir, name))
+            with open(self.files[-1], 'wb') as f:
+                f.write(name.encode())
+
+    def tearDown(self):
+        shutil.rmtree(self.work_dir)
+
+    def test_hash_cache(self):
+        cache_file = os.path.join(self.work_dir, 'cache.json')
+        daemon, transfer = HashCache(cache_file), HashCache(cache_file)
+        transfer.get_hash(self.files[0])
+        daemon.get_hash(self.files[1])
+        transfer.save()
+        daemon.save()
+        self.assertEqual(sorted(HashCache(cache_file).entries), self.files)
+
+    def test_ledger(self):
+        ledger_file = os.path.join(self.work_dir, 'ledger.json')
+        daemon, cli = UploadLedger(ledger_file), UploadLedger(ledger_file)
+        daemon.record("a" * 32, 'config.pcfg', "1", "complete")
+        cli.record("b" * 32, 'therapy.pdat', "2", "uploaded")
+        cli.save()
+        daemon.save()
+        self.assertEqual(sorted(UploadLedger(ledger_file).entries), ["a" * 32, "b" * 32])
+        self.assertEqual(len(daemon.entries), 2)
+
+
+class CredentialCacheTest(unittest.TestCase):
+
+    def setUp(self):
+        self.work_dir = tempfile.mkdtemp(prefix="prisma-test-")
+        self.cache_file = os.path.join(self.work_dir, 'token-cache.json')
+
+    def tearDown(self):
+        shutil.rmtree(self.work_dir)
+
+    def test_devices_of_one_team(self):
+        cache = CredentialCache(self.cache_file)
+        cache.store_machine_id("client", 1, "SERIAL-A", 10)
+        cache.store_machine_id("client", 1, "SERIAL-B", 20)
+        cache = CredentialCache(self.cache_file)
+        self.assertEqual(cache.get_machine_id("client", 1, "SERIAL-A"), 10)
+        self.assertEqual(cache.get_machine_id("client", "1", "SERIAL-B"), 20)
+        self.assertIsNone(cache.get_machine_id("client", 2, "SERIAL-A"))
+
+
+if __name__ == '__main__':
+    unittest.main()
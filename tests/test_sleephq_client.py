@@ -0,0 +1,304 @@
+""" Tests for the API client and the streamed upload body in sleephq_client.py
+
+Run from the scripts folder with:
+    python3 -m unittest discover tests
+"""
+import importlib.util
+import os
+import shutil
+import tempfile
+import time
+import unittest
+
+if importlib.util.find_spec("requests") is None:
+    raise unittest.SkipTest("needs the requests module, run: pip3 install requests")
+
+import requests
+from urllib3.exceptions import MaxRetryError, NewConnectionError
+
+import sleephq_client
+from sleephq_client import API_ATTEMPTS, DEFAULT_TIMEOUT, ENDPOINT_TIMEOUTS, MultipartUpload, STREAM_BLOCK_SIZE
+from sleephq_client import CircuitBreaker, CircuitOpenError, SleepHQClient, request_not_sent
+from sleephq_client import MAX_AUTH_REFRESHERS, refresh_authorization, set_auth_refresher, RateLimiter
+from sleephq_hash import calculate_content_hash
+
+URL = "http://sleephq.invalid/api/v1/imports/1000"
+
+
+def connection_refused():
+    # what requests raises when nothing listens on the port
+    reason = NewConnectionError(None, "Failed to establish a new connection: [Errno 111] Connection refused")
+    return requests.ConnectionError(MaxRetryError(None, URL, reason))
+
+
+class StubResponse:
+
+    def __init__(self, status_code, headers=None):
+        self.status_code = status_code
+        self.headers = headers or {}
+
+    def close(self):
+        pass
+
+
+class StubSession:
+    """
+     Answers each request with the next outcome, an HTTP status code or an
+     exception to raise, and records the requests made
+    """
+
+    def __init__(self, *outcomes):
+        self.outcomes = list(outcomes)
+        self.calls = []
+
+    def request(self, method, url, **kwargs):
+        self.calls.append((method, kwargs))
+        outcome = self.outcomes.pop(0) if len(self.outcomes) > 1 else self.outcomes[0]
+        if isinstance(outcome, Exception):
+            raise outcome
+        if isinstance(outcome, tuple):
+            return StubResponse(*outcome)
+        return StubResponse(outcome)
+
+
+class SleepHQClientTest(unittest.TestCase):
+
+    def client(self, *outcomes, breaker=None):
+        client = SleepHQClient(StubSession(*outcomes), breaker=breaker or CircuitBreaker(threshold=100))
+        # no waiting between attempts
+        client.backoff = lambda attempt: 0.0
+        return client
+
+    def test_endpoint_timeouts(self):
+        client = self.client(200)
+        client.get('import_status', URL)
+        client.post('files', URL)
+        client.get('unknown', URL)
+        client.get('teams', URL, timeout=1)
+        self.assertEqual([kwargs['timeout'] for _, kwargs in client.session.calls],
+                         [ENDPOINT_TIMEOUTS['import_status'], ENDPOINT_TIMEOUTS['files'], DEFAULT_TIMEOUT, 1])
+
+    def test_idempotent_retries(self):
+        client = self.client(503, 502, 200)
+        self.assertEqual(client.get('import_status', URL).status_code, 200)
+        self.assertEqual(len(client.session.calls), 3)
+        self.assertEqual(client.latency()['import_status']['retries'], 2)
+
+    def test_retry_count(self):
+        client = self.client(requests.ReadTimeout("read timed out"))
+        with self.assertRaises(requests.ReadTimeout):
+            client.get('import_status', URL)
+        self.assertEqual(len(client.session.calls), API_ATTEMPTS)
+        client = self.client(503)
+        self.assertEqual(client.get('import_status', URL).status_code, 503)
+        self.assertEqual(len(client.session.calls), API_ATTEMPTS)
+
+    def test_post_sent_once(self):
+        # the body may have reached SleepHQ, sending it again could do it twice
+        client = self.client(requests.ReadTimeout("read timed out"), 200)
+        with self.assertRaises(requests.ReadTimeout):
+            client.post('process_files', URL)
+        self.assertEqual(len(client.session.calls), 1)
+        client = self.client(500, 200)
+        self.assertEqual(client.post('process_files', URL).status_code, 500)
+        self.assertEqual(len(client.session.calls), 1)
+
+    def test_post_not_sent_is_retried(self):
+        for error in (requests.ConnectTimeout("connect timed out"), connection_refused()):
+            with self.subTest(error=type(error).__name__):
+                client = self.client(error, 201)
+                self.assertEqual(client.post('reserve_import', URL).status_code, 201)
+                self.assertEqual(len(client.session.calls), 2)
+
+    def test_post_idempotent_override(self):
+        client = self.client(500, 200)
+        self.assertEqual(client.post('token', URL, idempotent=True).status_code, 200)
+        self.assertEqual(len(client.session.calls), 2)
+
+    def test_rate_limited_post_is_retried(self):
+        client = self.client((429, {'Retry-After': "0"}), 201)
+        self.assertEqual(client.post('files', URL).status_code, 201)
+        self.assertEqual(len(client.session.calls), 2)
+
+    def test_streamed_body_sent_once(self):
+        client = self.client(requests.ConnectTimeout("connect timed out"), 201)
+        with open(os.devnull, 'rb') as body:
+            with self.assertRaises(requests.ConnectTimeout):
+                client.post('files', URL, data=body)
+        self.assertEqual(len(client.session.calls), 1)
+
+    def test_request_not_sent(self):
+        self.assertTrue(request_not_sent(requests.ConnectTimeout("connect timed out")))
+        self.assertTrue(request_not_sent(connection_refused()))
+        self.assertTrue(request_not_sent(CircuitOpenError("open")))
+        self.assertFalse(request_not_sent(requests.ReadTimeout("read timed out")))
+        self.assertFalse(request_not_sent(requests.ConnectionError("connection reset by peer")))
+
+
+class CircuitBreakerTest(unittest.TestCase):
+
+    def setUp(self):
+        self.breaker = CircuitBreaker(threshold=5, reset_timeout=0.2)
+        self.session = StubSession(connection_refused())
+        self.client = SleepHQClient(self.session, attempts=1, breaker=self.breaker)
+
+    def fail_calls(self, count):
+        for _ in range(count):
+            with self.assertRaises(requests.ConnectionError):
+                self.client.get('teams', URL)
+
+    def test_opens_after_threshold(self):
+        self.fail_calls(4)
+        self.assertEqual(self.breaker.state, "closed")
+        self.fail_calls(1)
+        self.assertEqual(self.breaker.state, "open")
+        # fails straight away without calling SleepHQ
+        with self.assertRaises(CircuitOpenError):
+            self.client.get('teams', URL)
+        self.assertEqual(len(self.session.calls), 5)
+
+    def test_success_resets_count(self):
+        self.fail_calls(4)
+        self.session.outcomes = [200]
+        self.client.get('teams', URL)
+        self.session.outcomes = [connection_refused()]
+        self.fail_calls(4)
+        self.assertEqual(self.breaker.state, "closed")
+
+    def test_closes_after_reset_timeout(self):
+        self.fail_calls(5)
+        time.sleep(0.25)
+        self.assertEqual(self.breaker.state, "half-open")
+        # a single trial call is let through
+        self.breaker.before_call('teams')
+        with self.assertRaises(CircuitOpenError):
+            self.breaker.before_call('teams')
+        self.breaker.succeeded()
+        self.assertEqual(self.breaker.state, "closed")
+        self.session.outcomes = [200]
+        self.assertEqual(self.client.get('teams', URL).status_code, 200)
+
+    def test_failed_trial_reopens(self):
+        self.fail_calls(5)
+        time.sleep(0.25)
+        self.fail_calls(1)
+        self.assertEqual(self.breaker.state, "open")
+        with self.assertRaises(CircuitOpenError):
+            self.client.get('teams', URL)
+        time.sleep(0.25)
+        self.session.outcomes = [200]
+        self.assertEqual(self.client.get('teams', URL).status_code, 200)
+        self.assertEqual(self.breaker.state, "closed")
+
+
+class MultipartUploadTest(unittest.TestCase):
+
+    def setUp(self):
+        self.work_dir = tempfile.mkdtemp(prefix="prisma-test-")
+        self.file_name = os.path.join(self.work_dir, 'therapy.pdat')
+        with open(self.file_name, 'wb') as f:
+            f.write(os.urandom(3 * STREAM_BLOCK_SIZE + 5))
+
+    def tearDown(self):
+        shutil.rmtree(self.work_dir)
+
+    def body(self, size):
+        upload = MultipartUpload(1000, 'therapy.pdat', self.file_name)
+        blocks = []
+        for block in iter(lambda: upload.read(size), b''):
+            if size >= 0:
+                self.assertLessEqual(len(block), size)
+            blocks.append(block)
+        body = b''.join(blocks)
+        self.assertEqual(len(body), len(upload))
+        self.assertEqual(upload.file_hash, calculate_content_hash(self.file_name))
+        return body.replace(upload.boundary.encode(), b'BOUNDARY')
+
+    def test_read_sizes(self):
+        expected = self.body(-1)
+        # http.client reads 8 KiB blocks, the others split the head, blocks and tail unevenly
+        for size in (7, 8192, STREAM_BLOCK_SIZE, STREAM_BLOCK_SIZE + 1, 10 * STREAM_BLOCK_SIZE):
+            with self.subTest(size=size):
+                self.assertEqual(self.body(size), expected)
+
+
+class FakeClock:
+    """
+     A clock that only moves when slept on
+    """
+
+    def __init__(self):
+        self.now = 0.0
+        self.sleeps = []
+
+    def __call__(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.sleeps.append(seconds)
+        # like a real sleep, always takes some time, or rounding could leave a tiny wait forever
+        self.now += max(seconds, 1e-6)
+
+
+class RateLimiterTest(unittest.TestCase):
+
+    def setUp(self):
+        self.clock = FakeClock()
+        self.limiter = RateLimiter(max_rate=10.0, burst=2, min_rate=0.5, clock=self.clock,
+                                   sleep=self.clock.sleep)
+
+    def acquire(self, count):
+        for _ in range(count):
+            self.limiter.acquire()
+
+    def test_burst_then_paced(self):
+        self.acquire(2)
+        self.assertEqual(self.clock.sleeps, [])
+        # 10 per second once the burst is used up
+        self.acquire(20)
+        self.assertAlmostEqual(self.clock.now, 2.0)
+        self.assertTrue(all(seconds <= 0.1 + 1e-9 for seconds in self.clock.sleeps))
+
+    def test_tokens_refill_while_idle(self):
+        self.acquire(2)
+        self.clock.now += 10
+        sleeps = len(self.clock.sleeps)
+        self.acquire(2)
+        self.assertEqual(len(self.clock.sleeps), sleeps)
+
+    def test_throttled_honours_retry_after(self):
+        self.acquire(1)
+        self.limiter.throttled(retry_after=5)
+        self.assertEqual(self.limiter.rate, 5.0)
+        self.acquire(1)
+        self.assertGreaterEqual(self.clock.now, 5.0)
+
+    def test_rate_halves_to_min_and_recovers(self):
+        for _ in range(10):
+            self.limiter.throttled()
+        self.assertEqual(self.limiter.rate, 0.5)
+        # without Retry-After the wait is one request at the lowered rate
+        start = self.clock.now
+        self.acquire(1)
+        self.assertAlmostEqual(self.clock.now - start, 2.0)
+        for _ in range(20):
+            self.limiter.succeeded()
+        self.assertEqual(self.limiter.rate, 10.0)
+
+
+class RefreshAuthorizationTest(unittest.TestCase):
+
+    def test_replaced_tokens_bounded(self):
+        tokens = iter(range(1, 1000))
+        headers = {'Authorization': "Bearer 0"}
+        set_auth_refresher(headers, lambda: f"Bearer {next(tokens)}")
+        for number in range(3 * MAX_AUTH_REFRESHERS):
+            self.assertEqual(refresh_authorization(f"Bearer {number}"), f"Bearer {number + 1}")
+        # a request still in flight with the token just rejected gets its replacement
+        self.assertEqual(refresh_authorization(f"Bearer {3 * MAX_AUTH_REFRESHERS - 1}"),
+                         f"Bearer {3 * MAX_AUTH_REFRESHERS}")
+        self.assertLessEqual(len(sleephq_client._replaced_tokens), MAX_AUTH_REFRESHERS)
+
+
+if __name__ == '__main__':
+    unittest.main()
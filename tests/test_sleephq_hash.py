@@ -0,0 +1,245 @@
+""" Tests for the SleepHQ content hash in sleephq_hash.py
+
+Run from the scripts folder with:
+    python3 -m unittest discover tests
+"""
+import hashlib
+import os
+import random
+import shutil
+import tempfile
+import unittest
+from unittest import mock
+
+import sleephq_hash
+from sleephq_hash import calculate_content_hash, calculate_content_hash_incremental, CheckpointContentHasher
+from sleephq_hash import ContentHasher, HashCache, ResumableMD5, transform_chunk, _get_libcrypto
+from transfer_data import copy_once
+
+# (file data, file name, SleepHQ content hash).  The hashes were worked out once
+# with hashlib.md5(data.decode('latin-1').encode('utf-8') + name.encode('utf-8'))
+# and are fixed here, so any change to the hash engine that changes them fails
+GOLDEN_VECTORS = [
+    # empty file: the hash of the file name alone
+    (b"", "config.pcfg", "bc07839c837306b8b561df0f18b64761"),
+    # ascii bytes encode to themselves
+    (b"SleepHQ", "config.pcfg", "deb049e54e9edfe31a8467d1def8c394"),
+    # 0xC3 0xA9 expand to C3 83 C2 A9, not the UTF-8 "e acute" they look like
+    (b"\xc3\xa9", "config.pcfg", "0e372641fcd80049274447e06c28a944"),
+    # every byte value, 0x80-0xFF expand to two bytes
+    (bytes(range(256)), "therapy.pdat", "15a9c572da9667e3a81e8a6f5cfdf05b"),
+    # the file name is added UTF-8 encoded
+    (bytes(range(256)), "th\u00e9rapie.pdat", "273f529922e1570d364b56c7ded7fb58"),
+    # just over the 1 MiB CHUNK_SIZE, with an odd length
+    (bytes(range(256)) * 4099 + b"\xff", "therapy.pdat", "917e5d8e50210b9d9cc85bd5c0fef57f"),
+]
+
+
+def legacy_calculate_md5(full_file_name):
+    """
+    The byte by byte hash the uploader used before sleephq_hash.py, kept as the reference
+    """
+    hasher = hashlib.md5()  # Create a hasher instance
+    short_file_name = os.path.basename(full_file_name)
+    with open(full_file_name, 'rb') as f:
+        for chunk in iter(lambda: f.read(4096), b''):
+            utf8_chunk = ''.join([chr(b) for b in chunk])
+            hasher.update(utf8_chunk.encode('utf-8'))
+    # Update the hasher with the file name encoded in UTF-8
+    hasher.update(short_file_name.encode('utf-8'))
+    return hasher.hexdigest()
+
+
+class LegacyHashTest(unittest.TestCase):
+    """
+     calculate_content_hash must give the same hash as the byte by byte loop it replaced
+    """
+
+    def setUp(self):
+        self.work_dir = tempfile.mkdtemp(prefix="prisma-test-")
+        # a fixed seed so a failure can be repeated
+        self.random = random.Random(20250107)
+
+    def tearDown(self):
+        shutil.rmtree(self.work_dir)
+
+    def random_data(self, size):
+        # mostly ascii with some high bytes, all high bytes, or any byte
+        kind = self.random.choice(("text", "high", "any"))
+        if kind == "text":
+            return bytes(self.random.choice(b"0123456789 abcdef\n\xe9\xff") for _ in range(size))
+        if kind == "high":
+            return bytes(self.random.randrange(0x80, 0x100) for _ in range(size))
+        return self.random.randbytes(size)
+
+    def test_random_files(self):
+        chunk_size = 1024
+        # sizes around the chunk boundaries of the new hasher and the 4096 byte reads of the old one
+        sizes = [0, 1, 2, 127, 128, chunk_size - 1, chunk_size, chunk_size + 1, 4095, 4096, 4097,
+                 3 * chunk_size + 17] + [self.random.randrange(1, 40000) for _ in range(8)]
+        for size in sizes:
+            file_name = os.path.join(self.work_dir, self.random.choice(('config.pcfg', 'therapy.pdat')))
+            with open(file_name, 'wb') as f:
+                f.write(self.random_data(size))
+            expected = legacy_calculate_md5(file_name)
+            for use_mmap in (False, True):
+                with self.subTest(size=size, use_mmap=use_mmap):
+                    self.assertEqual(calculate_content_hash(file_name, use_mmap, chunk_size), expected)
+                    self.assertEqual(calculate_content_hash(file_name, use_mmap), expected)
+
+
+class GoldenVectorTest(unittest.TestCase):
+    """
+     Every way of computing the SleepHQ content hash must give the fixed hashes
+    """
+
+    def setUp(self):
+        self.work_dir = tempfile.mkdtemp(prefix="prisma-test-")
+
+    def tearDown(self):
+        shutil.rmtree(self.work_dir)
+
+    def write(self, data, name):
+        file_name = os.path.join(self.work_dir, name)
+        with open(file_name, 'wb') as f:
+            f.write(data)
+        return file_name
+
+    def test_calculate_content_hash(self):
+        for data, name, expected in GOLDEN_VECTORS:
+            file_name = self.write(data, name)
+            # chunk sizes that split the data and the two byte expansions at odd places
+            for chunk_size in (1, 7, 1000, sleephq_hash.CHUNK_SIZE):
+                if chunk_size == 1 and len(data) > 4096:
+                    continue
+                for use_mmap in (False, True):
+                    with self.subTest(name=name, size=len(data), chunk_size=chunk_size, use_mmap=use_mmap):
+                        self.assertEqual(calculate_content_hash(file_name, use_mmap, chunk_size), expected)
+
+    def test_short_name(self):
+        for data, name, expected in GOLDEN_VECTORS:
+            file_name = self.write(data, 'renamed.tmp')
+            with self.subTest(name=name, size=len(data)):
+                self.assertEqual(calculate_content_hash(file_name, short_name=name), expected)
+
+    def test_content_hasher(self):
+        for data, name, expected in GOLDEN_VECTORS:
+            hasher = ContentHasher(name)
+            for offset in range(0, len(data), 999):
+                hasher.update(data[offset:offset + 999])
+            with self.subTest(name=name, size=len(data)):
+                self.assertEqual(hasher.hexdigest(), expected)
+                self.assertEqual(hasher.length, len(data))
+
+    def resumable_hash(self, data, name):
+        # the state is saved and restored after every chunk, as between two runs
+        state = None
+        for offset in range(0, len(data), 100003):
+            hasher = ResumableMD5(state)
+            hasher.update(transform_chunk(data[offset:offset + 100003]))
+            state = hasher.state()
+        hasher = ResumableMD5(state)
+        hasher.update(name.encode('utf-8'))
+        return hasher.hexdigest()
+
+    def test_resumable_md5(self):
+        for data, name, expected in GOLDEN_VECTORS:
+            with self.subTest(name=name, size=len(data), native=_get_libcrypto() is not None):
+                self.assertEqual(self.resumable_hash(data, name), expected)
+            # the pure python fallback used when OpenSSL can't be loaded
+            with mock.patch.object(sleephq_hash, '_get_libcrypto', return_value=None):
+                with self.subTest(name=name, size=len(data), native=False):
+                    self.assertEqual(self.resumable_hash(data, name), expected)
+
+    def test_incremental(self):
+        data, name, expected = GOLDEN_VECTORS[-1]
+        file_name = self.write(data[:sleephq_hash.INCREMENTAL_MIN_SIZE + 5], name)
+        _, checkpoint = calculate_content_hash_incremental(file_name, chunk_size=1000)
+        self.write(data, name)
+        self.assertEqual(calculate_content_hash_incremental(file_name, checkpoint, chunk_size=1000)[0], expected)
+        hasher = CheckpointContentHasher(name, checkpoint)
+        for offset in range(0, len(data), 100003):
+            hasher.update(data[offset:offset + 100003])
+        self.assertEqual(hasher.hexdigest(), expected)
+
+
+class IncrementalHashTest(unittest.TestCase):
+    """
+     Resuming from a checkpoint must always give the hash of the whole file
+    """
+
+    def setUp(self):
+        self.work_dir = tempfile.mkdtemp(prefix="prisma-test-")
+        self.file_name = os.path.join(self.work_dir, 'therapy.pdat')
+        with open(self.file_name, 'wb') as f:
+            f.write(os.urandom(1024 * 1024))
+
+    def tearDown(self):
+        shutil.rmtree(self.work_dir)
+
+    def change_byte(self, offset):
+        with open(self.file_name, 'r+b') as f:
+            f.seek(offset)
+            byte = f.read(1)
+            f.seek(offset)
+            f.write(bytes([byte[0] ^ 0xFF]))
+
+    def append(self, size):
+        with open(self.file_name, 'ab') as f:
+            f.write(os.urandom(size))
+
+    def test_append(self):
+        _, checkpoint = calculate_content_hash_incremental(self.file_name)
+        self.append(300000)
+        file_hash, _ = calculate_content_hash_incremental(self.file_name, checkpoint)
+        self.assertEqual(file_hash, calculate_content_hash(self.file_name))
+
+    def test_rewrite_outside_sampled_windows(self):
+        _, checkpoint = calculate_content_hash_incremental(self.file_name)
+        self.change_byte(100000)
+        self.append(1000)
+        file_hash, _ = calculate_content_hash_incremental(self.file_name, checkpoint)
+        self.assertEqual(file_hash, calculate_content_hash(self.file_name))
+
+    def test_hash_cache_rewrite(self):
+        hash_cache = HashCache(os.path.join(self.work_dir, 'cache.json'))
+        hash_cache.get_hash(self.file_name)
+        self.change_byte(100000)
+        self.append(1000)
+        self.assertEqual(hash_cache.get_hash(self.file_name), calculate_content_hash(self.file_name))
+
+    def test_copy_once_checkpoints(self):
+        card_file = self.file_name
+        archived = os.path.join(self.work_dir, 'archived')
+        file_hash, length, _, checkpoint = copy_once(card_file, archived, 'therapy.pdat')
+        self.assertEqual(file_hash, calculate_content_hash(card_file))
+        if _get_libcrypto() is None:
+            self.assertIsNone(checkpoint)
+            return
+        self.assertEqual(checkpoint['prefix_length'], length)
+        # appended: resumed from the checkpoint
+        self.append(200000)
+        file_hash, _, _, checkpoint = copy_once(card_file, archived, 'therapy.pdat', checkpoint)
+        self.assertEqual(file_hash, calculate_content_hash(card_file))
+        # rewritten: the copy is hashed again
+        self.change_byte(100000)
+        self.append(1000)
+        file_hash, _, _, checkpoint = copy_once(card_file, archived, 'therapy.pdat', checkpoint)
+        self.assertEqual(file_hash, calculate_content_hash(card_file))
+        # the checkpoint taken after the rewrite is usable
+        self.append(1000)
+        file_hash, _ = calculate_content_hash_incremental(card_file, checkpoint)
+        self.assertEqual(file_hash, calculate_content_hash(card_file))
+
+    def test_shorter_than_checkpoint(self):
+        if _get_libcrypto() is None:
+            self.skipTest("no OpenSSL MD5")
+        _, checkpoint = calculate_content_hash_incremental(self.file_name)
+        hasher = CheckpointContentHasher('therapy.pdat', checkpoint)
+        with open(self.file_name, 'rb') as f:
+            hasher.update(f.read(1000))
+        self.assertIsNone(hasher.hexdigest())
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,70 @@
+""" Tests for transfer_data.py and the archive store links it makes
+
+Run from the scripts folder with:
+    python3 -m unittest discover tests
+"""
+import datetime
+import os
+import shutil
+import tempfile
+import unittest
+
+from prisma_state import list_files
+from transfer_data import create_year_month_folders, duplicate_local
+
+
+class TransferTwiceTest(unittest.TestCase):
+    """
+     Two transfers of unchanged card files, as when config.pcfg has not changed
+     since the previous night or the button is pressed twice on the same day
+    """
+
+    def setUp(self):
+        self.old_cwd = os.getcwd()
+        self.work_dir = tempfile.mkdtemp(prefix="prisma-test-")
+        os.chdir(self.work_dir)
+        self.card = os.path.join(self.work_dir, 'card')
+        self.archive = os.path.join(self.work_dir, 'archive') + os.sep
+        self.data = os.path.join(self.work_dir, 'data')
+        for folder in (self.card, self.archive, self.data):
+            os.makedirs(folder)
+        with open(os.path.join(self.card, 'config.pcfg'), 'wb') as f:
+            f.write(bytes(range(256)) * 12)
+        with open(os.path.join(self.card, 'therapy.pdat'), 'wb') as f:
+            f.write(os.urandom(300000))
+
+    def tearDown(self):
+        os.chdir(self.old_cwd)
+        shutil.rmtree(self.work_dir)
+
+    def all_files(self, folder):
+        return sorted(os.path.relpath(os.path.join(dirpath, f), folder)
+                      for dirpath, dirnames, filenames in os.walk(folder) for f in filenames)
+
+    def test_no_tmp_files_left(self):
+        create_year_month_folders(self.archive, self.card, self.data)
+        create_year_month_folders(self.archive, self.card, self.data)
+        day = datetime.date.today().strftime(os.path.join('%Y', '%m', '%d'))
+        for folder in (self.data, os.path.join(self.archive, day)):
+            self.assertEqual(self.all_files(folder), ['config.pcfg', 'therapy.pdat'])
+        self.assertFalse([f for f in self.all_files(self.archive) if f.endswith('.tmp')])
+        self.assertEqual(sorted(name for name, _ in list_files(self.data)), ['config.pcfg', 'therapy.pdat'])
+        with open(os.path.join(self.data, 'therapy.pdat'), 'rb') as copy, \
+                open(os.path.join(self.card, 'therapy.pdat'), 'rb') as original:
+            self.assertEqual(copy.read(), original.read())
+
+    def test_duplicate_local_same_file(self):
+        source = os.path.join(self.card, 'config.pcfg')
+        destination = os.path.join(self.data, 'config.pcfg')
+        self.assertEqual(duplicate_local(source, destination), "hardlink")
+        self.assertEqual(duplicate_local(source, destination), "hardlink")
+        self.assertEqual(os.listdir(self.data), ['config.pcfg'])
+
+    def test_list_files_skips_tmp(self):
+        for name in ('config.pcfg', 'therapy.pdat', 'therapy.pdat.tmp'):
+            open(os.path.join(self.data, name), 'wb').close()
+        self.assertEqual(sorted(name for name, _ in list_files(self.data)), ['config.pcfg', 'therapy.pdat'])
+
+
+if __name__ == '__main__':
+    unittest.main()
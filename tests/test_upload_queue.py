@@ -0,0 +1,135 @@
+""" Tests for upload_queue.py
+
+Run from the scripts folder with:
+    python3 -m unittest discover tests
+"""
+import os
+import shutil
+import tempfile
+import unittest
+
+from upload_queue import MAX_ATTEMPTS, RETRY_FIRST_DELAY, RETRY_MAX_DELAY, UploadQueue, drain, retry_delay
+
+
+class Failure(SystemExit):
+    def __init__(self, message, permanent):
+        super().__init__(1)
+        self.message = message
+        self.permanent = permanent
+
+
+class QueueTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.work_dir = tempfile.mkdtemp(prefix="prisma-test-")
+        self.queue = UploadQueue(os.path.join(self.work_dir, 'queue.db'))
+
+    def tearDown(self):
+        self.queue.close()
+        shutil.rmtree(self.work_dir)
+
+    def job(self, job_id):
+        return [job for job in self.queue.jobs() if job['id'] == job_id][0]
+
+
+class SupersedeTest(QueueTestCase):
+
+    def test_newer_snapshot_supersedes_pending(self):
+        first = self.queue.add("/archive/2026/10/16")
+        second = self.queue.add("/archive/2026/10/17")
+        self.assertEqual(self.job(first)['state'], "superseded")
+        self.assertEqual(self.queue.claim()['id'], second)
+        self.assertIsNone(self.queue.claim())
+
+    def test_running_job_not_superseded(self):
+        first = self.queue.add("/archive/2026/10/16")
+        self.queue.claim()
+        second = self.queue.add("/archive/2026/10/17")
+        self.assertEqual(self.job(first)['state'], "running")
+        # the newer snapshot is taken ahead of the retry of the older one
+        self.queue.fail(first, "timed out")
+        self.assertEqual(self.queue.claim(now=float('inf'))['id'], second)
+
+    def test_failed_job_superseded_by_newer(self):
+        first = self.queue.add("/archive/2026/10/16")
+        self.queue.claim()
+        self.queue.fail(first, "timed out")
+        second = self.queue.add("/archive/2026/10/17")
+        self.assertEqual(self.job(first)['state'], "superseded")
+        self.assertEqual(self.queue.claim()['id'], second)
+
+
+class BackoffTest(QueueTestCase):
+
+    def test_retry_delay_doubles_to_max(self):
+        delays = [retry_delay(attempts, jitter=0) for attempts in range(1, 10)]
+        self.assertEqual(delays[:4], [RETRY_FIRST_DELAY * 2 ** n for n in range(4)])
+        self.assertEqual(delays[-1], RETRY_MAX_DELAY)
+        self.assertEqual(max(delays), 3600)
+        for attempts in range(1, 60):
+            self.assertLessEqual(retry_delay(attempts), RETRY_MAX_DELAY * 1.2)
+
+    def test_fail_schedules_retry(self):
+        job_id = self.queue.add("/archive/2026/10/18")
+        self.queue.claim()
+        delay = self.queue.fail(job_id, "timed out")
+        self.assertTrue(RETRY_FIRST_DELAY * 0.8 <= delay <= RETRY_FIRST_DELAY * 1.2)
+        job = self.job(job_id)
+        self.assertEqual((job['state'], job['attempts']), ("pending", 1))
+        # not due until the delay has passed
+        self.assertIsNone(self.queue.claim())
+        self.assertEqual(self.queue.claim(now=job['next_attempt'])['id'], job_id)
+
+    def test_given_up_after_max_attempts(self):
+        job_id = self.queue.add("/archive/2026/10/18")
+        for attempt in range(1, MAX_ATTEMPTS + 1):
+            self.assertEqual(self.queue.claim(now=float('inf'))['id'], job_id)
+            delay = self.queue.fail(job_id, f"failure {attempt}")
+            if attempt < MAX_ATTEMPTS:
+                self.assertIsNotNone(delay)
+        self.assertIsNone(delay)
+        job = self.job(job_id)
+        self.assertEqual((job['state'], job['attempts'], job['last_error']),
+                         ("failed", MAX_ATTEMPTS, f"failure {MAX_ATTEMPTS}"))
+        self.assertIsNone(self.queue.claim(now=float('inf')))
+
+
+class DrainTest(QueueTestCase):
+
+    def drain_failing(self, permanent):
+        def upload(path):
+            raise Failure("rejected", permanent)
+        job_id = self.queue.add("/archive/2026/10/18")
+        with self.assertRaises(Failure):
+            drain(self.queue, upload)
+        return self.job(job_id)
+
+    def test_newest_uploaded(self):
+        uploaded = []
+
+        def upload(path):
+            uploaded.append(path)
+            return "complete"
+        self.queue.add("/archive/2026/10/17")
+        job_id = self.queue.add("/archive/2026/10/18")
+        self.assertEqual(drain(self.queue, upload), "complete")
+        self.assertEqual(uploaded, ["/archive/2026/10/18"])
+        self.assertEqual((self.job(job_id)['state'], self.job(job_id)['status']), ("done", "complete"))
+
+    def test_nothing_new(self):
+        job_id = self.queue.add("/archive/2026/10/18")
+        self.assertIsNone(drain(self.queue, lambda path: None))
+        self.assertEqual(self.job(job_id)['status'], "nothing new")
+
+    def test_temporary_failure_is_retried(self):
+        job = self.drain_failing(permanent=False)
+        self.assertEqual((job['state'], job['attempts']), ("pending", 1))
+
+    def test_permanent_failure_is_given_up(self):
+        job = self.drain_failing(permanent=True)
+        self.assertEqual((job['state'], job['last_error']), ("failed", "rejected"))
+        self.assertIsNone(self.queue.next_due())
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,178 @@
+""" Tests for prisma20a_sleephq_uploader.py against the SleepHQ stand-in
+
+Run from the scripts folder with:
+    python3 -m unittest discover tests
+"""
+import importlib.util
+import itertools
+import logging
+import os
+import shutil
+import tempfile
+import time
+import unittest
+from unittest import mock
+
+for module_name, package in (("requests", "requests"), ("dotenv", "python-dotenv")):
+    if importlib.util.find_spec(module_name) is None:
+        raise unittest.SkipTest(f"needs the {module_name} module, run: pip3 install {package}")
+
+import prisma20a_sleephq_uploader as uploader
+from sleephq_client import set_base_url
+from sleephq_standin import start_standin, StandinOptions
+
+HEADERS = {'Authorization': "Bearer standin-token", 'Accept': 'application/json'}
+NTFY = uploader.NTFY("NO", None, None, logging)
+
+
+class StandinTestCase(unittest.TestCase):
+    """
+     Starts a stand-in server for each test and points the uploader at it
+    """
+    options = {}
+
+    def setUp(self):
+        self.work_dir = tempfile.mkdtemp(prefix="prisma-test-")
+        self.standin = start_standin(StandinOptions(**self.options))
+        set_base_url(f"http://127.0.0.1:{self.standin.server_port}")
+
+    def tearDown(self):
+        self.standin.shutdown()
+        self.standin.server_close()
+        shutil.rmtree(self.work_dir)
+
+    def requests_to(self, endpoint):
+        return self.standin.state.snapshot()['endpoints'].get(endpoint, {}).get('requests', 0)
+
+
+class UploadFilesTest(StandinTestCase):
+    options = {'latency': 0.4, 'rate_limit_every': 3, 'retry_after': 0}
+
+    def make_files(self, count):
+        files = []
+        for number in range(count):
+            name = f"file{number}.pdat"
+            full_name = os.path.join(self.work_dir, name)
+            with open(full_name, 'wb') as f:
+                f.write(bytes([number]) * 1000 + bytes(range(256)))
+            # half of the files are hashed while they are sent
+            file_hash = uploader.calculate_content_hash(full_name) if number % 2 else None
+            files.append(uploader.FileDetails(name, full_name, file_hash))
+        return files
+
+    def test_parallel_upload_with_rate_limiting(self):
+        files = self.make_files(6)
+        import_id = uploader.reserve_import_id("1", HEADERS, NTFY)
+        start = time.monotonic()
+        results = uploader.upload_files(import_id, HEADERS, files, NTFY, max_workers=3)
+        elapsed = time.monotonic() - start
+        self.assertEqual([str(result) for result in results], [f"{item.ShortName}: uploaded" for item in files])
+        imported = self.standin.state.snapshot()['imports'][str(import_id)]['files']
+        self.assertEqual(sorted(imported), sorted(item.ShortName for item in files))
+        # every third upload was answered with HTTP 429 and sent again
+        self.assertGreater(self.requests_to('files'), len(files))
+        # one after another the uploads would take at least 0.4s each
+        self.assertLess(elapsed, 0.4 * self.requests_to('files'))
+        self.assertTrue(all(item.FileHash is not None for item in files))
+
+
+class RunPipelineTest(StandinTestCase):
+    """
+     An unchanged config.pcfg next to new therapy data
+    """
+    options = {'processing_time': 0.1}
+
+    def setUp(self):
+        super().setUp()
+        self.data = os.path.join(self.work_dir, 'data')
+        os.makedirs(self.data)
+        for name, size in (('config.pcfg', 3000), ('therapy.pdat', 20000)):
+            with open(os.path.join(self.data, name), 'wb') as f:
+                f.write(os.urandom(size))
+        self.hash_cache = uploader.HashCache(os.path.join(self.work_dir, 'prisma-hash-cache.json'))
+        self.ledger = uploader.UploadLedger(os.path.join(self.work_dir, 'prisma-upload-ledger.json'))
+        self.cred_cache = uploader.CredentialCache(os.path.join(self.work_dir, 'prisma-token-cache.json'))
+        patcher = mock.patch.object(uploader, 'poll_delays', lambda: itertools.repeat(0.05))
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def run_pipeline(self):
+        return uploader.run_pipeline("client", "secret", "1", "ANY", self.data, NTFY, self.hash_cache,
+                                     self.ledger, self.cred_cache)
+
+    def imported_files(self):
+        return [sorted(entry['files']) for entry in self.standin.state.snapshot()['imports'].values()]
+
+    def test_full_set_sent(self):
+        config_hash = uploader.calculate_content_hash(os.path.join(self.data, 'config.pcfg'))
+        self.ledger.record(config_hash, 'config.pcfg', 1, "complete")
+        self.assertEqual(self.run_pipeline(), "complete")
+        self.assertEqual(self.imported_files(), [['config.pcfg', 'therapy.pdat']])
+        self.assertEqual(self.ledger.entries[config_hash]['import_id'], 1000)
+
+    def test_nothing_new(self):
+        self.assertEqual(self.run_pipeline(), "complete")
+        self.assertIsNone(self.run_pipeline())
+        self.assertEqual(self.imported_files(), [['config.pcfg', 'therapy.pdat']])
+
+
+class PollDelaysTest(unittest.TestCase):
+
+    def test_grows_to_max(self):
+        delays = list(itertools.islice(uploader.poll_delays(jitter=0), 12))
+        for delay, expected in zip(delays, (2.0, 3.2, 5.12, 8.192)):
+            self.assertAlmostEqual(delay, expected)
+        self.assertEqual(delays, sorted(delays))
+        self.assertEqual(delays[-3:], [30.0] * 3)
+
+    def test_jitter_bounded(self):
+        for delay in itertools.islice(uploader.poll_delays(first_delay=10, factor=1, jitter=0.2), 200):
+            self.assertTrue(8.0 <= delay <= 12.0)
+
+
+class WaitForImportTest(StandinTestCase):
+    options = {'processing_time': 0.3}
+
+    def setUp(self):
+        super().setUp()
+        # the same schedule a hundred times faster
+        fast_delays = uploader.poll_delays(0.02, 1.6, 0.3)
+        patcher = mock.patch.object(uploader, 'poll_delays', lambda: fast_delays)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.import_id = uploader.reserve_import_id("1", HEADERS, NTFY)
+        uploader.process_imported_files(self.import_id, HEADERS, NTFY)
+
+    def test_complete(self):
+        self.assertEqual(uploader.wait_for_import(self.import_id, HEADERS, NTFY, deadline=10), ("complete", None))
+        # polled more than once, but far fewer times than a fixed short interval would
+        self.assertGreater(self.requests_to('import_status'), 1)
+        self.assertLess(self.requests_to('import_status'), 10)
+
+    def test_failed(self):
+        self.standin.state.options.fail_imports = True
+        self.assertEqual(uploader.wait_for_import(self.import_id, HEADERS, NTFY, deadline=10),
+                         ("failed", "injected failure"))
+        with self.assertRaises(uploader.UploadFailed):
+            uploader.check_imported_files(self.import_id, HEADERS, NTFY, deadline=10)
+
+    def test_other_failed_states(self):
+        for status in uploader.IMPORT_FAILED_STATES:
+            with self.subTest(status=status):
+                self.standin.state.imports[str(self.import_id)]['status'] = status
+                start = time.monotonic()
+                self.assertEqual(uploader.wait_for_import(self.import_id, HEADERS, NTFY, deadline=10)[0], status)
+                self.assertLess(time.monotonic() - start, 1)
+
+    def test_timeout(self):
+        self.standin.state.options.processing_time = 60
+        start = time.monotonic()
+        self.assertEqual(uploader.wait_for_import(self.import_id, HEADERS, NTFY, deadline=0.5)[0], "timeout")
+        self.assertLess(time.monotonic() - start, 1.5)
+        with self.assertRaises(uploader.UploadFailed) as failure:
+            uploader.check_imported_files(self.import_id, HEADERS, NTFY, deadline=0.3)
+        self.assertIn("did not finish processing", failure.exception.message)
+
+
+if __name__ == '__main__':
+    unittest.main()
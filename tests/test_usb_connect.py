@@ -0,0 +1,100 @@
+""" Tests for the button monitor in usb_connect.py, with simulated button edges
+
+Run from the scripts folder with:
+    python3 -m unittest discover tests
+"""
+import logging
+import os
+import shutil
+import tempfile
+import threading
+import time
+import unittest
+
+from usb_connect import ButtonMonitor, SimulatedButton
+
+
+class StubYkush:
+    """
+     Holds the port on until allowed to carry on, so a cycle can be kept running
+    """
+
+    def __init__(self):
+        self.carry_on = threading.Event()
+        self.power_ons = 0
+        self.power_offs = 0
+
+    def power_on(self):
+        self.power_ons += 1
+        self.carry_on.wait(5)
+        return True
+
+    def power_off(self):
+        self.power_offs += 1
+        return True
+
+
+class ButtonMonitorTest(unittest.TestCase):
+
+    def setUp(self):
+        self.work_dir = tempfile.mkdtemp(prefix="prisma-test-")
+        self.ykush = StubYkush()
+        # the card is never mounted, each cycle ends with the short timeout
+        self.monitor = ButtonMonitor(self.ykush, os.path.join(self.work_dir, 'card'), cycle_timeout=0.1,
+                                     logger=logging.getLogger('prisma.test'))
+        self.button = SimulatedButton()
+        self.button.start(self.monitor.edge)
+
+    def tearDown(self):
+        self.ykush.carry_on.set()
+        self.finish_cycle()
+        shutil.rmtree(self.work_dir)
+
+    def finish_cycle(self):
+        cycle = self.monitor.cycle
+        self.ykush.carry_on.set()
+        if cycle is not None:
+            cycle.join(5)
+        self.ykush.carry_on.clear()
+
+    def test_bounces_are_one_press(self):
+        # press with contact bounce on the way down and up, all within the debounce window
+        for offset, pressed in ((0.0, True), (0.01, False), (0.02, True), (0.05, False), (0.08, True),
+                                (0.3, False), (0.31, True), (0.33, False)):
+            self.monitor.edge(pressed, 100.0 + offset)
+        self.finish_cycle()
+        self.assertEqual(self.ykush.power_ons, 1)
+        self.assertEqual(self.monitor.coalesced, 0)
+
+    def test_presses_during_cycle_coalesced(self):
+        self.button.press()
+        time.sleep(0.3)
+        self.button.release()
+        for _ in range(3):
+            time.sleep(0.3)
+            self.button.press()
+            time.sleep(0.3)
+            self.button.release()
+        self.assertEqual(self.monitor.coalesced, 3)
+        self.finish_cycle()
+        self.assertEqual((self.ykush.power_ons, self.ykush.power_offs), (1, 1))
+        # the next press after the cycle starts a new one
+        time.sleep(0.3)
+        self.button.press()
+        self.finish_cycle()
+        self.assertEqual(self.ykush.power_ons, 2)
+        self.assertEqual(self.monitor.coalesced, 0)
+
+    def test_edges_from_file(self):
+        edges = os.path.join(self.work_dir, 'button')
+        with open(edges, 'w') as f:
+            f.write("press\n0\n1\nrelease\n")
+        button = SimulatedButton(edges)
+        button.start(self.monitor.edge)
+        time.sleep(0.2)
+        self.finish_cycle()
+        self.assertEqual(self.ykush.power_ons, 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
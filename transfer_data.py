@@ -1,12 +1,126 @@
 import os
 import datetime
 import shutil
+import time
+import fcntl
+import hashlib
 
-def create_year_month_folders():
+from archive_catalogue import ArchiveCatalogue, CATALOGUE_FILE
+from archive_store import ArchiveStore
+from nas_sync import record_changes
+from sleephq_hash import CheckpointContentHasher, HashCache, INCREMENTAL_MIN_SIZE
+from sleephq_hash import calculate_content_hash_incremental
+from upload_queue import UploadQueue, QUEUE_FILE
+
+# Size of each read from the SD card
+CHUNK_SIZE = 1024 * 1024
+# ioctl request to clone (reflink) a file on btrfs/xfs, from linux/fs.h
+FICLONE = 0x40049409
+ARCHIVE_PATH = "/home/USER/prisma/archive/"
+MOUNT_PATH = "/media/USER/Weinmann"
+DATA_PATH = "/home/USER/prisma/data"
+CARD_FILES = ["config.pcfg", "therapy.pdat",]
+
+
+def copy_once(source, destination, short_name=None, checkpoint=None):
+    """Copies source to destination reading it only once.
+
+    The SleepHQ content hash and the SHA-256 used by the archive store are
+    calculated from the same reads.  Given the hash checkpoint of the previous
+    snapshot, the data it covers is only checked against it and not hashed
+    again; if the file was rewritten rather than appended to, the copy is
+    hashed in full.  The copy is written to a temporary file first so a failed
+    copy never replaces a good one.
+    Returns the content hash, the number of bytes copied, the SHA-256 and a new
+    checkpoint, or None for it when the file is too small to need one.
+    """
+    short_name = short_name or os.path.basename(destination)
+    hasher = CheckpointContentHasher(short_name, checkpoint)
+    sha256 = hashlib.sha256()
+    tmp_destination = destination + ".tmp"
+    with open(source, 'rb') as src, open(tmp_destination, 'wb') as dst:
+        for chunk in iter(lambda: src.read(CHUNK_SIZE), b''):
+            dst.write(chunk)
+            hasher.update(chunk)
+            sha256.update(chunk)
+        dst.flush()
+        os.fsync(dst.fileno())
+    file_hash = hasher.hexdigest()
+    new_checkpoint = hasher.checkpoint(tmp_destination) if hasher.length >= INCREMENTAL_MIN_SIZE else None
+    if file_hash is None:
+        # the previous snapshot is not a prefix of this one, hash the local copy instead of the card
+        file_hash, new_checkpoint = calculate_content_hash_incremental(tmp_destination, short_name=short_name)
+    os.replace(tmp_destination, destination)
+    return file_hash, hasher.length, sha256.hexdigest(), new_checkpoint
+
+
+def duplicate_local(source, destination):
+    """Makes destination a copy of the local file source without reading the SD card.
+
+    Tries a hardlink, then a reflink, then an in-kernel copy, and finally a
+    plain copy.  The destination is replaced rather than overwritten, as it may
+    be a hardlink to an older archived file that must not change.
+    Returns the method used.
+    """
+    tmp_destination = destination + ".tmp"
+    if os.path.lexists(tmp_destination):
+        os.unlink(tmp_destination)
+    if os.path.lexists(destination) and os.path.samefile(source, destination):
+        # already a hardlink to source, renaming another link over it would leave the .tmp behind
+        return "hardlink"
+    try:
+        os.link(source, tmp_destination)
+        os.replace(tmp_destination, destination)
+        return "hardlink"
+    except OSError:
+        pass
+    with open(source, 'rb') as src, open(tmp_destination, 'wb') as dst:
+        method = None
+        try:
+            fcntl.ioctl(dst.fileno(), FICLONE, src.fileno())
+            method = "reflink"
+        except OSError:
+            pass
+        if method is None:
+            try:
+                remaining = os.fstat(src.fileno()).st_size
+                while remaining > 0:
+                    copied = os.copy_file_range(src.fileno(), dst.fileno(), remaining)
+                    if copied == 0:
+                        break
+                    remaining -= copied
+                method = "copy_file_range"
+            except (OSError, AttributeError):
+                dst.seek(0)
+                dst.truncate()
+                try:
+                    offset = 0
+                    size = os.fstat(src.fileno()).st_size
+                    while offset < size:
+                        sent = os.sendfile(dst.fileno(), src.fileno(), offset, size - offset)
+                        if sent == 0:
+                            break
+                        offset += sent
+                    method = "sendfile"
+                except OSError:
+                    src.seek(0)
+                    dst.seek(0)
+                    dst.truncate()
+                    shutil.copyfileobj(src, dst, CHUNK_SIZE)
+                    method = "copy"
+    os.replace(tmp_destination, destination)
+    return method
+
+
+def has_new_data(mount_path=MOUNT_PATH, data_path=DATA_PATH):
+    """True if therapy.pdat on the card is newer than the copy in the data folder."""
+    card_file = os.path.join(mount_path, "therapy.pdat")
+    data_file = os.path.join(data_path, "therapy.pdat")
+    return not os.path.isfile(data_file) or os.path.getmtime(card_file) > os.path.getmtime(data_file)
+
+
+def create_year_month_folders(base_path=ARCHIVE_PATH, mount_path=MOUNT_PATH, data_path=DATA_PATH):
     """Creates folders for the current year and month."""
-    base_path = "/home/USER/prisma/archive/"
-    mount_path = "/media/USER/Weinmann"
-    data_path = "/home/USER/prisma/data"
     now = datetime.datetime.now()
     year_folder = str(now.year)
     month_folder = now.strftime("%m")  # Get month
@@ -26,15 +140,47 @@ def create_year_month_folders():
     if not os.path.exists(day_path):
         os.makedirs(day_path)
 
-    # Copy data from SD card
-    files = ["config.pcfg", "therapy.pdat",]
-    for myfile in files:
+    # Copy data from SD card, each file is read from the card once into the
+    # archive's blob store, the day folder and the data folder get hardlinks
+    # to the blob so unchanged files take no extra space
+    # The hashes are stored in the uploader's hash cache so it does not have
+    # to read the files again
+    store = ArchiveStore(base_path)
+    hash_cache = HashCache('./prisma-hash-cache.json')
+    # each archived file is indexed by day and hash, see archive_catalogue.py
+    catalogue = ArchiveCatalogue(CATALOGUE_FILE)
+    day = f"{year_folder}-{month_folder}-{day_folder}"
+    card_time = 0.0
+    card_bytes = 0
+    for myfile in CARD_FILES:
         destination = os.path.join(base_path, year_folder, month_folder, day_folder, myfile)
         source = os.path.join(mount_path, myfile)
         pdata = os.path.join(data_path, myfile)
-        shutil.copyfile(source, destination)
-        shutil.copyfile(source, pdata)
+        start = time.monotonic()
+        # the data folder copy holds the previous snapshot, only the data appended since is hashed
+        previous = hash_cache.entries.get(os.path.abspath(pdata), {}).get('checkpoint')
+        file_hash, length, sha256, checkpoint = copy_once(source, store.new_temp_file(myfile), myfile, previous)
+        card_time += time.monotonic() - start
+        card_bytes += length
+        blob = store.add(store.new_temp_file(myfile), sha256)
+        store.link(blob, destination)
+        method = duplicate_local(blob, pdata)
+        hash_cache.store(os.path.abspath(destination), os.stat(destination), file_hash, checkpoint)
+        hash_cache.store(os.path.abspath(pdata), os.stat(pdata), file_hash, checkpoint)
+        catalogue.record(day, myfile, length, os.stat(destination).st_mtime, file_hash, sha256)
+        print(f"Copied {myfile} ({length} bytes), data folder copy by {method}")
+    hash_cache.save()
+    catalogue.close()
+    # the NAS sync only pushes the archive files listed in its journal
+    record_changes(store.changes)
+    # the uploader picks the snapshot up from the queue, and retries it if SleepHQ
+    # can't be reached
+    queue = UploadQueue(QUEUE_FILE)
+    try:
+        queue.add(os.path.abspath(day_path))
+    finally:
+        queue.close()
+    print(f"Read {card_bytes} bytes from the SD card in {card_time:.2f}s")
 
 if __name__ == "__main__":
     create_year_month_folders()
-
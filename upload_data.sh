@@ -3,16 +3,22 @@ sleep 10
 if grep -qs '/media/USER/Weinmann ' /proc/mounts; then
     file_today="/media/USER/Weinmann/therapy.pdat"
     file_prev="/home/USER/prisma/data/therapy.pdat"
+    new_data="NO"
 	if [[ ! -f "$file_prev" || "$file_today" -nt "$file_prev" ]]; then
 		cd /home/USER/prisma/scripts
 		/home/USER/prisma/mypython/bin/python3 /home/USER/prisma/scripts/transfer_data.py
-		/home/USER/prisma/mypython/bin/python3 /home/USER/prisma/scripts/prisma20a_sleephq_uploader.py
-		./nas_sync.sh
+		new_data="YES"
 	fi
+	# the card is no longer needed once the files are copied, release the
+	# Prisma before uploading so it does not wait on SleepHQ
 	sleep 1
     umount /dev/sda
 	sleep 1
     sudo ykushcmd ykushxs -d
+	if [[ "$new_data" == "YES" ]]; then
+		/home/USER/prisma/mypython/bin/python3 /home/USER/prisma/scripts/prisma20a_sleephq_uploader.py
+		./nas_sync.sh
+	fi
 else
     echo "It's not mounted."
 fi
\ No newline at end of file
@@ -0,0 +1,249 @@
+""" Persistent upload queue
+
+Every snapshot copied off the card by transfer_data.py becomes an upload job
+in a small SQLite database, so a night's data is not lost when Wi-Fi or SleepHQ
+is down.  Failed jobs are retried with exponential backoff by whoever drains the
+queue next: the uploader, or the background worker in prisma_daemon.py.
+
+therapy.pdat is cumulative, so a new snapshot holds everything an older one
+does.  Adding a job therefore supersedes every job still waiting, and after an
+outage only the newest snapshot is uploaded.
+
+Usage:
+    python3 upload_queue.py            # list the jobs
+    python3 upload_queue.py --retry    # make waiting jobs due now
+"""
+import argparse
+import random
+import sqlite3
+import threading
+import time
+
+QUEUE_FILE = "./prisma-upload-queue.db"
+# Seconds before the first retry, doubled after every failure up to RETRY_MAX_DELAY
+RETRY_FIRST_DELAY = 60
+RETRY_MAX_DELAY = 3600
+# Give up on a snapshot after this many failures, about two days of hourly retries
+MAX_ATTEMPTS = 48
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    id           INTEGER PRIMARY KEY AUTOINCREMENT,
+    path         TEXT NOT NULL,
+    created      REAL NOT NULL,
+    state        TEXT NOT NULL,
+    attempts     INTEGER NOT NULL DEFAULT 0,
+    next_attempt REAL NOT NULL,
+    last_error   TEXT,
+    status       TEXT,
+    updated      REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS jobs_state ON jobs (state, next_attempt);
+"""
+
+
+def retry_delay(attempts, first_delay=RETRY_FIRST_DELAY, max_delay=RETRY_MAX_DELAY, jitter=0.2):
+    """
+    Return the seconds to wait after a job has failed attempts times
+    """
+    delay = min(max_delay, first_delay * 2 ** (attempts - 1))
+    return delay * random.uniform(1 - jitter, 1 + jitter)
+
+
+class UploadQueue:
+    """
+     Upload jobs kept in SQLite.  Job states are:
+
+        pending    : waiting for its next attempt
+        running    : being uploaded
+        done       : imported, or nothing new to import
+        superseded : replaced by a newer snapshot before it was uploaded
+        failed     : given up after MAX_ATTEMPTS, or after a failure a retry can't fix
+    """
+
+    def __init__(self, queue_file=QUEUE_FILE, max_attempts=MAX_ATTEMPTS):
+        """
+        Construct a new UploadQueue object.  Jobs left running by a killed
+        process are made pending again.
+
+        :param queue_file   : The SQLite database file
+        :param max_attempts : Number of failures before a job is given up
+        """
+        self.queue_file = queue_file
+        self.max_attempts = max_attempts
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(queue_file, timeout=30, check_same_thread=False, isolation_level=None)
+        self.db.row_factory = sqlite3.Row
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=FULL")
+        self.db.executescript(SCHEMA)
+        self.db.execute("UPDATE jobs SET state = 'pending' WHERE state = 'running'")
+
+    def _execute(self, sql, parameters=()):
+        with self.lock:
+            return self.db.execute(sql, parameters)
+
+    def add(self, path):
+        """
+        Queue the snapshot in a folder for upload, superseding every job still waiting
+
+        :param path : folder holding config.pcfg and therapy.pdat
+
+        Return value: the job ID
+        """
+        now = time.time()
+        with self.lock:
+            self.db.execute("BEGIN IMMEDIATE")
+            try:
+                self.db.execute("UPDATE jobs SET state = 'superseded', updated = ? WHERE state = 'pending'",
+                                (now,))
+                cursor = self.db.execute("INSERT INTO jobs (path, created, state, next_attempt, updated) " +
+                                         "VALUES (?, ?, 'pending', ?, ?)", (path, now, now, now))
+                self.db.execute("COMMIT")
+            except BaseException:
+                self.db.execute("ROLLBACK")
+                raise
+        return cursor.lastrowid
+
+    def claim(self, now=None):
+        """
+        Take the newest job that is due
+
+        Return value: the job as a dictionary, or None if no job is due
+        """
+        now = time.time() if now is None else now
+        with self.lock:
+            self.db.execute("BEGIN IMMEDIATE")
+            try:
+                row = self.db.execute("SELECT * FROM jobs WHERE state = 'pending' AND next_attempt <= ? " +
+                                      "ORDER BY id DESC LIMIT 1", (now,)).fetchone()
+                if row is not None:
+                    self.db.execute("UPDATE jobs SET state = 'running', updated = ? WHERE id = ?",
+                                    (now, row['id']))
+                self.db.execute("COMMIT")
+            except BaseException:
+                self.db.execute("ROLLBACK")
+                raise
+        return dict(row) if row is not None else None
+
+    def peek(self, now=None):
+        """
+        Return value: the newest job that is due as a dictionary, without taking it,
+                      or None if no job is due
+        """
+        now = time.time() if now is None else now
+        row = self._execute("SELECT * FROM jobs WHERE state = 'pending' AND next_attempt <= ? " +
+                            "ORDER BY id DESC LIMIT 1", (now,)).fetchone()
+        return dict(row) if row is not None else None
+
+    def complete(self, job_id, status):
+        """
+        Record a job as done
+
+        :param job_id : the job ID
+        :param status : the import status, or "nothing new"
+        """
+        self._execute("UPDATE jobs SET state = 'done', status = ?, updated = ? WHERE id = ?",
+                      (status, time.time(), job_id))
+
+    def fail(self, job_id, error, permanent=False):
+        """
+        Record a failed attempt and schedule the next one
+
+        :param job_id    : the job ID
+        :param error     : why the attempt failed
+        :param permanent : give the job up straight away, e.g. the credentials were rejected
+
+        Return value: seconds until the next attempt, or None if the job was given up
+        """
+        now = time.time()
+        with self.lock:
+            self.db.execute("BEGIN IMMEDIATE")
+            try:
+                attempts = self.db.execute("SELECT attempts FROM jobs WHERE id = ?",
+                                           (job_id,)).fetchone()['attempts'] + 1
+                delay = retry_delay(attempts) if attempts < self.max_attempts and not permanent else None
+                # a newer snapshot may have superseded the job while it was running
+                self.db.execute("UPDATE jobs SET state = CASE WHEN state = 'running' THEN ? ELSE state END, " +
+                                "attempts = ?, next_attempt = ?, last_error = ?, updated = ? WHERE id = ?",
+                                ("pending" if delay is not None else "failed", attempts,
+                                 now + (delay or 0), error, now, job_id))
+                self.db.execute("COMMIT")
+            except BaseException:
+                self.db.execute("ROLLBACK")
+                raise
+        return delay
+
+    def next_due(self):
+        """
+        Return value: the time the next pending job is due, or None if nothing is pending
+        """
+        return self._execute("SELECT MIN(next_attempt) FROM jobs WHERE state = 'pending'").fetchone()[0]
+
+    def retry_now(self):
+        """
+        Make every pending job due now
+        """
+        self._execute("UPDATE jobs SET next_attempt = ? WHERE state = 'pending'", (time.time(),))
+
+    def close(self):
+        """
+        Close the database
+        """
+        with self.lock:
+            self.db.close()
+
+    def jobs(self, limit=20):
+        """
+        Return value: the most recent jobs as dictionaries, newest first
+        """
+        return [dict(row) for row in
+                self._execute("SELECT * FROM jobs ORDER BY id DESC LIMIT ?", (limit,)).fetchall()]
+
+
+def drain(queue, upload):
+    """
+    Upload every due job, newest first.  A failed attempt is recorded and the
+    failure is raised again, so the caller still sees it.  A failure with a true
+    permanent attribute (UploadFailed in the uploader), such as rejected
+    credentials, gives the job up instead of retrying it
+
+    :param queue  : UploadQueue object
+    :param upload : function taking a snapshot folder and returning the import status,
+                    or None if there was nothing new
+
+    Return value: the import status of the last job uploaded, or None
+    """
+    import_status = None
+    while True:
+        job = queue.claim()
+        if job is None:
+            return import_status
+        try:
+            import_status = upload(job['path'])
+        except (Exception, SystemExit) as e:
+            queue.fail(job['id'], getattr(e, 'message', None) or repr(e), getattr(e, 'permanent', False))
+            raise
+        queue.complete(job['id'], import_status or "nothing new")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Show the upload queue")
+    parser.add_argument('--queue', default=QUEUE_FILE, help="queue database (default %(default)s)")
+    parser.add_argument('--retry', action='store_true', help="make waiting jobs due now")
+    args = parser.parse_args()
+
+    my_queue = UploadQueue(args.queue)
+    if args.retry:
+        my_queue.retry_now()
+    for my_job in my_queue.jobs():
+        when = time.strftime('%Y-%m-%d %H:%M', time.localtime(my_job['created']))
+        line = f"{my_job['id']:5d} {when} {my_job['state']:<10} {my_job['path']}"
+        if my_job['state'] == "pending" and my_job['attempts']:
+            line += f" attempt {my_job['attempts'] + 1} at " + \
+                    time.strftime('%H:%M', time.localtime(my_job['next_attempt']))
+        if my_job['state'] in ("pending", "failed") and my_job['last_error']:
+            line += f" ({my_job['last_error'].strip()})"
+        if my_job['status']:
+            line += f" [{my_job['status']}]"
+        print(line)
@@ -1,21 +1,233 @@
-import RPi.GPIO as GPIO
+""" Button monitor
+
+Connects the Prisma to the Pi when the button on GPIO 26 is pressed.  The
+service sleeps until something happens: RPi.GPIO reports button edges from its
+own interrupt driven thread, the main thread waits for SIGTERM or SIGINT, and a
+connection cycle waits on mount table events.  Nothing wakes up on a timer.
+
+A press switches the YKUSH port on through one controller kept for the life of
+the service (ykush.py), without starting a shell or ykushcmd when the board can
+be opened directly.  The cycle lasts until the Weinmann card has been mounted
+and released again, by prisma_daemon.py or upload_data.sh, or until
+CYCLE_TIMEOUT passes, in which case the port is switched off so the Prisma is
+not left locked.  Contact bounce within DEBOUNCE_SECONDS is ignored, and presses
+during a cycle are counted but do not start another one.
+
+The button is read through a small hardware layer, so the monitor can run on a
+plain Linux box with simulated edges read from a file or FIFO, one per line
+("press"/"1" or "release"/"0"):
+
+    mkfifo /tmp/button
+    python3 usb_connect.py --simulate /tmp/button --ykush-command echo ykushxs --mount-path /tmp/card
+    echo press > /tmp/button
+
+Usage:
+    python3 usb_connect.py
+"""
+import argparse
+import logging
+import os
+import signal
+import stat
+import sys
+import threading
 import time
-import subprocess
 
-GPIO.setmode(GPIO.BCM)
-GPIO.setup(26, GPIO.IN)
+from mount_watch import mount_points, MountWatcher
+from prisma_logging import setup_logging, console_message
+from ykush import YkushController, open_ykush, YKUSH_COMMAND
+
+# BCM number of the GPIO the button is wired to, it reads high while pressed
+BUTTON_CHANNEL = 26
+# Edges closer together than this are contact bounce
+DEBOUNCE_SECONDS = 0.2
+# Where the Weinmann card is mounted once the Prisma is connected
+MOUNT_PATH = "/media/USER/Weinmann"
+# Longest connection cycle in seconds, the Prisma turns itself off after about 12 minutes
+CYCLE_TIMEOUT = 15 * 60
+
+
+class GpioButton:
+    """
+     The button on a Raspberry Pi GPIO, read with RPi.GPIO edge detection
+    """
+
+    def __init__(self, channel=BUTTON_CHANNEL):
+        """
+        Construct a new GpioButton object.
+
+        :param channel : BCM number of the GPIO
+        """
+        import RPi.GPIO as GPIO
+        self.GPIO = GPIO
+        self.channel = channel
+        GPIO.setmode(GPIO.BCM)
+        GPIO.setup(channel, GPIO.IN)
+
+    def start(self, on_edge):
+        """
+        Call on_edge(pressed) from the RPi.GPIO thread on every edge
+        """
+        self.GPIO.add_event_detect(self.channel, self.GPIO.BOTH,
+                                   callback=lambda channel: on_edge(self.GPIO.input(channel) == self.GPIO.HIGH))
+
+    def close(self):
+        self.GPIO.cleanup(self.channel)
+
+
+class SimulatedButton:
+    """
+     A button whose edges are read from a file or FIFO, or sent with press() and
+     release(), for running the monitor without GPIO hardware
+    """
+
+    def __init__(self, source=None):
+        """
+        Construct a new SimulatedButton object.
+
+        :param source : file or FIFO with one edge per line, None to only use press() and release()
+        """
+        self.source = source
+        self.on_edge = None
+
+    def start(self, on_edge):
+        self.on_edge = on_edge
+        if self.source is not None:
+            threading.Thread(target=self.read_edges, name="simulated-button", daemon=True).start()
+
+    def read_edges(self):
+        while True:
+            with open(self.source) as f:
+                for line in f:
+                    edge = line.strip().lower()
+                    if edge in ("press", "1"):
+                        self.press()
+                    elif edge in ("release", "0"):
+                        self.release()
+            # a FIFO is opened again for the next writer, a file is read once
+            if not stat.S_ISFIFO(os.stat(self.source).st_mode):
+                return
+
+    def press(self):
+        self.on_edge(True)
+
+    def release(self):
+        self.on_edge(False)
+
+    def close(self):
+        pass
+
+
+class ButtonMonitor:
+    """
+     Turns debounced button presses into connection cycles, one at a time
+    """
+
+    def __init__(self, ykush, mount_path=MOUNT_PATH, cycle_timeout=CYCLE_TIMEOUT,
+                 debounce=DEBOUNCE_SECONDS, logger=None):
+        """
+        Construct a new ButtonMonitor object.
+
+        :param ykush         : YKUSH controller the Prisma is connected with, see ykush.py
+        :param mount_path    : where the Weinmann card is mounted
+        :param cycle_timeout : seconds after which the port is switched off if the card was not released
+        :param debounce      : edges closer together than this many seconds are ignored
+        :param logger        : logger for progress and failures
+        """
+        self.ykush = ykush
+        self.mount_path = mount_path
+        self.cycle_timeout = cycle_timeout
+        self.debounce = debounce
+        self.logger = logger or logging.getLogger('prisma.button')
+        self.lock = threading.Lock()
+        self.last_edge = None
+        self.cycle = None
+        self.coalesced = 0
+
+    def edge(self, pressed, now=None):
+        """
+        Handle a button edge, called from the button's thread
+
+        :param pressed : True when the button went down
+        :param now     : time of the edge, time.monotonic() if None
+        """
+        now = time.monotonic() if now is None else now
+        with self.lock:
+            bounce = self.last_edge is not None and now - self.last_edge < self.debounce
+            self.last_edge = now
+            if bounce or not pressed:
+                return
+            if self.cycle is not None:
+                self.coalesced += 1
+                self.logger.info(f"Button pressed during a connection cycle, ignored ({self.coalesced} so far)")
+                return
+            self.coalesced = 0
+            self.cycle = threading.Thread(target=self.run_cycle, name="connection-cycle", daemon=True)
+            self.cycle.start()
+
+    def wait_for_release(self, watcher):
+        """
+        Wait until the card has been mounted and then unmounted, or until cycle_timeout
+
+        Return value: True if the card was released in time
+        """
+        end_time = time.monotonic() + self.cycle_timeout
+        seen = False
+        while True:
+            mounted = self.mount_path in mount_points()
+            if mounted:
+                seen = True
+            elif seen:
+                return True
+            remaining = end_time - time.monotonic()
+            if remaining <= 0:
+                return False
+            watcher.wait(remaining)
+
+    def run_cycle(self):
+        start = time.monotonic()
+        try:
+            console_message(self.logger, "Button pressed, connecting the Prisma")
+            watcher = MountWatcher()
+            if not self.ykush.power_on():
+                self.logger.error("Could not switch the YKUSH port on")
+                return
+            if self.wait_for_release(watcher):
+                console_message(self.logger, f"Card released after {time.monotonic() - start:.0f}s")
+            else:
+                console_message(self.logger, f"Card not released within {self.cycle_timeout}s, " +
+                                "disconnecting the Prisma")
+                self.ykush.power_off()
+        except Exception:
+            self.logger.exception("Connection cycle failed")
+        finally:
+            with self.lock:
+                self.cycle = None
 
-def my_callback(channel):
-    if GPIO.input(channel) == GPIO.HIGH:
-        print("Button Pressed")
-        subprocess.run(["/home/USER/prisma/scripts/ykushxs_on.sh"])
-    else:
-        print("Button Released")
 
-GPIO.add_event_detect(26, GPIO.BOTH, callback=my_callback, bouncetime=200)
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Connect the Prisma when the button is pressed")
+    parser.add_argument('--channel', type=int, default=BUTTON_CHANNEL, help="BCM GPIO of the button")
+    parser.add_argument('--mount-path', default=MOUNT_PATH, help="where the card is mounted")
+    parser.add_argument('--cycle-timeout', type=int, default=CYCLE_TIMEOUT,
+                        help="seconds before the port is switched off if the card was not released")
+    parser.add_argument('--simulate', metavar='FILE',
+                        help="read button edges from FILE (a FIFO, or /dev/stdin) instead of the GPIO")
+    parser.add_argument('--ykush-command', nargs='+',
+                        help="switch the port with this command plus -u/-d instead of the board or ykushcmd")
+    args = parser.parse_args()
 
-try:
-    while True:
-        time.sleep(0.1)
-except KeyboardInterrupt:
-    GPIO.cleanup()
+    setup_logging('./prisma-api.log')
+    # signals are only taken by sigwait below, the button and cycle threads never see them
+    my_signals = {signal.SIGTERM, signal.SIGINT}
+    signal.pthread_sigmask(signal.SIG_BLOCK, my_signals)
+    my_ykush = YkushController(args.ykush_command) if args.ykush_command else open_ykush(YKUSH_COMMAND)
+    my_button = SimulatedButton(args.simulate) if args.simulate else GpioButton(args.channel)
+    my_monitor = ButtonMonitor(my_ykush, args.mount_path, args.cycle_timeout)
+    my_button.start(my_monitor.edge)
+    console_message(logging, f"Waiting for the button ({type(my_ykush).__name__})")
+    my_signal = signal.sigwait(my_signals)
+    console_message(logging, f"Stopping on {signal.Signals(my_signal).name}")
+    my_button.close()
+    my_ykush.close()
+    sys.exit(0)
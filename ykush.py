@@ -0,0 +1,163 @@
+""" YKUSH XS port control
+
+Switches the USB port of the Yepkit YKUSH XS board that connects the Prisma,
+the same way ykushxs_on.sh and ykushxs_off.sh do.
+
+YkushController runs ykushcmd for every switch.  HidrawYkush keeps the board's
+/dev/hidraw device open and sends the HID reports itself, so a long running
+service such as usb_connect.py or prisma_daemon.py switches the port without
+starting sudo and ykushcmd each time.  It needs read/write access to the hidraw
+device, e.g. with a udev rule:
+
+    SUBSYSTEM=="hidraw", ATTRS{idVendor}=="04d8", ATTRS{idProduct}=="f0cd", MODE="0660", GROUP="plugdev"
+
+open_ykush() uses HidrawYkush when the board can be opened and falls back to
+ykushcmd otherwise, or after the board stops answering.
+"""
+import glob
+import logging
+import os
+import select
+import subprocess
+import threading
+
+# Command used to switch the port, ykushcmd needs root to open the board
+YKUSH_COMMAND = ("sudo", "ykushcmd", "ykushxs")
+# USB vendor and product ID of the YKUSH XS
+YKUSHXS_VENDOR_ID = 0x04D8
+YKUSHXS_PRODUCT_ID = 0xF0CD
+# HID commands of the downstream port, the board answers 0x01 in the first byte on success
+PORT_UP = 0x11
+PORT_DOWN = 0x01
+REPORT_SIZE = 64
+# Seconds to wait for the board to answer a command
+REPLY_TIMEOUT = 1.0
+
+
+class YkushController:
+    """
+     Switches the YKUSH XS downstream port on and off
+    """
+
+    def __init__(self, command=YKUSH_COMMAND, logger=None):
+        """
+        Construct a new YkushController object.
+
+        :param command : ykushcmd command line without the -u/-d option
+        :param logger  : logger for failures
+        """
+        self.command = tuple(command)
+        self.logger = logger or logging.getLogger('prisma.ykush')
+
+    def _switch(self, option):
+        result = subprocess.run(self.command + (option,), capture_output=True, text=True)
+        if result.returncode != 0:
+            self.logger.error(f"{' '.join(self.command)} {option} failed: {result.stderr.strip()}")
+        return result.returncode == 0
+
+    def power_on(self):
+        """
+        Connect the Prisma. Return value: True on success
+        """
+        return self._switch("-u")
+
+    def power_off(self):
+        """
+        Disconnect the Prisma so it leaves USB mode. Return value: True on success
+        """
+        return self._switch("-d")
+
+    def close(self):
+        pass
+
+
+def find_hidraw(vendor_id=YKUSHXS_VENDOR_ID, product_id=YKUSHXS_PRODUCT_ID):
+    """
+    Return value: the /dev/hidraw path of the first board with the USB IDs, None if none is connected
+    """
+    wanted = f"HID_ID=0003:{vendor_id:08X}:{product_id:08X}"
+    for uevent in sorted(glob.glob("/sys/class/hidraw/hidraw*/device/uevent")):
+        try:
+            with open(uevent) as f:
+                if wanted in f.read().upper().split():
+                    return os.path.join("/dev", uevent.split('/')[4])
+        except OSError:
+            continue
+    return None
+
+
+class HidrawYkush:
+    """
+     Switches the YKUSH XS port over a hidraw device kept open for the life of
+     the object.  A command the board does not acknowledge is repeated with the
+     fallback controller, which is then used from that point on
+    """
+
+    def __init__(self, device, fallback=None, logger=None):
+        """
+        Construct a new HidrawYkush object.
+
+        :param device   : the /dev/hidraw path of the board
+        :param fallback : YkushController used when the board does not answer, None for none
+        :param logger   : logger for failures
+        """
+        self.device = device
+        self.fallback = fallback
+        self.logger = logger or logging.getLogger('prisma.ykush')
+        self.fd = os.open(device, os.O_RDWR)
+        self.lock = threading.Lock()
+
+    def _send(self, command):
+        # report ID 0, then the command twice as ykushcmd sends it, padded to a full report
+        report = bytes([0, command, command]) + bytes(REPORT_SIZE - 2)
+        with self.lock:
+            if self.fd is None:
+                return False
+            try:
+                os.write(self.fd, report)
+                ready, _, _ = select.select([self.fd], [], [], REPLY_TIMEOUT)
+                reply = os.read(self.fd, REPORT_SIZE) if ready else b''
+            except OSError as e:
+                self.logger.error(f"{self.device}: {e}")
+                reply = b''
+            if reply[:1] == b'\x01':
+                return True
+            self.logger.error(f"{self.device} did not acknowledge command 0x{command:02x}, reply {reply[:4].hex()}")
+            os.close(self.fd)
+            self.fd = None
+        return False
+
+    def power_on(self):
+        """
+        Connect the Prisma. Return value: True on success
+        """
+        return self._send(PORT_UP) or (self.fallback is not None and self.fallback.power_on())
+
+    def power_off(self):
+        """
+        Disconnect the Prisma so it leaves USB mode. Return value: True on success
+        """
+        return self._send(PORT_DOWN) or (self.fallback is not None and self.fallback.power_off())
+
+    def close(self):
+        with self.lock:
+            if self.fd is not None:
+                os.close(self.fd)
+                self.fd = None
+
+
+def open_ykush(command=YKUSH_COMMAND, logger=None):
+    """
+    Return the persistent hidraw controller if the board can be opened,
+    otherwise the ykushcmd controller
+    """
+    logger = logger or logging.getLogger('prisma.ykush')
+    fallback = YkushController(command, logger)
+    device = find_hidraw()
+    if device is None:
+        return fallback
+    try:
+        return HidrawYkush(device, fallback, logger)
+    except OSError as e:
+        logger.info(f"Using {' '.join(command)}, {device} can't be opened: {e}")
+        return fallback